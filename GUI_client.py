@@ -1,21 +1,32 @@
-import socket
+import argparse
 import os
 import threading
 import tkinter as tk
 from tkinter import filedialog, messagebox
-from tkinter.scrolledtext import ScrolledText
+
+from client import PARALLEL_STREAMS, RANGE_SIZE, ClientError, FileClient
+from download_cache import DOWNLOAD_CACHE_SIZE, DownloadCache
+from log_view import MAX_LINES, LogView
+
 
 class ClientGUI:
-    def __init__(self, root):
+    """Tkinter front end; the protocol itself lives in client.FileClient."""
+
+    def __init__(self, root, log_file=None, log_lines=MAX_LINES, cache=None):
         self.root = root
         self.root.title("File Client")
-        self.client_socket = None
+        self.log_file = log_file
+        self.log_lines = log_lines
+        self.cache = cache  # DownloadCache kept across connections, if any
+        self.client = None
         self.username = ""
-        self.connected = False
-        self.filepath = ""
 
         self.create_widgets()
 
+    @property
+    def connected(self):
+        return self.client is not None and self.client.connected
+
     def create_widgets(self):
         frame = tk.Frame(self.root)
         frame.pack(pady=10)
@@ -32,9 +43,21 @@ class ClientGUI:
         self.username_entry = tk.Entry(frame)
         self.username_entry.grid(row=2, column=1)
 
-        tk.Button(frame, text="Connect", command=self.connect_to_server).grid(row=3, column=0, columnspan=2, pady=10)
+        tk.Label(frame, text="Parallel Streams:").grid(row=3, column=0, sticky="e")
+        self.streams_entry = tk.Spinbox(frame, from_=1, to=16, width=5)
+        self.streams_entry.delete(0, tk.END)
+        self.streams_entry.insert(0, PARALLEL_STREAMS)
+        self.streams_entry.grid(row=3, column=1, sticky="w")
+
+        tk.Label(frame, text="Range Size (MB):").grid(row=4, column=0, sticky="e")
+        self.range_size_entry = tk.Entry(frame, width=7)
+        self.range_size_entry.insert(0, RANGE_SIZE // (1024 * 1024))
+        self.range_size_entry.grid(row=4, column=1, sticky="w")
 
-        self.log = ScrolledText(self.root, width=80, height=20, state='disabled')
+        tk.Button(frame, text="Connect", command=self.connect_to_server).grid(row=5, column=0, columnspan=2, pady=10)
+
+        # Transfer threads log too; LogView hands their lines to Tk in batches.
+        self.log = LogView(self.root, max_lines=self.log_lines, log_file=self.log_file, width=80, height=20)
         self.log.pack(pady=10)
 
         button_frame = tk.Frame(self.root)
@@ -47,10 +70,16 @@ class ClientGUI:
         tk.Button(button_frame, text="Disconnect", command=self.disconnect).grid(row=0, column=4, padx=5)
 
     def log_message(self, message):
-        self.log.config(state='normal')
-        self.log.insert(tk.END, f"{message}\n")
-        self.log.see(tk.END)
-        self.log.config(state='disabled')
+        self.log.write(message)
+
+    def run_in_background(self, target, *args):
+        """Run a blocking client call off the GUI thread."""
+        def run():
+            try:
+                target(*args)
+            except (ClientError, OSError) as e:
+                self.log_message(f"[ERROR] {e}")
+        threading.Thread(target=run, daemon=True).start()
 
     def connect_to_server(self):
         server_ip = self.server_ip_entry.get()
@@ -68,97 +97,79 @@ class ClientGUI:
             return
 
         try:
-            self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.client_socket.connect((server_ip, port))
-            self.log_message(f"[CONNECTED] Connected to server at {server_ip}:{port}")
-            self.authenticate()
-        except Exception as e:
-            self.log_message(f"[ERROR] Unable to connect to server: {e}")
-            return
+            streams = max(1, int(self.streams_entry.get()))
+        except ValueError:
+            streams = PARALLEL_STREAMS
+        try:
+            range_size = max(1, int(self.range_size_entry.get())) * 1024 * 1024
+        except ValueError:
+            range_size = RANGE_SIZE
 
-    def authenticate(self):
-        self.send_message(self.username, self.client_socket)
-        response = self.receive_message(self.client_socket)
-        if response and response.startswith("[AUTHENTICATED]"):
-            self.connected = True
-            self.log_message(f"[AUTHENTICATED] Welcome, {self.username}!")
-            threading.Thread(target=self.listener, daemon=True).start()
-        else:
-            self.log_message(response)
-            self.client_socket.close()
-            self.client_socket = None
+        client = FileClient(server_ip, port, self.username, streams=streams, range_size=range_size, on_event=self.on_event,
+                            cache=self.cache)
+        self.run_in_background(self.connect, client)
 
-    def send_message(self, message, connection_socket : socket.socket):
+    def connect(self, client):
         try:
-            connection_socket.send(len(message).to_bytes(4, byteorder="big"))
-            connection_socket.send(message.encode())
-        except Exception as e:
-            self.log_message(f"[ERROR] Failed to send message: {e}")
+            client.connect()
+        except ClientError as e:
+            self.log_message(f"[ERROR] {e}")
+            return
+        self.client = client
+        self.log_message(f"[CONNECTED] Connected to server at {client.host}:{client.port}")
+        self.log_message(f"[AUTHENTICATED] Welcome, {self.username}!")
+        if client.data_channels:
+            self.log_message(f"[DATA CHANNEL] Transfers will share {len(client.data_channels)} data channels.")
+        else:
+            self.log_message("[DATA CHANNEL] Falling back to per-transfer ports.")
 
-    def receive_message(self, connection_socket):
-        try:
-            message_length_bytes = connection_socket.recv(4)
-            if not message_length_bytes:
-                return None
-            message_length = int.from_bytes(message_length_bytes, byteorder="big")
-            message = connection_socket.recv(message_length).decode()
-            return message
-        except Exception as e:
-            self.log_message(f"[ERROR] Failed to receive message: {e}")
-            return None
+    def on_event(self, message):
+        """Server messages that don't answer one of our requests, e.g. notifications."""
+        if message.startswith("[ERROR]"):
+            self.log_message(f"[SERVER ERROR]: {message}")
+        elif message.startswith("[NOTIFICATION]"):
+            self.log_message(f"[SERVER NOTIFICATION]: {message}")
+        elif not message.startswith("[DOWNLOADS]"):  # Downloads are reported when they complete
+            self.log_message(message)
 
     def upload_file(self):
         if not self.connected:
             messagebox.showerror("Error", "Not connected to server.")
             return
 
-        self.filepath = filedialog.askopenfilename()
-        if not self.filepath:
+        filepaths = filedialog.askopenfilenames()
+        if not filepaths:
             return
+        if len(filepaths) > 1:
+            self.log_message(f"[UPLOADING] Sending {len(filepaths)} files...")
+            self.run_in_background(self.upload_batch, filepaths)
+            return
+        filepath = filepaths[0]
 
-        if not os.path.exists(self.filepath):
+        if not os.path.exists(filepath):
             self.log_message("[ERROR] File does not exist.")
             return
 
-        filesize = os.path.getsize(self.filepath)
-        filename = os.path.basename(self.filepath)
-        packet = f"[UPLOAD]|[{filename}]|[{filesize}]"
-        self.send_message(packet, self.client_socket)
-        #self.send_file(filepath, filename)
-        #threading.Thread(target=self.send_file, args=(filepath, filename), daemon=True).start()
-
-    def send_file(self, port, filename):
+        self.log_message(f"[UPLOADING] Sending {os.path.basename(filepath)}...")
+        self.run_in_background(self.upload, filepath)
 
+    def upload(self, filepath):
+        result = self.client.upload(filepath)
+        if result.ok:
+            self.log_message(f"[UPLOAD][SERVER RESPONSE] {result.message}")
+            self.log_message(f"[UPLOAD COMPLETE] {result.filename} uploaded.")
+        else:
+            self.log_message(f"[ERROR] Failed to upload file: {result.message} Upload it again to resume.")
 
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as data_socket:
-            data_socket.connect((self.server_ip_entry.get(), port))
-
-            try:
-                with open(self.filepath, "rb") as file:
-                    self.log_message(f"[UPLOADING] Sending {filename}...")
-                    while chunk:= file.read(1024):
-                        data_socket.send(chunk)
-                self.log_message(f"[UPLOAD COMPLETE] {filename} uploaded.")
-            except Exception as e:
-                self.log_message(f"[ERROR] Failed to upload file: {e}")
-        """try:
-            with open(self.filepath, "rb") as file:
-                self.log_message(f"[UPLOADING] Sending {filename}...")
-                while True:
-                    chunk = file.read(1024)
-                    if not chunk:
-                        break
-                    stateless_conn.send(chunk)
-            self.log_message(f"[UPLOAD COMPLETE] {filename} uploaded.")
-        except Exception as e:
-            self.log_message(f"[ERROR] Failed to upload file: {e}")"""
+    def upload_batch(self, filepaths):
+        self.log_batch("[BATCH_UPLOAD]", self.client.upload_many(filepaths))
 
     def download_file(self):
         if not self.connected:
             messagebox.showerror("Error", "Not connected to server.")
             return
 
-        filename = simple_input_dialog("Enter the name of the file to download:")
+        filename = simple_input_dialog("Enter the name of the file to download (or several, separated by commas):")
         if not filename:
             return
 
@@ -166,101 +177,77 @@ class ClientGUI:
         if not uploader_name:
             return
 
-        message = f"[DOWNLOAD]|[{filename}]|[{uploader_name}]"
-        self.send_message(message, self.client_socket)
+        download_dir = filedialog.askdirectory(title="Select Download Directory")
+        if not download_dir:
+            return
+
+        filenames = [name.strip() for name in filename.split(",") if name.strip()]
+        if len(filenames) > 1:
+            self.log_message(f"[DOWNLOADING] Receiving {len(filenames)} files...")
+            self.run_in_background(self.download_batch, filenames, uploader_name, download_dir)
+            return
+
+        self.log_message(f"[DOWNLOADING] Receiving {filename}...")
+        self.run_in_background(self.download, filename, uploader_name, download_dir)
+
+    def download(self, filename, uploader_name, download_dir):
+        result = self.client.download(filename, uploader_name, download_dir)
+        if result.ok:
+            self.log_message(f"[DOWNLOAD COMPLETE] {result.message}")
+        else:
+            self.log_message(f"[SERVER ERROR]: Download of '{filename}' failed: {result.message}")
+
+    def download_batch(self, filenames, uploader_name, download_dir):
+        self.log_batch("[BATCH_DOWNLOAD]", self.client.download_many(filenames, uploader_name, download_dir))
+
+    def log_batch(self, tag, result):
+        """A batch summary, then a line for every file that didn't make it."""
+        self.log_message(f"{tag}[SERVER RESPONSE] {result.message}")
+        for filename, status in result.statuses:
+            if status != "OK":
+                self.log_message(f"  {filename}: {status}")
 
     def list_files(self):
         if not self.connected:
             messagebox.showerror("Error", "Not connected to server.")
             return
 
-        self.send_message("[LIST_FILES]", self.client_socket)
+        self.run_in_background(self.show_files)
+
+    def show_files(self):
+        files = self.client.list_files()
+        if files:
+            lines = "\n".join(f"{listed.filename} (Uploaded by {listed.owner})" for listed in files)
+        else:
+            lines = "No files available."
+        self.log_message(f"[AVAILABLE FILES]: \n{lines}")
 
     def delete_file(self):
         if not self.connected:
             messagebox.showerror("Error", "Not connected to server.")
             return
 
-        filename = simple_input_dialog("Enter the name of the file to delete:")
+        filename = simple_input_dialog("Enter the name of the file to delete (or several, separated by commas):")
         if not filename:
             return
 
-        message = f"[DELETE]|[{filename}]"
-        self.send_message(message, self.client_socket)
+        filenames = [name.strip() for name in filename.split(",") if name.strip()]
+        if len(filenames) > 1:
+            self.run_in_background(lambda: self.log_batch("[BATCH_DELETE]", self.client.delete_many(filenames)))
+            return
+        self.run_in_background(self.delete, filename)
+
+    def delete(self, filename):
+        result = self.client.delete(filename)
+        self.log_message(f"[DELETE] {result.message}" if result.ok else f"[ERROR] {result.message}")
 
     def disconnect(self):
         if self.connected:
-            self.send_message("[DISCONNECT]", self.client_socket)
-            self.client_socket.close()
-            self.connected = False
+            self.client.close()
             self.log_message("[DISCONNECTED] Connection closed.")
+        self.log.close()
         self.root.quit()
 
-    def listener(self):
-        while self.connected:
-            response = self.receive_message(self.client_socket)
-            if not response:
-                self.log_message("[DISCONNECTED] Connection closed by server.")
-                self.connected = False
-                break
-
-            if response.startswith("[ERROR]"):
-                self.log_message(f"[SERVER ERROR]: {response}")
-
-            elif response.startswith("[NOTIFICATION]"):
-                self.log_message(f"[SERVER NOTIFICATION]: {response}")
-
-            elif response.startswith("[UPLOAD]"):
-                if response.startswith("[UPLOAD][SERVER RESPONSE]"):
-                    self.log_message(f"{response}")
-                else:
-                    _, port, filename = response.split("|")
-                    port = int(port.strip("[]"))
-                    filename = filename.strip("[]")
-
-                    threading.Thread(target=self.send_file, args=(port, filename), daemon=True).start()
-
-            elif response.startswith("[DOWNLOAD]"):
-
-                if response.startswith("[ERROR]"):
-                    self.log_message(f"[SERVER RESPONSE]: {response}")
-                elif response.startswith("[DOWNLOAD][SERVER RESPONSE]"):
-                    self.log_message(f"{response}")
-                else:
-                    _, temp_port, temp_filename = response.split("|")
-                    temp_port = int(temp_port.strip("[]"))
-                    temp_filename = temp_filename.strip("[]")
-                    threading.Thread(target=self.receive_file, args=(temp_port, temp_filename), daemon=True).start()
-                    #self.receive_file(filename, filesize)
-
-            elif response.startswith("[DELETE]"):
-                self.log_message(f"{response}")
-
-            elif response.startswith("[LIST_FILES]"):
-                self.log_message(f"[AVAILABLE FILES]: {response[12:]}")
-
-    def receive_file(self, port, filename):
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as data_socket:
-            data_socket.connect((self.server_ip_entry.get(), port))
-            download_dir = filedialog.askdirectory(title="Select Download Directory")
-            filepath = os.path.join(download_dir, filename)
-
-            filesize = self.receive_message(data_socket)
-            filesize = int(filesize.strip("[] "))
-
-            try:
-                with open(filepath, "wb") as file:
-                    bytes_received = 0
-                    while bytes_received < filesize:
-                        data = data_socket.recv(min(1024, filesize - bytes_received))
-                        if not data:
-                            break
-                        file.write(data)
-                        bytes_received += len(data)
-                self.log_message(f"[DOWNLOAD COMPLETE] File saved as '{filepath}'.")
-            except Exception as e:
-                self.log_message(f"[ERROR] Failed to download file: {e}")
-                self.log_message(f"[DOWNLOAD COMPLETE] File saved as '{filepath}'.")
 
 def simple_input_dialog(prompt):
     input_window = tk.Toplevel()
@@ -279,6 +266,14 @@ def simple_input_dialog(prompt):
     return result[0] if result else None
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="File client with a GUI.")
+    parser.add_argument("--log-file", help="Also write the log to this file, rotated by size")
+    parser.add_argument("--log-lines", type=int, default=MAX_LINES, help="Lines of log to keep on screen")
+    parser.add_argument("--cache-dir", help="Keep downloaded files here, so unchanged files aren't downloaded again")
+    parser.add_argument("--cache-mb", type=int, default=DOWNLOAD_CACHE_SIZE // (1024 * 1024),
+                        help="Size limit of the download cache (0 turns it off)")
+    args = parser.parse_args()
     root = tk.Tk()
-    app = ClientGUI(root)
+    cache = DownloadCache(args.cache_dir, args.cache_mb * 1024 * 1024) if args.cache_dir else None
+    app = ClientGUI(root, log_file=args.log_file, log_lines=args.log_lines, cache=cache)
     root.mainloop()
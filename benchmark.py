@@ -0,0 +1,345 @@
+"""Load-generation benchmark for the file server.
+
+Starts server_engine.py on loopback against a temporary storage directory,
+then drives simulated clients (client.FileClient, one thread each) through
+a set of workloads:
+
+    small_uploads   every client uploads many small files
+    large_uploads   every client uploads (and replaces) a large file
+    hot_downloads   every client downloads the same file, over and over
+    list_files      every client lists a catalog of --catalog-size files
+    delete_churn    every client uploads and deletes small files in a loop
+
+For each workload it reports throughput (MB/s, ops/s), latency percentiles
+and the server process's thread count and memory, and writes everything to a
+JSON file.  Pass an earlier result file with --compare to see what changed:
+
+    python benchmark.py --clients 16 --output after.json --compare before.json
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from client import ClientError, FileClient
+
+WORKLOADS = ("small_uploads", "large_uploads", "hot_downloads", "list_files", "delete_churn")
+SAMPLE_INTERVAL = 0.1  # Seconds between samples of the server's threads and memory
+STARTUP_TIMEOUT = 10  # Seconds to wait for the server to accept connections
+PERCENTILES = (50, 90, 99)
+
+
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+def percentile(sorted_values, percent):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, round(percent / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def process_status(pid):
+    """(threads, resident bytes) of a process and its children, or (None, None) where /proc isn't available."""
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            fields = dict(line.split(":", 1) for line in status if ":" in line)
+        threads, rss = int(fields["Threads"]), int(fields["VmRSS"].split()[0]) * 1024
+    except (OSError, KeyError, ValueError):
+        return None, None
+    # Add up worker processes too (server_engine.py --workers).
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as children:
+            child_pids = children.read().split()
+    except OSError:
+        child_pids = []
+    for child in child_pids:
+        child_threads, child_rss = process_status(child)
+        if child_threads is not None:
+            threads += child_threads
+            rss += child_rss
+    return threads, rss
+
+
+class ResourceSampler:
+    """Samples a process's thread count and resident memory in the background."""
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.samples = []
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def run(self):
+        while not self.stopped.is_set():
+            threads, rss = process_status(self.pid)
+            if threads is not None:
+                self.samples.append((threads, rss))
+            self.stopped.wait(SAMPLE_INTERVAL)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        self.thread.join()
+
+    def summary(self):
+        if not self.samples:
+            return {"threads_max": None, "threads_mean": None, "rss_max_mb": None, "rss_mean_mb": None}
+        threads = [sample[0] for sample in self.samples]
+        rss = [sample[1] for sample in self.samples]
+        return {
+            "threads_max": max(threads),
+            "threads_mean": round(sum(threads) / len(threads), 1),
+            "rss_max_mb": round(max(rss) / 2**20, 1),
+            "rss_mean_mb": round(sum(rss) / len(rss) / 2**20, 1),
+        }
+
+
+class BenchmarkServer:
+    """server_engine.py running as its own process, so its threads and memory can be measured apart from ours."""
+
+    def __init__(self, storage_dir, extra_args=()):
+        self.storage_dir = storage_dir
+        self.port = free_port()
+        self.extra_args = list(extra_args)
+        self.process = None
+
+    def __enter__(self):
+        server = os.path.join(os.path.dirname(os.path.abspath(__file__)), "server_engine.py")
+        self.process = subprocess.Popen(
+            [sys.executable, server, "--host", "127.0.0.1", "--port", str(self.port), "--storage", self.storage_dir,
+             "--data-port-base", str(free_port()), *self.extra_args],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        deadline = time.monotonic() + STARTUP_TIMEOUT
+        while time.monotonic() < deadline:
+            try:
+                socket.create_connection(("127.0.0.1", self.port), timeout=1).close()
+                return self
+            except OSError:
+                if self.process.poll() is not None:
+                    break
+                time.sleep(0.05)
+        self.__exit__()
+        raise RuntimeError("Benchmark server did not start")
+
+    def __exit__(self, *exc_info):
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+
+
+class Benchmark:
+    def __init__(self, args, server, work_dir):
+        self.args = args
+        self.server = server
+        self.work_dir = work_dir
+        self.small_file = self.make_file("small.bin", args.small_size)
+        self.large_file = self.make_file("large.bin", args.large_size)
+
+    def make_file(self, name, size):
+        # Random content, so transfer compression doesn't flatter the numbers.
+        path = os.path.join(self.work_dir, name)
+        with open(path, "wb") as file:
+            for offset in range(0, size, 1024 * 1024):
+                file.write(os.urandom(min(1024 * 1024, size - offset)))
+        return path
+
+    def new_client(self, username):
+        return FileClient("127.0.0.1", self.server.port, username, streams=self.args.streams, protocol=self.args.protocol,
+                          delta=self.args.delta)
+
+    def run(self, name):
+        """Run one workload with --clients clients at once and summarise it."""
+        operation = getattr(self, f"op_{name}")
+        setup = getattr(self, f"setup_{name}", None)
+        if setup:
+            setup()
+        clients = [self.new_client(f"bench{index}").connect() for index in range(self.args.clients)]
+        results = [[] for _ in clients]  # Per client: (latency, bytes, ok)
+        start = threading.Barrier(len(clients) + 1)
+
+        def drive(index, client):
+            start.wait()
+            for iteration in range(self.args.iterations):
+                started = time.perf_counter()
+                try:
+                    moved, ok = operation(client, index, iteration)
+                except (ClientError, OSError):
+                    moved, ok = 0, False
+                results[index].append((time.perf_counter() - started, moved, ok))
+
+        workers = [threading.Thread(target=drive, args=(index, client), daemon=True) for index, client in enumerate(clients)]
+        for worker in workers:
+            worker.start()
+        with ResourceSampler(self.server.process.pid) as sampler:
+            start.wait()
+            began = time.perf_counter()
+            for worker in workers:
+                worker.join()
+            elapsed = time.perf_counter() - began
+        for client in clients:
+            client.close()
+
+        operations = [result for client_results in results for result in client_results]
+        latencies = sorted(latency for latency, _, ok in operations if ok)
+        moved = sum(moved for _, moved, ok in operations if ok)
+        summary = {
+            "clients": len(clients),
+            "operations": len(operations),
+            "errors": sum(not ok for _, _, ok in operations),
+            "elapsed_s": round(elapsed, 4),
+            "ops_per_s": round(len(latencies) / elapsed, 2),
+            "mb_per_s": round(moved / elapsed / 2**20, 2),
+            "latency_ms": {f"p{percent}": round(percentile(latencies, percent) * 1000, 3) if latencies else None
+                           for percent in PERCENTILES},
+            "client_threads_max": len(clients) + 1,
+        }
+        summary["latency_ms"]["max"] = round(latencies[-1] * 1000, 3) if latencies else None
+        summary.update({f"server_{key}": value for key, value in sampler.summary().items()})
+        return summary
+
+    # ------------------------------------------------------------------ workloads
+
+    def op_small_uploads(self, client, index, iteration):
+        path = os.path.join(self.work_dir, f"small-{index}-{iteration}.bin")
+        shutil.copyfile(self.small_file, path)
+        result = client.upload(path)
+        os.remove(path)
+        return result.size, result.ok
+
+    def op_large_uploads(self, client, index, iteration):
+        result = client.upload(self.large_file)
+        return result.size, result.ok
+
+    def setup_hot_downloads(self):
+        with self.new_client("benchhot") as client:
+            client.upload(self.large_file)
+
+    def op_hot_downloads(self, client, index, iteration):
+        download_dir = os.path.join(self.work_dir, f"downloads-{index}")
+        os.makedirs(download_dir, exist_ok=True)
+        result = client.download(os.path.basename(self.large_file), "benchhot", download_dir)
+        if result.ok:
+            os.remove(os.path.join(download_dir, result.filename))
+        return result.size or 0, result.ok
+
+    def setup_list_files(self):
+        seed_dir = os.path.join(self.work_dir, "catalog")
+        os.makedirs(seed_dir, exist_ok=True)
+        paths = []
+        for number in range(self.args.catalog_size):
+            path = os.path.join(seed_dir, f"file-{number:07d}.txt")
+            with open(path, "wb") as file:
+                file.write(b"x")
+            paths.append(path)
+        with self.new_client("benchcatalog") as client:
+            for start in range(0, len(paths), 1000):
+                client.upload_many(paths[start:start + 1000])
+        shutil.rmtree(seed_dir)
+
+    def op_list_files(self, client, index, iteration):
+        return 0, bool(client.list_files())
+
+    def op_delete_churn(self, client, index, iteration):
+        path = os.path.join(self.work_dir, f"churn-{index}-{iteration}.bin")
+        shutil.copyfile(self.small_file, path)
+        uploaded = client.upload(path)
+        os.remove(path)
+        deleted = client.delete(os.path.basename(path))
+        return uploaded.size, uploaded.ok and deleted.ok
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, timeout=10,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def print_report(results, baseline=None):
+    header = f"{'workload':<15}{'ops/s':>10}{'MB/s':>10}{'p50 ms':>10}{'p99 ms':>10}{'errors':>8}{'threads':>9}{'RSS MB':>9}"
+    print(header)
+    for name, summary in results["workloads"].items():
+        print(f"{name:<15}{summary['ops_per_s']:>10}{summary['mb_per_s']:>10}{str(summary['latency_ms']['p50']):>10}"
+              f"{str(summary['latency_ms']['p99']):>10}{summary['errors']:>8}{str(summary['server_threads_max']):>9}"
+              f"{str(summary['server_rss_max_mb']):>9}")
+        previous = (baseline or {}).get("workloads", {}).get(name)
+        if previous:
+            changes = []
+            for key in ("ops_per_s", "mb_per_s"):
+                if previous[key]:
+                    changes.append(f"{key} {(summary[key] - previous[key]) / previous[key] * 100:+.1f}%")
+            if previous["latency_ms"]["p99"] and summary["latency_ms"]["p99"]:
+                change = (summary["latency_ms"]["p99"] - previous["latency_ms"]["p99"]) / previous["latency_ms"]["p99"] * 100
+                changes.append(f"p99 {change:+.1f}%")
+            print(f"{'':<15}vs {baseline.get('revision') or 'baseline'}: {', '.join(changes)}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the file server under load on loopback.")
+    parser.add_argument("--clients", type=int, default=8, help="Simulated clients per workload")
+    parser.add_argument("--iterations", type=int, default=20, help="Operations per client per workload")
+    parser.add_argument("--workloads", nargs="+", choices=WORKLOADS, default=list(WORKLOADS))
+    parser.add_argument("--small-size", type=int, default=4 * 1024, help="Bytes per small file")
+    parser.add_argument("--large-size", type=int, default=8 * 1024 * 1024, help="Bytes per large file")
+    parser.add_argument("--catalog-size", type=int, default=10000, help="Files on the server for list_files")
+    parser.add_argument("--streams", type=int, default=1, help="Data channels per client")
+    parser.add_argument("--protocol", type=int, choices=(1, 2), default=2, help="Highest control protocol clients use")
+    parser.add_argument("--delta", action="store_true",
+                        help="Let re-uploads send only what changed (unchanged files then cost no transfer at all)")
+    parser.add_argument("--server-arg", action="append", default=[],
+                        help="Extra argument for server_engine.py (repeatable), e.g. --server-arg=--backend=dedup")
+    parser.add_argument("--output", default="benchmark.json", help="JSON file to write the results to")
+    parser.add_argument("--compare", help="Earlier result file to compare against")
+    args = parser.parse_args(argv)
+
+    work_dir = tempfile.mkdtemp(prefix="fileserver-bench-")
+    try:
+        storage_dir = os.path.join(work_dir, "storage")
+        os.makedirs(storage_dir)
+        results = {
+            "revision": git_revision(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "parameters": {key: value for key, value in vars(args).items() if key not in ("output", "compare")},
+            "workloads": {},
+        }
+        with BenchmarkServer(storage_dir, args.server_arg) as server:
+            benchmark = Benchmark(args, server, work_dir)
+            for name in args.workloads:
+                print(f"Running {name}...", file=sys.stderr)
+                results["workloads"][name] = benchmark.run(name)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    with open(args.output, "w", encoding="utf-8") as output:
+        json.dump(results, output, indent=2)
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as previous:
+            baseline = json.load(previous)
+    print_report(results, baseline)
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,270 @@
+"""In-memory index of the files in the server's storage directory.
+
+The catalog maps (owner, filename) to a FileEntry so [LIST_FILES], [DELETE]
+and [DOWNLOAD] never have to scan the storage directory.  It is updated as
+uploads and deletes complete and saved as a compact JSON manifest in
+<storage_dir>/.catalog/ on shutdown.  On startup the manifest is trusted only
+if the previous run shut down cleanly and nothing has been added to or
+removed from the storage directory (or its shard directories) since;
+otherwise the index is rebuilt from a single scan.
+
+Every change after loading gets the next sequence number and goes into a
+log of the last MAX_CHANGES changes, so clients following the catalog
+([SUBSCRIBE]) can be sent just what changed since the last change they
+saw.  Sequence numbers start over with each run of the server; the epoch, a
+random tag chosen at startup, tells a client whether the numbers it has are
+still meaningful.  In a cluster the master's catalog numbers every change
+and the workers' catalogs follow it (see follow()), so a client gets the
+same epoch and numbers whichever worker it is logged in on.
+"""
+import bisect
+import itertools
+import json
+import os
+import uuid
+from collections import deque, namedtuple
+from urllib.parse import unquote
+
+from compression import original_size
+
+CATALOG_DIR = ".catalog"
+MANIFEST_NAME = "manifest.json"
+DIRTY_MARKER = "dirty"
+MANIFEST_VERSION = 4
+MAX_CHANGES = 10000  # Changes kept for clients catching up; one that missed more lists the files again
+
+# path is relative to the storage directory; digest is the content hash when
+# the storage backend tracks one (see storage.py); version is a tag unique to
+# each upload of the file, set when it is added.
+FileEntry = namedtuple("FileEntry", "owner filename size mtime path digest version", defaults=(None, None))
+# kind is "added", "updated" or "removed"; size is None for removals.
+Change = namedtuple("Change", "sequence kind owner filename size")
+
+
+def file_version(entry):
+    """A tag that changes whenever a file is replaced: its digest if known, else its upload's version; clients cache downloads by it."""
+    return entry.digest or entry.version
+
+
+def quote_name(name, special=""):
+    """name with % and the characters in special written as %XX, so they can be told apart again."""
+    if "%" not in name and not any(char in name for char in special):
+        return name
+    return "".join(f"%{ord(char):02X}" if char == "%" or char in special else char for char in name)
+
+
+def stored_name(owner, filename):
+    """<owner>_<filename>; an _ in the owner is quoted, so the first _ always ends it."""
+    return f"{quote_name(owner, '_')}_{filename}"
+
+
+def valid_filename(filename):
+    """Whether filename can be stored as is: the flat layout and part files put it in a path unquoted."""
+    return filename not in ("", ".", "..") and not any(char in filename for char in "/\\\0")
+
+
+def split_stored_name(name):
+    """(owner, filename) back from a stored_name, or None if name isn't one."""
+    owner, separator, filename = name.partition("_")
+    if not separator or not owner or not filename:
+        return None
+    return unquote(owner), filename
+
+
+class Catalog:
+    def __init__(self, storage_dir, storage):
+        self.storage_dir = storage_dir
+        self.storage = storage  # Backend that knows where entries live on disk
+        self.catalog_dir = os.path.join(storage_dir, CATALOG_DIR)
+        self.manifest_path = os.path.join(self.catalog_dir, MANIFEST_NAME)
+        self.dirty_path = os.path.join(self.catalog_dir, DIRTY_MARKER)
+        self.entries = {}  # (owner, filename) -> FileEntry, in upload order
+        self.owners = {}  # filename -> set of owners, for lookups by name alone
+        self._listing = None  # Cached [LIST_FILES] lines
+        self._sorted = None  # (filename, owner) of every entry, sorted, once a page has been asked for
+        self.epoch = uuid.uuid4().hex[:8]
+        self.sequence = 0  # Of the latest change
+        self.changes = deque(maxlen=MAX_CHANGES)
+        self.numbering = True  # Number changes here, rather than take numbers from another catalog
+
+    # ------------------------------------------------------------------ queries
+
+    def get(self, owner, filename):
+        return self.entries.get((owner, filename))
+
+    def owners_of(self, filename):
+        return self.owners.get(filename, ())
+
+    def path_of(self, entry):
+        return os.path.join(self.storage_dir, entry.path)
+
+    def listing(self):
+        """Lines for [LIST_FILES], rebuilt only after the catalog changes."""
+        if self._listing is None:
+            self._listing = [f"{entry.filename} (Uploaded by {entry.owner})" for entry in self.entries.values()]
+        return self._listing
+
+    def page(self, prefix="", owner=None, after=None, limit=None):
+        """Entries in (filename, owner) order, as ([FileEntry], whether there are more).
+
+        Only files whose name starts with prefix (and, if given, uploaded by
+        owner) are included, starting after the (filename, owner) key after.
+        """
+        if self._sorted is None:
+            self._sorted = sorted((filename, entry_owner) for entry_owner, filename in self.entries)
+        keys = self._sorted
+        start = bisect.bisect_left(keys, (prefix,))
+        if after is not None:
+            start = max(start, bisect.bisect_right(keys, after))
+        entries = []
+        for index in range(start, len(keys)):
+            filename, entry_owner = keys[index]
+            if not filename.startswith(prefix):
+                break
+            if owner is not None and entry_owner != owner:
+                continue
+            if limit is not None and len(entries) == limit:
+                return entries, True
+            entries.append(self.entries[(entry_owner, filename)])
+        return entries, False
+
+    def changes_since(self, sequence):
+        """The changes after sequence, oldest first; None if the log no longer reaches back that far."""
+        oldest = self.changes[0].sequence if self.changes else self.sequence + 1
+        if not oldest - 1 <= sequence <= self.sequence:
+            return None
+        return list(itertools.islice(self.changes, sequence + 1 - oldest, None))
+
+    def misplaced(self):
+        """(owner, filename) of the entries whose file isn't where the storage layout now puts it."""
+        return [(entry.owner, entry.filename) for entry in self.entries.values()
+                if entry.path != self.storage.path_for(entry.owner, entry.filename)]
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(list(self.entries.values()))
+
+    # ------------------------------------------------------------------ updates
+
+    def add(self, owner, filename, size, mtime, path=None, digest=None, version=None):
+        # A fresh random version (rather than mtime and size) tells apart uploads within one mtime tick.
+        entry = FileEntry(owner, filename, size, mtime, path or stored_name(owner, filename), digest,
+                          version or uuid.uuid4().hex[:16])
+        replaced = self.entries.pop((owner, filename), None)  # Re-uploads move to the end, like a new file
+        self.entries[(owner, filename)] = entry
+        self.owners.setdefault(filename, set()).add(owner)
+        self._listing = None
+        if replaced is None and self._sorted is not None:
+            bisect.insort(self._sorted, (filename, owner))
+        self._record("updated" if replaced else "added", owner, filename, size)
+        return entry
+
+    def add_file(self, owner, filename, path=None, digest=None):
+        """Index a file that is already on disk, taking size and mtime from it."""
+        path = path or stored_name(owner, filename)
+        full_path = os.path.join(self.storage_dir, path)
+        # size is the content's, even if the file is kept compressed on disk.
+        return self.add(owner, filename, original_size(full_path), os.stat(full_path).st_mtime, path, digest)
+
+    def remove(self, owner, filename):
+        entry = self.entries.pop((owner, filename), None)
+        if entry is not None:
+            owners = self.owners[filename]
+            owners.discard(owner)
+            if not owners:
+                del self.owners[filename]
+            self._listing = None
+            if self._sorted is not None:
+                del self._sorted[bisect.bisect_left(self._sorted, (filename, owner))]
+            self._record("removed", owner, filename, None)
+        return entry
+
+    def relocate(self, owner, filename, path):
+        """Note that an entry's file was moved on disk. Its content didn't change, so this is no news to subscribers."""
+        entry = self.entries.get((owner, filename))
+        if entry is not None:
+            self.entries[(owner, filename)] = entry._replace(path=path)
+        return entry
+
+    def follow(self, epoch, sequence):
+        """Take the epoch and numbers of another catalog from here on; only changes given to record() are logged."""
+        self.epoch, self.sequence = epoch, sequence
+        self.numbering = False
+        self.changes.clear()
+
+    def record(self, sequence, kind, owner, filename, size):
+        """Log a change numbered by the catalog this one follows, in the order it numbered them."""
+        self.sequence = sequence
+        self.changes.append(Change(sequence, kind, owner, filename, size))
+
+    def _record(self, kind, owner, filename, size):
+        if not self.numbering:
+            return
+        self.sequence += 1
+        self.changes.append(Change(self.sequence, kind, owner, filename, size))
+
+    # ------------------------------------------------------------------ persistence
+
+    def load(self):
+        """Fill the index from the manifest, or from the directory if needed.
+
+        Returns True if the manifest could be used, False if the index had to
+        be rebuilt.  Either way the manifest is marked dirty until save().
+        """
+        os.makedirs(self.catalog_dir, exist_ok=True)
+        loaded = self._load_manifest()
+        if not loaded:
+            self.rebuild()
+        self.changes.clear()  # Loading isn't news to anyone; only changes from here on are followed
+        with open(self.dirty_path, "w"):
+            pass  # A crash before save() leaves this behind and forces a rebuild
+        return loaded
+
+    def _load_manifest(self):
+        if os.path.exists(self.dirty_path):
+            return False
+        try:
+            with open(self.manifest_path, "r", encoding="utf-8") as manifest:
+                data = json.load(manifest)
+        except (OSError, ValueError):
+            return False
+        if data.get("version") != MANIFEST_VERSION:
+            return False
+        if data.get("storage_state") != self.storage.state():
+            return False  # Files were added or removed behind our back
+        self.clear()
+        for fields in data["entries"]:
+            self.add(*fields)
+        return True
+
+    def rebuild(self):
+        """Re-index the storage directory from scratch."""
+        self.clear()
+        for owner, filename, path, stat, digest in self.storage.scan():
+            size = original_size(os.path.join(self.storage_dir, path))
+            self.add(owner, filename, size, stat.st_mtime, path, digest)
+
+    def save(self):
+        """Write the manifest atomically and mark it clean."""
+        os.makedirs(self.catalog_dir, exist_ok=True)
+        data = {
+            "version": MANIFEST_VERSION,
+            "storage_state": self.storage.state(),
+            "entries": [list(entry) for entry in self.entries.values()],
+        }
+        temp_path = self.manifest_path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as manifest:
+            json.dump(data, manifest, separators=(",", ":"))
+        os.replace(temp_path, self.manifest_path)
+        try:
+            os.remove(self.dirty_path)
+        except FileNotFoundError:
+            pass
+
+    def clear(self):
+        self.entries.clear()
+        self.owners.clear()
+        self._listing = None
+        self._sorted = None
@@ -0,0 +1,1282 @@
+"""Headless client for the file server: an importable library and a command-line tool.
+
+FileClient speaks the whole protocol over plain sockets and threads, without
+any Tkinter, so it can be scripted, run in CI or used from batch jobs:
+
+    with FileClient("127.0.0.1", 5555, "alice") as client:
+        result = client.upload("notes.txt", progress=lambda done, total: print(done, total))
+        print(result.ok, result.message)
+
+Every operation blocks until the server has answered and returns a result
+tuple instead of printing.  Progress callbacks are called from transfer
+threads with (bytes done, total bytes or None).  AsyncFileClient offers the
+same operations as coroutines, and ClientGUI (GUI_client.py) is a thin
+Tkinter layer on top of FileClient.
+
+Run this module directly for the command-line tool:
+
+    python client.py --port 5555 --user alice upload notes.txt report.pdf
+    python client.py --port 5555 --user bob download notes.txt --uploader alice --dir downloads
+    python client.py --port 5555 --user bob --cache-dir ~/.cache/file_client download notes.txt --uploader alice
+    python client.py --port 5555 --user bob list
+    python client.py --port 5555 --user bob watch
+    python client.py --port 5555 --user bob stats
+"""
+import argparse
+import asyncio
+import hashlib
+import itertools
+import json
+import os
+import queue
+import re
+import socket
+import sys
+import threading
+import time
+from collections import deque, namedtuple
+from contextlib import contextmanager
+
+from compression import DecompressingSink, choose_codec, compress_chunks, read_chunks, sample_compresses
+from delta import compute_delta, delta_chunks, delta_size
+from download_cache import DOWNLOAD_CACHE_SIZE, DownloadCache
+from protocol import (BATCH_FILE_HEADER, BATCH_MISSING, CONTROL_HEADER, FRAME_ABORT, FRAME_COMPRESSED, FRAME_DATA,
+                      FRAME_END, FRAME_HEADER, MAX_FRAME_PAYLOAD, PROTOCOL_VERSION, decode_control, decode_frame_header,
+                      encode_control, encode_frame_header, encode_message, format_batch, format_command, parse_batch,
+                      parse_command)
+
+CHUNK_SIZE = 256 * 1024  # Receive buffer size per transfer
+PART_SUFFIX = ".part"  # Downloads land here until complete, so they can be resumed
+PARALLEL_STREAMS = 4  # Data channels to open; large transfers are spread over all of them
+PARALLEL_THRESHOLD = 64 * 1024 * 1024  # Uploads at least this big are split into ranges
+RANGE_SIZE = 16 * 1024 * 1024  # Bytes per range of a parallel transfer
+DATA_CHANNEL_TIMEOUT = 5  # Seconds to wait for a server to offer a data channel before using ports
+ERROR_GRACE = 1  # Seconds to wait for the server's reason after a transfer is aborted
+DELTA_THRESHOLD = 1024 * 1024  # Re-uploads at least this big send only what changed, if the server can take it
+DELTA_MAX_LITERAL = 0.5  # ...unless more than this fraction of the file changed; then it is sent whole
+LIST_PAGE_SIZE = 1000  # Files per [LIST_FILES] page when listing with filters
+
+TransferResult = namedtuple("TransferResult", "filename ok message size elapsed")
+DeleteResult = namedtuple("DeleteResult", "filename ok message")
+BatchResult = namedtuple("BatchResult", "ok message statuses")  # statuses: [(filename, "OK" or "ERROR ...")]
+ListedFile = namedtuple("ListedFile", "filename owner")
+# position ("<epoch>:<sequence>") is where a later subscribe(since=...) picks up.
+ListPage = namedtuple("ListPage", "files more position")
+# kind is "added", "updated", "removed" or "reset" (changes were missed; list the files again).
+CatalogChange = namedtuple("CatalogChange", "kind filename owner size position")
+
+DELETE_ERRORS = ("[ERROR] You do not have permission to delete this file.", "[ERROR] File not found.",
+                 "[ERROR] Could not delete file.")
+BATCH_ERRORS = ("[ERROR] Batch transfers need a data channel.", "[ERROR] Malformed batch upload.",
+                "[ERROR] Malformed batch download.")
+DOWNLOAD_NOT_FOUND = "[ERROR]: File not found."
+
+
+class ClientError(Exception):
+    """Connecting or logging in failed, or the connection was lost mid-operation."""
+
+
+def reply_text(message):
+    """A server reply without its leading [TAG]s, e.g. "File 'a.txt' uploaded successfully."."""
+    return re.sub(r"^(\[[^\]|]*\])+:?\s*", "", message)
+
+
+def parse_listing(reply):
+    """The ListedFiles in a [LIST_FILES] reply."""
+    files = []
+    for line in reply.split("\n")[1:]:
+        filename, sep, owner = line.rpartition(" (Uploaded by ")
+        if sep:
+            files.append(ListedFile(filename, owner.rstrip(")")))
+    return files
+
+
+def parse_changes(message):
+    """The CatalogChanges in a [CATALOG] message."""
+    header, entries = parse_batch(message)
+    _, options = parse_command(header, 0)
+    epoch, last = options["epoch"], int(options["seq"])
+    if options.get("reset") == "1":
+        return [CatalogChange("reset", None, None, None, f"{epoch}:{last}")]
+    first = last - len(entries) + 1  # The changes of a message are numbered consecutively
+    return [CatalogChange(kind, filename, owner, int(size[0]) if size else None, f"{epoch}:{first + index}")
+            for index, (kind, filename, owner, *size) in enumerate(entries)]
+
+
+def file_digest(filepath):
+    digest = hashlib.sha256()
+    with open(filepath, "rb") as file:
+        while chunk := file.read(1024 * 1024):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def receive_exactly(connection_socket, size):
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        count = connection_socket.recv_into(view[received:])
+        if not count:
+            raise ConnectionError("Connection closed by server.")
+        received += count
+    return bytes(buffer)
+
+
+def receive_message(connection_socket):
+    message_length = int.from_bytes(receive_exactly(connection_socket, 4), byteorder="big")
+    return receive_exactly(connection_socket, message_length).decode()
+
+
+def receive_control(connection_socket):
+    """The next protocol 2 control message, as (request ID, message)."""
+    length, opcode, request_id = CONTROL_HEADER.unpack(receive_exactly(connection_socket, CONTROL_HEADER.size))
+    return request_id, decode_control(opcode, receive_exactly(connection_socket, length))
+
+
+def connect_tcp(host, port):
+    connection_socket = socket.create_connection((host, port))
+    connection_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # Commands are small; don't hold them back
+    return connection_socket
+
+
+class CacheCheck:
+    """Makes a download conditional on the copy in the download cache, and keeps what the server said about it."""
+
+    def __init__(self, cached):
+        self.cached = cached  # CachedFile, or None to just learn the version
+        self.version = None  # Of the file on the server, from the reply
+        self.not_modified = False  # The cached copy is still current; nothing was sent
+
+    def options(self):
+        if self.cached is None:
+            return {"if_version": "-"}  # Matches nothing, but gets the version into a port reply too
+        return {"if_version": self.cached.version, "if_sha256": self.cached.sha256}
+
+    def reply(self, options):
+        self.version = options.get("version")
+        self.not_modified = options.get("not_modified") == "1"
+        return self.not_modified
+
+
+class Progress:
+    """Adds up the bytes moved by one operation, possibly from several threads, and reports them."""
+
+    def __init__(self, callback=None, total=None, done=0):
+        self.callback = callback
+        self.total = total
+        self.done = done
+        self.lock = threading.Lock()
+
+    def add(self, count):
+        if self.callback is None:
+            return
+        with self.lock:
+            self.done += count
+            done, total = self.done, self.total
+        self.callback(done, total)
+
+    def counted(self, chunks):
+        """Pass chunks through, adding up their sizes."""
+        for chunk in chunks:
+            self.add(len(chunk))
+            yield chunk
+
+
+# ---------------------------------------------------------------------- sinks
+
+class FileSink:
+    """Writes the frames of one download stream to a local file.
+
+    Bytes go to <filepath>.part starting at offset; the part file is renamed
+    to filepath once the stream ends, or kept for a later resume if it breaks.
+    """
+
+    def __init__(self, filepath, offset=0, progress=None):
+        self.filepath = filepath
+        self.part_path = filepath + PART_SUFFIX
+        self.offset = offset
+        self.progress = progress or Progress()
+        self.file = None
+        self.completed = False
+        self.finished = threading.Event()
+
+    def open(self):
+        if self.offset:
+            self.file = open(self.part_path, "r+b")
+            self.file.seek(self.offset)
+        else:
+            self.file = open(self.part_path, "wb")
+
+    def write(self, data):
+        if self.file is None:
+            self.open()
+        self.file.write(data)
+        self.progress.add(len(data))
+
+    def finish(self, completed):
+        if self.file is None and completed:
+            self.open()  # Nothing left to receive
+        if self.file is not None:
+            self.file.close()
+            if completed:
+                os.replace(self.part_path, self.filepath)
+        self.completed = completed
+        self.finished.set()
+
+
+class RangeSink:
+    """Writes the frames of one range of a parallel download into place."""
+
+    def __init__(self, part_path, offset, progress=None):
+        self.part_path = part_path
+        self.offset = offset
+        self.progress = progress or Progress()
+        self.file = None
+        self.completed = False
+        self.finished = threading.Event()
+
+    def write(self, data):
+        if self.file is None:
+            self.file = open(self.part_path, "r+b")
+            self.file.seek(self.offset)
+        self.file.write(data)
+        self.progress.add(len(data))
+
+    def finish(self, completed):
+        if self.file is not None:
+            self.file.close()
+        self.completed = completed
+        self.finished.set()
+
+
+class BatchSink:
+    """Splits the stream of a batch download into its files.
+
+    Every file arrives as a BATCH_FILE_HEADER with its size followed by its
+    bytes, in the order requested; each is written to <name>.part and
+    renamed once complete.
+    """
+
+    def __init__(self, download_dir, filenames, progress=None):
+        self.download_dir = download_dir
+        self.filenames = filenames
+        self.progress = progress or Progress()
+        self.index = 0  # File the stream is at
+        self.header = b""  # Partial BATCH_FILE_HEADER
+        self.remaining = None  # Bytes left of the current file; None while reading its header
+        self.file = None
+        self.saved = []
+        self.completed = False
+        self.finished = threading.Event()
+
+    def write(self, data):
+        view = memoryview(data)
+        while view and self.index < len(self.filenames):
+            if self.remaining is None:
+                needed = BATCH_FILE_HEADER.size - len(self.header)
+                self.header += bytes(view[:needed])
+                view = view[needed:]
+                if len(self.header) < BATCH_FILE_HEADER.size:
+                    break
+                (size,), self.header = BATCH_FILE_HEADER.unpack(self.header), b""
+                if size == BATCH_MISSING:
+                    self.index += 1  # The server says why in its reply
+                    continue
+                self.remaining = size
+                self.file = open(self.part_path(), "wb")
+            count = min(len(view), self.remaining)
+            self.file.write(view[:count])
+            self.progress.add(count)
+            self.remaining -= count
+            view = view[count:]
+            if not self.remaining:
+                self.file.close()
+                self.file = None
+                os.replace(self.part_path(), self.part_path()[:-len(PART_SUFFIX)])
+                self.saved.append(self.filenames[self.index])
+                self.remaining = None
+                self.index += 1
+
+    def part_path(self):
+        return os.path.join(self.download_dir, self.filenames[self.index]) + PART_SUFFIX
+
+    def finish(self, completed):
+        if self.file is not None:
+            self.file.close()
+            os.remove(self.part_path())
+        self.completed = completed
+        self.finished.set()
+
+
+# ---------------------------------------------------------------------- connections
+
+class DataChannel:
+    """Client end of a long-lived data connection shared by all transfers."""
+
+    def __init__(self, server_ip, port, token, chunk_size=CHUNK_SIZE):
+        self.sock = connect_tcp(server_ip, port)
+        self.chunk_size = chunk_size
+        self.send_lock = threading.Lock()
+        self.sinks = {}  # stream id -> sink
+        self.sock.sendall(encode_message(format_command("ATTACH", token)))
+        reply = receive_message(self.sock)
+        if not reply.startswith("[ATTACHED]"):
+            self.sock.close()
+            raise ConnectionError(reply)
+        (self.channel_id,), _ = parse_command(reply, 1)
+        threading.Thread(target=self.read_frames, daemon=True).start()
+
+    def read_frames(self):
+        buffer = memoryview(bytearray(self.chunk_size))
+        try:
+            while True:
+                stream_id, flags, length = decode_frame_header(receive_exactly(self.sock, FRAME_HEADER.size))
+                sink = self.sinks.get(stream_id)
+                if sink is not None:
+                    write = sink.write_compressed if flags & FRAME_COMPRESSED else sink.write
+                while length:
+                    count = self.sock.recv_into(buffer[:min(length, len(buffer))])
+                    if not count:
+                        raise ConnectionError("Connection closed by server.")
+                    if sink is not None:
+                        write(buffer[:count])
+                    length -= count
+                if sink is not None and flags in (FRAME_END, FRAME_ABORT):
+                    del self.sinks[stream_id]
+                    sink.finish(flags == FRAME_END)
+        except (OSError, ConnectionError):
+            for stream_id in list(self.sinks):
+                self.sinks.pop(stream_id).finish(False)
+
+    def send_frame(self, stream_id, flags, payload=b""):
+        with self.send_lock:
+            self.sock.sendall(encode_frame_header(stream_id, flags, len(payload)) + payload)
+
+    def send_compressed(self, stream_id, chunks, codec):
+        for piece in compress_chunks(chunks, codec):
+            for start in range(0, len(piece), MAX_FRAME_PAYLOAD):
+                self.send_frame(stream_id, FRAME_DATA | FRAME_COMPRESSED, piece[start:start + MAX_FRAME_PAYLOAD])
+
+    def send_file_frame(self, stream_id, file, offset, length, filepath):
+        """Send length bytes of file from offset as one data frame.
+
+        Raises OSError if the file has got shorter; the frame is made up
+        with zeros first, so the channel stays in step and the caller can
+        abort the stream.
+        """
+        with self.send_lock:
+            self.sock.sendall(encode_frame_header(stream_id, FRAME_DATA, length))
+            sent = self.sock.sendfile(file, offset, length)
+            if sent < length:
+                self.sock.sendall(bytes(length - sent))
+        if sent < length:
+            raise OSError(f"{filepath} changed while it was being sent")
+
+    def send_file(self, stream_id, filepath, offset=0, count=None, codec=None, progress=None):
+        progress = progress or Progress()
+        try:
+            with open(filepath, "rb") as file:
+                if codec:
+                    self.send_compressed(stream_id, progress.counted(read_chunks(file, offset, count)), codec)
+                else:
+                    end = os.fstat(file.fileno()).st_size if count is None else offset + count
+                    for offset in range(offset, end, MAX_FRAME_PAYLOAD):
+                        length = min(MAX_FRAME_PAYLOAD, end - offset)
+                        self.send_file_frame(stream_id, file, offset, length, filepath)
+                        progress.add(length)
+        except OSError:
+            self.send_frame(stream_id, FRAME_ABORT)
+            raise
+        self.send_frame(stream_id, FRAME_END)
+
+    def send_chunks(self, stream_id, chunks, codec=None, progress=None):
+        """Send chunks of bytes as one stream."""
+        progress = progress or Progress()
+        try:
+            if codec:
+                self.send_compressed(stream_id, progress.counted(chunks), codec)
+            else:
+                for chunk in progress.counted(chunks):
+                    for start in range(0, len(chunk), MAX_FRAME_PAYLOAD):
+                        self.send_frame(stream_id, FRAME_DATA, chunk[start:start + MAX_FRAME_PAYLOAD])
+        except OSError:
+            self.send_frame(stream_id, FRAME_ABORT)
+            raise
+        self.send_frame(stream_id, FRAME_END)
+
+    def send_files(self, stream_id, files, codec=None, progress=None):
+        """Send (filepath, size) pairs back to back as one stream, for a batch upload."""
+        progress = progress or Progress()
+        try:
+            if codec:
+                chunks = itertools.chain.from_iterable(self.read_exactly(filepath, size) for filepath, size in files)
+                self.send_compressed(stream_id, progress.counted(chunks), codec)
+            else:
+                for filepath, size in files:
+                    with open(filepath, "rb") as file:
+                        for offset in range(0, size, MAX_FRAME_PAYLOAD):
+                            length = min(MAX_FRAME_PAYLOAD, size - offset)
+                            self.send_file_frame(stream_id, file, offset, length, filepath)
+                            progress.add(length)
+        except OSError:
+            self.send_frame(stream_id, FRAME_ABORT)
+            raise
+        self.send_frame(stream_id, FRAME_END)
+
+    @staticmethod
+    def read_exactly(filepath, size):
+        """Yield the first size bytes of filepath; the batch stream only works if they are all there."""
+        with open(filepath, "rb") as file:
+            for chunk in read_chunks(file, 0, size):
+                size -= len(chunk)
+                yield chunk
+        if size:
+            raise OSError(f"{filepath} changed while it was being sent")
+
+    def close(self):
+        self.sock.close()
+
+
+class ReplyWaiter:
+    """Collects the control messages that answer one operation.
+
+    The waiter stops taking messages once it has been given one for which
+    last(message) is true, so a reply that matches several operations in
+    progress goes to one that is still waiting for it.
+    """
+
+    def __init__(self, match, last=None, request_id=0):
+        self.match = match
+        self.request_id = request_id  # Protocol 2 only
+        self.last = last or (lambda message: True)
+        self.closed = False
+        self.messages = queue.Queue()
+
+    def offer(self, message):
+        """Take message if it answers this operation. Called by the listener only."""
+        if self.closed or not self.match(message):
+            return False
+        self.closed = self.last(message)
+        self.messages.put(message)
+        return True
+
+    def get(self, timeout=None):
+        """The next matching message; raises ClientError if the connection is gone."""
+        message = self.messages.get(timeout=timeout)
+        if message is None:
+            raise ClientError("Connection closed by server.")
+        return message
+
+    def get_within(self, timeout, default=None):
+        try:
+            return self.get(timeout)
+        except queue.Empty:
+            return default
+
+
+# ---------------------------------------------------------------------- client
+
+class FileClient:
+    """A connection to the file server, usable from any thread.
+
+    on_event is called (from the listener thread) with every control message
+    that doesn't answer one of our own requests, e.g. download notifications;
+    catalog changes go to the callback given to subscribe() instead.
+    protocol=1 keeps the control connection on the text framing even if the
+    server speaks protocol 2.  delta=False always sends re-uploads whole.
+    cache, a DownloadCache, keeps downloaded files so downloading one again
+    only fetches it if it changed.
+    """
+
+    def __init__(self, host, port, username, streams=PARALLEL_STREAMS, range_size=RANGE_SIZE,
+                 parallel_threshold=PARALLEL_THRESHOLD, on_event=None, protocol=PROTOCOL_VERSION, delta=True,
+                 cache=None):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.streams = streams
+        self.range_size = range_size
+        self.parallel_threshold = parallel_threshold
+        self.on_event = on_event or (lambda message: None)
+        self.max_protocol = protocol
+        self.protocol = 1  # Control message framing in use; see protocol.py
+        self.request_ids = itertools.count(1)
+        self.client_socket = None
+        self.connected = False
+        self.send_lock = threading.Lock()  # Transfer threads share the control socket
+        self.data_channel = None  # Shared data connection, if the server offers one
+        self.data_channels = []  # All data connections, for parallel transfers
+        self.stream_ids = itertools.count(1)
+        self.dedup = False  # Server stores content once and can skip uploads it already has
+        self.codec = None  # Compression both sides support, for data channel transfers
+        self.use_delta = delta
+        self.cache = cache
+        self.delta = False  # Server can rebuild a re-upload from the changes alone
+        self.feed = False  # Server can page through listings and push catalog changes
+        self.on_change = None  # Callback for catalog changes, once subscribed
+        self.waiters = []  # ReplyWaiters of operations in progress, oldest first
+        self.waiters_lock = threading.Lock()
+        self.interrupted_uploads = {}  # local path -> (size, mtime) of uploads that broke off
+
+    # ------------------------------------------------------------------ connection
+
+    def connect(self):
+        """Connect, log in and open data channels. Raises ClientError on failure."""
+        try:
+            self.client_socket = connect_tcp(self.host, self.port)
+            self.client_socket.sendall(encode_message(self.username))
+            response = receive_message(self.client_socket)
+        except (OSError, ConnectionError) as e:
+            self.close()
+            raise ClientError(f"Unable to connect to server: {e}") from e
+        if not response.startswith("[AUTHENTICATED]"):
+            self.close()
+            raise ClientError(reply_text(response))
+        self.connected = True
+        threading.Thread(target=self.listener, daemon=True).start()
+
+        # Servers that support it answer with a token for shared data channels;
+        # older ones ignore the request and every transfer gets its own port.
+        with self.expect(lambda message: message.startswith("[DATA_CHANNEL]"), "[DATA_CHANNEL]") as waiter:
+            response = waiter.get_within(DATA_CHANNEL_TIMEOUT)
+        if response:
+            (token,), options = parse_command(response, 1)
+            self.dedup = options.get("dedup") == "1"
+            self.delta = self.use_delta and options.get("delta") == "1"
+            self.feed = options.get("feed") == "1"
+            self.codec = choose_codec(options.get("compress", "").split(","))
+            version = min(int(options.get("protocol", 1)), self.max_protocol)
+            if version > 1:
+                with self.expect(lambda message: message.startswith("[PROTOCOL]"), format_command("PROTOCOL", version)) as waiter:
+                    waiter.get_within(DATA_CHANNEL_TIMEOUT)  # The listener switches framing when the answer arrives
+            try:
+                for _ in range(max(1, self.streams)):
+                    self.data_channels.append(DataChannel(self.host, self.port, token, CHUNK_SIZE))
+            except (OSError, ConnectionError) as e:
+                self.on_event(f"[DATA CHANNEL] Opened {len(self.data_channels)} of {self.streams} data channels: {e}")
+            self.data_channel = self.data_channels[0] if self.data_channels else None
+        return self
+
+    def close(self):
+        if self.connected:
+            try:
+                self.send_message("[DISCONNECT]")
+            except OSError:
+                pass
+        self.connected = False
+        for channel in self.data_channels:
+            channel.close()
+        self.data_channels = []
+        self.data_channel = None
+        if self.client_socket is not None:
+            self.client_socket.close()
+            self.client_socket = None
+
+    def __enter__(self):
+        return self.connect()
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def encode(self, message, request_id=0):
+        return encode_message(message) if self.protocol == 1 else encode_control(message, request_id)
+
+    def send_message(self, message):
+        with self.send_lock:
+            self.client_socket.sendall(self.encode(message))
+
+    @contextmanager
+    def expect(self, match, request, last=None):
+        """Send request and route the control messages that match it to a ReplyWaiter while in the block.
+
+        Waiters are offered each message oldest first, and registering and
+        sending happen under one lock, so replies that only the order tells
+        apart (e.g. "[ERROR] File not found.") reach the right operation.
+        Under protocol 2 the request gets an ID and only replies carrying it
+        are offered to the waiter.
+        """
+        with self.send_lock:
+            waiter = ReplyWaiter(match, last, next(self.request_ids) if self.protocol > 1 else 0)
+            with self.waiters_lock:
+                self.waiters.append(waiter)
+                if not self.connected:
+                    waiter.messages.put(None)
+            if self.connected:
+                try:
+                    self.client_socket.sendall(self.encode(request, waiter.request_id))
+                except OSError:
+                    pass  # The listener notices the broken connection and wakes every waiter
+        try:
+            yield waiter
+        finally:
+            with self.waiters_lock:
+                self.waiters.remove(waiter)
+
+    def listener(self):
+        while self.connected:
+            try:
+                if self.protocol == 1:
+                    request_id, message = 0, receive_message(self.client_socket)
+                    if message.startswith("[PROTOCOL]|["):
+                        # The server's last text-framed message; switch before anything else is read or sent.
+                        (version,), _ = parse_command(message, 1)
+                        self.protocol = int(version)
+                else:
+                    request_id, message = receive_control(self.client_socket)
+            except (OSError, ConnectionError, ValueError):
+                break
+            with self.waiters_lock:
+                waiters = [waiter for waiter in self.waiters if waiter.request_id == request_id] if request_id else self.waiters
+                taken = any(waiter.offer(message) for waiter in waiters)
+            if taken:
+                pass
+            elif message.startswith("[CATALOG]") and self.on_change is not None:
+                for change in parse_changes(message):
+                    self.on_change(change)
+            else:
+                self.on_event(message)
+        if self.connected:
+            self.connected = False
+            self.on_event("[DISCONNECTED] Connection closed by server.")
+        with self.waiters_lock:
+            for waiter in self.waiters:
+                waiter.messages.put(None)
+
+    def require_connection(self):
+        if not self.connected:
+            raise ClientError("Not connected to server.")
+
+    # ------------------------------------------------------------------ uploads
+
+    def upload_codec(self, filepath):
+        """Codec to ask for when uploading filepath, or None if it doesn't compress."""
+        if not self.codec:
+            return None
+        with open(filepath, "rb") as file:
+            return self.codec if sample_compresses(file, 0, self.codec) else None
+
+    def upload(self, filepath, progress=None):
+        """Upload one file. Resumes an earlier upload of it that broke off, if it hasn't changed."""
+        self.require_connection()
+        started = time.monotonic()
+        stat = os.stat(filepath)
+        filesize = stat.st_size
+        filename = os.path.basename(filepath)
+        # Pick up where a broken upload of this same, unchanged file stopped.
+        resume = 1 if self.interrupted_uploads.get(filepath) == (stat.st_size, stat.st_mtime) else None
+        source = f"{stat.st_size}-{stat.st_mtime_ns}"  # Which version of the file the server's part file holds
+        result = None
+        if self.delta and self.data_channel and filesize >= DELTA_THRESHOLD and not resume:
+            result = self.upload_delta(filepath, filename, filesize, progress)
+        progress = Progress(progress, filesize)
+        if result is not None:
+            ok, message = result
+        elif len(self.data_channels) > 1 and filesize >= self.parallel_threshold and not resume:
+            ok, message = self.upload_parallel(filepath, filename, filesize, progress, source)
+        else:
+            digest = file_digest(filepath) if self.dedup and not resume else None
+            ok, message = self.upload_stream(self.data_channel, filepath, filename, filesize, progress,
+                                             resume=resume, digest=digest, source=source)
+        if ok:
+            self.interrupted_uploads.pop(filepath, None)
+        else:
+            self.interrupted_uploads[filepath] = (stat.st_size, stat.st_mtime)
+        return TransferResult(filename, ok, message, filesize, time.monotonic() - started)
+
+    def upload_delta(self, filepath, filename, filesize, progress=None):
+        """Upload only what changed since the server's copy of the file (see delta.py).
+
+        Returns (ok, message), or None if the server has no copy to build on,
+        the file changed too much, or the changes didn't apply; the caller
+        then sends the file whole.
+        """
+        digest = file_digest(filepath)
+        match = lambda message: message.startswith(format_command("SIGNATURES", filename))
+        with self.expect(match, format_command("SIGNATURES", filename, sha256=digest)) as waiter:
+            reply = waiter.get()
+        header, entries = parse_batch(reply)
+        _, options = parse_command(header, 1)
+        if options.get("unchanged") == "1":
+            Progress(progress, filesize).add(filesize)
+            return True, f"File '{filename}' is unchanged on the server; nothing to send."
+        if "block" not in options:
+            return None
+        block_size = int(options["block"])
+        signatures = [(int(weak, 16), bytes.fromhex(strong)) for weak, strong in entries]
+        ops = compute_delta(filepath, signatures, block_size, int(options["size"]), filesize * DELTA_MAX_LITERAL)
+        if ops is None:
+            return None
+        ok, message = self.upload_stream(self.data_channel, filepath, filename, filesize, Progress(progress, delta_size(ops)),
+                                         digest=digest, delta=(ops, block_size))
+        return (ok, message) if ok else None
+
+    def upload_stream(self, channel, filepath, filename, filesize, progress, offset=None, length=None,
+                      resume=None, digest=None, codec=None, delta=None, source=None):
+        """Upload a file, or one byte range of it, over channel (or a data port if None). Returns (ok, message).
+
+        delta=(ops, block size) sends those changes against the server's copy instead (channel only).
+        """
+        if channel is not None and codec is None and offset is None:
+            codec = self.upload_codec(filepath)
+        stream_id = next(self.stream_ids) if channel else None
+        ranged = offset is not None
+
+        def match(message):
+            if message.startswith("[UPLOAD]|["):
+                (key, name), _ = parse_command(message, 2)
+                return key == f"stream={stream_id}" if channel else name == filename and not key.startswith("stream=")
+            if f"'{filename}'" not in message:
+                return False
+            if message.startswith("[UPLOAD][SERVER RESPONSE] Received bytes"):
+                return ranged and f"bytes {offset}-{offset + length} of" in message
+            return message.startswith(("[UPLOAD][SERVER RESPONSE]", "[ERROR] Upload of", "[ERROR] Invalid byte range for"))
+
+        if channel:
+            command = format_command("UPLOAD", filename, filesize, stream=stream_id, channel=channel.channel_id,
+                                     resume=resume, sha256=digest, offset=offset, length=length, compress=codec,
+                                     delta=delta and delta_size(delta[0]), block=delta and delta[1], source=source)
+        else:
+            command = format_command("UPLOAD", filename, filesize, resume=resume, sha256=digest, offset=offset, length=length,
+                                     source=source)
+        with self.expect(match, command, last=lambda message: not message.startswith("[UPLOAD]|[")) as waiter:
+            reply = waiter.get()
+            if not reply.startswith("[UPLOAD]|["):
+                return False, reply_text(reply)
+            (key, _), options = parse_command(reply, 2)
+            if options.get("stored") != "1":  # Otherwise the server already had the content
+                send_offset = int(options.get("offset", 0))
+                send_length = int(options["length"]) if "length" in options else None
+                progress.add(send_offset if not ranged else 0)  # Bytes a resumed upload skips
+                try:
+                    if delta:
+                        channel.send_chunks(stream_id, delta_chunks(filepath, delta[0]), options.get("compress"), progress)
+                    elif channel:
+                        channel.send_file(stream_id, filepath, send_offset, send_length, options.get("compress"), progress)
+                    else:
+                        self.send_to_port(int(key), filepath, send_offset, send_length, progress)
+                except OSError as e:
+                    return False, str(e)
+            reply = waiter.get()
+        return reply.startswith("[UPLOAD][SERVER RESPONSE]"), reply_text(reply)
+
+    def send_to_port(self, port, filepath, offset, length, progress):
+        with socket.create_connection((self.host, port)) as data_socket:
+            with open(filepath, "rb") as file:
+                sent = data_socket.sendfile(file, offset, length)
+        progress.add(sent)
+
+    def upload_parallel(self, filepath, filename, filesize, progress, source=None):
+        """Send one file as byte ranges spread over all data channels. Returns (ok, message).
+
+        Each channel carries one range at a time and takes the next as soon as
+        the server has it; the server assembles the file once all ranges are in.
+        Every range carries the file's sha256, which the server checks before
+        committing, so ranges of two versions of a file that changed meanwhile
+        are never put together; a change seen between ranges stops the upload.
+        """
+        ranges = deque((offset, min(self.range_size, filesize - offset)) for offset in range(0, filesize, self.range_size))
+        codec = self.upload_codec(filepath)
+        digest = file_digest(filepath)
+        lock = threading.Lock()
+        errors, replies = [], []
+
+        def send_ranges(channel):
+            while True:
+                with lock:
+                    if errors or not ranges:
+                        return
+                    offset, length = ranges.popleft()
+                stat = os.stat(filepath)
+                if source and f"{stat.st_size}-{stat.st_mtime_ns}" != source:
+                    ok, message = False, f"'{filename}' changed while it was being uploaded. Upload it again."
+                else:
+                    try:
+                        ok, message = self.upload_stream(channel, filepath, filename, filesize, progress, offset=offset,
+                                                         length=length, digest=digest, codec=codec, source=source)
+                    except ClientError as e:
+                        ok, message = False, str(e)
+                with lock:
+                    (replies if ok else errors).append(message)
+
+        self.on_event(f"[UPLOADING] Sending {filename} in {len(ranges)} ranges over {len(self.data_channels)} streams...")
+        workers = [threading.Thread(target=send_ranges, args=(channel,), daemon=True) for channel in self.data_channels]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        if errors:
+            return False, errors[0]
+        return True, next((reply for reply in replies if "uploaded successfully" in reply), replies[-1])
+
+    def upload_many(self, filepaths, progress=None):
+        """Upload several files with one request and one stream."""
+        self.require_connection()
+        if not self.data_channel:
+            return BatchResult(False, "Uploading several files at once needs a data channel.", [])
+        files = [(filepath, os.path.getsize(filepath)) for filepath in filepaths]
+        progress = Progress(progress, sum(size for _, size in files))
+        stream_id = next(self.stream_ids)
+        tag = f"[stream={stream_id}]"
+        match = lambda message: (message.startswith(("[BATCH_UPLOAD]|" + tag, "[BATCH_UPLOAD][SERVER RESPONSE]",
+                                                     "[BATCH_UPLOAD][ERROR]"))
+                                 and tag in message.split("\n", 1)[0]) or message in BATCH_ERRORS
+        command = format_command("BATCH_UPLOAD", stream=stream_id, channel=self.data_channel.channel_id,
+                                 compress=self.upload_codec(filepaths[0]))
+        request = format_batch(command, [(os.path.basename(filepath), size) for filepath, size in files])
+        with self.expect(match, request, last=lambda message: not message.startswith("[BATCH_UPLOAD]|")) as waiter:
+            reply = waiter.get()
+            if not reply.startswith("[BATCH_UPLOAD]|"):
+                return self.batch_result(reply)
+            _, options = parse_command(reply, 2)
+            try:
+                self.data_channel.send_files(stream_id, files, options.get("compress"), progress)
+            except OSError as e:
+                return BatchResult(False, str(e), [])
+            return self.batch_result(waiter.get())
+
+    @staticmethod
+    def batch_result(reply):
+        """The BatchResult a batch's final reply (or an error in its place) stands for."""
+        if reply in BATCH_ERRORS:
+            return BatchResult(False, reply_text(reply), [])
+        header, statuses = parse_batch(reply)
+        (summary,), _ = parse_command(header, 1)
+        if header.startswith(("[BATCH_UPLOAD][ERROR]", "[BATCH_DOWNLOAD][ERROR]")):
+            return BatchResult(False, summary, [])
+        statuses = [tuple(entry[:2]) for entry in statuses]
+        return BatchResult(all(status == "OK" for _, status in statuses), summary, statuses)
+
+    # ------------------------------------------------------------------ downloads
+
+    def download_sink(self, sink):
+        """Let sink take a compressed stream if the server decides to send one."""
+        return DecompressingSink(sink, self.codec) if self.codec else sink
+
+    def download(self, filename, uploader, download_dir=".", progress=None):
+        """Download one file into download_dir, resuming from a .part file left by an earlier attempt.
+
+        With a download cache, a file that hasn't changed since it was last
+        downloaded is copied out of the cache instead.
+        """
+        self.require_connection()
+        started = time.monotonic()
+        # A leftover .part file means an earlier download broke off; continue it.
+        filepath = os.path.join(download_dir, filename)
+        offset = os.path.getsize(filepath + PART_SUFFIX) if os.path.exists(filepath + PART_SUFFIX) else 0
+        progress = Progress(progress, done=offset)
+        server = f"{self.host}:{self.port}"
+        check = CacheCheck(self.cache.get(server, uploader, filename)) if self.cache is not None and not offset else None
+        if len(self.data_channels) > 1 and not offset:
+            ok, size, message = self.download_parallel(filename, uploader, filepath, progress, check)
+        elif self.data_channel:
+            ok, size, message = self.download_stream(self.data_channel, filename, uploader,
+                                                     FileSink(filepath, offset, progress), progress, offset or None,
+                                                     check=check)
+        else:
+            ok, size, message = self.download_from_port(filename, uploader, filepath, offset, progress, check)
+        if ok and check is not None and check.not_modified:
+            if not self.cache.restore(server, uploader, filename, check.cached, filepath):
+                return self.download(filename, uploader, download_dir, progress.callback)  # Gone from the cache; fetch it
+            progress.total = size
+            progress.add(size)
+            message = f"File saved as '{filepath}' (unchanged, from the download cache)."
+        elif ok:
+            if check is not None and check.version:
+                try:
+                    self.cache.store(server, uploader, filename, check.version, filepath)
+                except OSError as e:
+                    self.on_event(f"[CACHE] Could not cache {filename}: {e}")
+            message = f"File saved as '{filepath}'."
+        return TransferResult(filename, ok, message, size, time.monotonic() - started)
+
+    def download_stream(self, channel, filename, uploader, sink, progress, offset=None, length=None, check=None,
+                        if_match=None):
+        """Download a file, or one byte range of it, into sink. Returns (ok, file size, message).
+
+        check, a CacheCheck, makes the download conditional on a cached copy;
+        if_match, a version from an earlier reply, on the file still being it.
+        """
+        stream_id = next(self.stream_ids)
+        match = lambda message: message.startswith(f"[DOWNLOAD]|[stream={stream_id}]") or message == DOWNLOAD_NOT_FOUND or (
+            message.startswith("[ERROR] Invalid byte range for") and f"'{filename}'" in message)
+        channel.sinks[stream_id] = self.download_sink(sink)
+        command = format_command("DOWNLOAD", filename, uploader, stream=stream_id, channel=channel.channel_id,
+                                 offset=offset, length=length, compress=self.codec, if_match=if_match,
+                                 **(check.options() if check else {}))
+        with self.expect(match, command) as waiter:
+            reply = waiter.get()
+        if not reply.startswith("[DOWNLOAD]|"):
+            channel.sinks.pop(stream_id, None)
+            return False, None, reply_text(reply)
+        _, options = parse_command(reply, 2)
+        if options.get("changed") == "1":
+            channel.sinks.pop(stream_id, None)
+            return False, None, f"'{filename}' changed on the server during the download. Download it again."
+        if check is not None and check.reply(options):
+            channel.sinks.pop(stream_id, None)
+            return True, check.cached.size, "Not modified."
+        size = int(options["size"])
+        progress.total = size
+        sink.finished.wait()
+        if sink.completed:
+            return True, size, "Downloaded."
+        return False, size, "Download was interrupted. Download it again to resume."
+
+    def download_parallel(self, filename, uploader, filepath, progress, check=None):
+        """Fetch one file as byte ranges spread over all data channels. Returns (ok, size, message).
+
+        The first range's reply tells us the file size and version; the rest
+        are then handed out to the channels as they free up, each only to be
+        sent if the file is still that version, and written into a shared
+        part file.
+        """
+        part_path = filepath + PART_SUFFIX
+        with open(part_path, "wb"):
+            pass
+        first = check or CacheCheck(None)  # Either way the reply says which version the first range came from
+        ok, size, message = self.download_stream(self.data_channels[0], filename, uploader,
+                                                 RangeSink(part_path, 0, progress), progress, 0, self.range_size, first)
+        if check is not None and check.not_modified:
+            os.remove(part_path)
+            return ok, size, message
+        if ok and size > self.range_size:
+            with open(part_path, "r+b") as part:
+                part.truncate(size)
+            ranges = deque((offset, min(self.range_size, size - offset)) for offset in range(self.range_size, size, self.range_size))
+            lock = threading.Lock()
+            errors = []
+
+            def fetch_ranges(channel):
+                while True:
+                    with lock:
+                        if errors or not ranges:
+                            return
+                        offset, length = ranges.popleft()
+                    try:
+                        range_ok, _, range_message = self.download_stream(channel, filename, uploader,
+                                                                          RangeSink(part_path, offset, progress),
+                                                                          progress, offset, length, if_match=first.version)
+                    except ClientError as e:
+                        range_ok, range_message = False, str(e)
+                    if not range_ok:
+                        with lock:
+                            errors.append(range_message)
+
+            workers = [threading.Thread(target=fetch_ranges, args=(channel,), daemon=True) for channel in self.data_channels]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            if errors:
+                ok, message = False, errors[0]
+        if ok:
+            os.replace(part_path, filepath)
+        else:
+            os.remove(part_path)
+        return ok, size, message
+
+    def download_from_port(self, filename, uploader, filepath, offset, progress, check=None):
+        """Download over a data port opened for this transfer (servers without data channels)."""
+        def match(message):
+            if message.startswith("[DOWNLOAD]|["):
+                (key, name), _ = parse_command(message, 2)
+                return name == filename and not key.startswith("stream=")
+            return message == DOWNLOAD_NOT_FOUND
+
+        command = format_command("DOWNLOAD", filename, uploader, offset=offset or None, **(check.options() if check else {}))
+        # After the port, the server may still say why the transfer failed.
+        with self.expect(match, command, last=lambda message: not message.startswith("[DOWNLOAD]|[")) as waiter:
+            reply = waiter.get()
+            if not reply.startswith("[DOWNLOAD]|"):
+                return False, None, reply_text(reply)
+            (port, _), options = parse_command(reply, 2)
+            if check is not None and check.reply(options):
+                return True, check.cached.size, "Not modified."
+            try:
+                with socket.create_connection((self.host, int(port))) as data_socket:
+                    count = int(receive_message(data_socket).strip("[] "))
+                    progress.total = offset + count
+                    with open(filepath + PART_SUFFIX, "r+b" if offset else "wb") as file:
+                        file.seek(offset)
+                        buffer = memoryview(bytearray(min(CHUNK_SIZE, max(count, 1))))
+                        bytes_received = 0
+                        while bytes_received < count:
+                            received = data_socket.recv_into(buffer[:min(len(buffer), count - bytes_received)])
+                            if not received:
+                                break
+                            file.write(buffer[:received])
+                            bytes_received += received
+                            progress.add(received)
+            except (OSError, ConnectionError, ValueError) as e:
+                # The server closes the data port first and then says why on the control connection.
+                reply = waiter.get_within(ERROR_GRACE)
+                return False, None, reply_text(reply) if reply else f"Download failed: {e}"
+        if bytes_received < count:
+            return False, offset + count, "Download was interrupted. Download it again to resume."
+        os.replace(filepath + PART_SUFFIX, filepath)
+        return True, offset + count, "Downloaded."
+
+    def download_many(self, filenames, uploader, download_dir=".", progress=None):
+        """Download several files of one uploader with one request and one stream."""
+        self.require_connection()
+        if not self.data_channel:
+            return BatchResult(False, "Downloading several files at once needs a data channel.", [])
+        stream_id = next(self.stream_ids)
+        tag = f"[stream={stream_id}]"
+        sink = BatchSink(download_dir, filenames, Progress(progress))
+        match = lambda message: (message.startswith(("[BATCH_DOWNLOAD]|" + tag, "[BATCH_DOWNLOAD][SERVER RESPONSE]",
+                                                     "[BATCH_DOWNLOAD][ERROR]"))
+                                 and tag in message.split("\n", 1)[0]) or message in BATCH_ERRORS
+        self.data_channel.sinks[stream_id] = self.download_sink(sink)
+        command = format_command("BATCH_DOWNLOAD", stream=stream_id, channel=self.data_channel.channel_id, compress=self.codec)
+        request = format_batch(command, [(filename, uploader) for filename in filenames])
+        with self.expect(match, request, last=lambda message: not message.startswith("[BATCH_DOWNLOAD]|")) as waiter:
+            reply = waiter.get()
+            if not reply.startswith("[BATCH_DOWNLOAD]|"):
+                self.data_channel.sinks.pop(stream_id, None)
+                return self.batch_result(reply)
+            sink.finished.wait()
+            if not sink.completed:
+                saved = set(sink.saved)
+                return BatchResult(False, "Batch download was interrupted.",
+                                   [(filename, "OK" if filename in saved else "ERROR Interrupted") for filename in filenames])
+            return self.batch_result(waiter.get())
+
+    # ------------------------------------------------------------------ other commands
+
+    def list_files(self, prefix=None, owner=None):
+        """The files on the server, as ListedFile(filename, owner) tuples.
+
+        prefix and owner keep only the files whose name starts with prefix
+        and that owner uploaded; the server does the filtering if it can.
+        """
+        self.require_connection()
+        if (prefix or owner) and self.feed:
+            files, after = [], None
+            while True:
+                page = self.list_page(prefix, owner, after)
+                files.extend(page.files)
+                if not page.more:
+                    return files
+                after = page.files[-1]
+        with self.expect(lambda message: message.startswith("[LIST_FILES]\n"), "[LIST_FILES]") as waiter:
+            reply = waiter.get()
+        return [listed for listed in parse_listing(reply)
+                if listed.filename.startswith(prefix or "") and owner in (None, listed.owner)]
+
+    def list_page(self, prefix=None, owner=None, after=None, limit=LIST_PAGE_SIZE):
+        """One page of the files on the server in (filename, owner) order, starting after the ListedFile after.
+
+        Returns ListPage(files, more, position); subscribe(since=position)
+        then reports every change made since the page was taken.
+        """
+        self.require_connection()
+        if not self.feed:
+            raise ClientError("The server can't page through the file list.")
+        request = format_command("LIST_FILES", prefix=prefix or None, owner=owner, limit=limit,
+                                 after=after and after.filename, after_owner=after and after.owner)
+        with self.expect(lambda message: message.startswith("[LIST_FILES]|"), request) as waiter:
+            reply = waiter.get()
+        _, options = parse_command(reply.split("\n", 1)[0], 0)
+        return ListPage(parse_listing(reply), options.get("more") == "1", f"{options['epoch']}:{options['seq']}")
+
+    def subscribe(self, on_change, since=None):
+        """Have on_change(CatalogChange) called, from the listener thread, for every change to the catalog.
+
+        since is the position of an earlier change or ListPage to pick up
+        after, e.g. after reconnecting.  Returns False if the server no
+        longer knows what changed since then; list the files again.
+        """
+        self.require_connection()
+        if not self.feed:
+            raise ClientError("The server can't send catalog changes.")
+        epoch, _, sequence = since.partition(":") if since else (None, None, None)
+        self.on_change = on_change
+        with self.expect(lambda message: message.startswith("[SUBSCRIBE]"),
+                         format_command("SUBSCRIBE", epoch=epoch, seq=sequence)) as waiter:
+            reply = waiter.get()
+        _, options = parse_command(reply, 0)
+        return options.get("reset") != "1"
+
+    def stats(self):
+        """The server's metrics summary (see metrics.py) as a dict."""
+        self.require_connection()
+        with self.expect(lambda message: message.startswith("[STATS]"), "[STATS]") as waiter:
+            reply = waiter.get()
+        return json.loads(reply.split("\n", 1)[1])
+
+    def delete(self, filename):
+        """Delete one of our own files."""
+        self.require_connection()
+        match = lambda message: message.startswith(f"[DELETE] File '{filename}'") or message in DELETE_ERRORS
+        with self.expect(match, format_command("DELETE", filename)) as waiter:
+            reply = waiter.get()
+        return DeleteResult(filename, reply.startswith("[DELETE]"), reply_text(reply))
+
+    def delete_many(self, filenames):
+        """Delete several of our own files with one request."""
+        self.require_connection()
+        request = format_batch("[BATCH_DELETE]", [(filename,) for filename in filenames])
+        with self.expect(lambda message: message.startswith("[BATCH_DELETE]"), request) as waiter:
+            return self.batch_result(waiter.get())
+
+
+class AsyncFileClient:
+    """asyncio front end to FileClient: the same operations, as coroutines.
+
+    Each operation runs in a worker thread, so progress callbacks are called
+    from there rather than from the event loop.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.client = FileClient(*args, **kwargs)
+
+    async def connect(self):
+        await asyncio.to_thread(self.client.connect)
+        return self
+
+    async def close(self):
+        await asyncio.to_thread(self.client.close)
+
+    async def __aenter__(self):
+        return await self.connect()
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def upload(self, filepath, progress=None):
+        return await asyncio.to_thread(self.client.upload, filepath, progress)
+
+    async def upload_many(self, filepaths, progress=None):
+        return await asyncio.to_thread(self.client.upload_many, filepaths, progress)
+
+    async def download(self, filename, uploader, download_dir=".", progress=None):
+        return await asyncio.to_thread(self.client.download, filename, uploader, download_dir, progress)
+
+    async def download_many(self, filenames, uploader, download_dir=".", progress=None):
+        return await asyncio.to_thread(self.client.download_many, filenames, uploader, download_dir, progress)
+
+    async def list_files(self, prefix=None, owner=None):
+        return await asyncio.to_thread(self.client.list_files, prefix, owner)
+
+    async def list_page(self, prefix=None, owner=None, after=None, limit=LIST_PAGE_SIZE):
+        return await asyncio.to_thread(self.client.list_page, prefix, owner, after, limit)
+
+    async def subscribe(self, on_change, since=None):
+        return await asyncio.to_thread(self.client.subscribe, on_change, since)
+
+    async def delete(self, filename):
+        return await asyncio.to_thread(self.client.delete, filename)
+
+    async def stats(self):
+        return await asyncio.to_thread(self.client.stats)
+
+    async def delete_many(self, filenames):
+        return await asyncio.to_thread(self.client.delete_many, filenames)
+
+
+# ---------------------------------------------------------------------- command line
+
+def print_progress(done, total):
+    if total:
+        print(f"\r{done * 100 // total:3d}% of {total} bytes", end="", file=sys.stderr, flush=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Command-line client for the file server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, required=True)
+    parser.add_argument("--user", required=True, help="Username to log in as")
+    parser.add_argument("--streams", type=int, default=PARALLEL_STREAMS, help="Data channels to open")
+    parser.add_argument("--protocol", type=int, choices=(1, 2), default=PROTOCOL_VERSION,
+                        help="Highest control protocol to use (1 is the text framing)")
+    parser.add_argument("--json", action="store_true", help="Print results as JSON lines")
+    parser.add_argument("--progress", action="store_true", help="Show transfer progress on stderr")
+    parser.add_argument("--cache-dir", help="Keep downloaded files here, so unchanged files aren't downloaded again")
+    parser.add_argument("--cache-mb", type=int, default=DOWNLOAD_CACHE_SIZE // (1024 * 1024),
+                        help="Size limit of the download cache; least recently used files are dropped first")
+    commands = parser.add_subparsers(dest="command", required=True)
+    upload = commands.add_parser("upload", help="Upload files")
+    upload.add_argument("paths", nargs="+")
+    download = commands.add_parser("download", help="Download files of one uploader")
+    download.add_argument("names", nargs="+")
+    download.add_argument("--uploader", required=True)
+    download.add_argument("--dir", default=".", help="Directory to save into")
+    listing = commands.add_parser("list", help="List the files on the server")
+    listing.add_argument("--prefix", help="Only files whose name starts with this")
+    listing.add_argument("--owner", help="Only files this user uploaded")
+    watch = commands.add_parser("watch", help="Print changes to the server's files as they happen, until interrupted")
+    watch.add_argument("--since", help="Position printed with an earlier change, to pick up after it")
+    commands.add_parser("stats", help="Show the server's metrics")
+    delete = commands.add_parser("delete", help="Delete your own files")
+    delete.add_argument("names", nargs="+")
+    args = parser.parse_args(argv)
+
+    def report(result):
+        if args.progress:
+            print(file=sys.stderr)
+        if args.json:
+            print(json.dumps(result._asdict()))
+        elif isinstance(result, BatchResult):
+            print(f"{'OK' if result.ok else 'FAILED'}  {result.message}")
+            for filename, status in result.statuses:
+                print(f"  {filename}: {status}")
+        else:
+            print(f"{'OK' if result.ok else 'FAILED'}  {result.filename}: {result.message}")
+        return result.ok
+
+    progress = print_progress if args.progress else None
+    on_event = lambda message: print(message, file=sys.stderr) if message.startswith(("[NOTIFICATION]", "[QUEUED]")) else None
+    try:
+        cache = DownloadCache(args.cache_dir, args.cache_mb * 1024 * 1024) if args.cache_dir else None
+        with FileClient(args.host, args.port, args.user, streams=args.streams, on_event=on_event,
+                        protocol=args.protocol, cache=cache) as client:
+            if args.command == "upload":
+                if len(args.paths) > 1:
+                    ok = report(client.upload_many(args.paths, progress))
+                else:
+                    ok = report(client.upload(args.paths[0], progress))
+            elif args.command == "download":
+                if len(args.names) > 1:
+                    ok = report(client.download_many(args.names, args.uploader, args.dir, progress))
+                else:
+                    ok = report(client.download(args.names[0], args.uploader, args.dir, progress))
+            elif args.command == "list":
+                files = client.list_files(args.prefix, args.owner)
+                for listed in files:
+                    print(json.dumps(listed._asdict()) if args.json else f"{listed.filename}  (uploaded by {listed.owner})")
+                ok = True
+            elif args.command == "watch":
+                def print_change(change):
+                    if args.json:
+                        print(json.dumps(change._asdict()), flush=True)
+                    elif change.kind == "reset":
+                        print(f"Changes were missed; list the files again.  {change.position}", flush=True)
+                    else:
+                        print(f"{change.kind:<8} {change.filename}  (uploaded by {change.owner})  {change.position}", flush=True)
+
+                if not client.subscribe(print_change, args.since):
+                    print("[CATALOG] The server no longer knows what changed since then; list the files again.", file=sys.stderr)
+                try:
+                    while client.connected:
+                        time.sleep(1)
+                except KeyboardInterrupt:
+                    pass
+                ok = True
+            elif args.command == "stats":
+                print(json.dumps(client.stats(), indent=None if args.json else 2))
+                ok = True
+            else:
+                if len(args.names) > 1:
+                    ok = report(client.delete_many(args.names))
+                else:
+                    ok = report(client.delete(args.names[0]))
+    except (ClientError, OSError) as e:
+        print(f"[ERROR] {e}", file=sys.stderr)
+        return 2
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,451 @@
+"""Multi-process mode for the server engine: one master, N worker processes.
+
+The master owns the listening port.  It accepts each connection, reads the
+client's first message (a username, or [ATTACH] for a data channel), and
+hands the socket over to a worker together with that message.  Logins go
+to the next worker in turn; data channels go to the worker that holds their
+session, which is why the master routes connections itself rather than
+letting the kernel spread them over SO_REUSEPORT listeners.
+
+Every worker is a full ServerEngine with its own event loop, so transfers,
+hashing and compression run on as many cores as there are workers.  What
+has to be the same everywhere lives in the master, and workers ask for it
+over a Unix socket pair (see Link):
+
+- usernames: a login is only accepted once the master has claimed the name,
+  so a name can't be logged in on two workers at once;
+- file locks: SharedFileLocks takes every per-file lock in the master, so a
+  download on one worker still waits for an upload committing on another;
+- the catalog: a worker that changes it (upload, delete, or moving a file
+  into the storage layout) tells the master, which passes the change on to
+  every other worker before granting anyone the file's lock again, and
+  saves the manifest on shutdown.  The master's catalog also numbers the
+  changes: each worker starts from its epoch and sequence number and is
+  sent every change's number, its own changes' too, so clients following
+  the catalog see the same numbers on every worker;
+- notifications for users logged in on another worker go through the master.
+
+Each message is one SOCK_SEQPACKET packet holding a JSON object, at most
+MAX_PACKET bytes on either end; handed-over sockets ride along as
+SCM_RIGHTS file descriptors.  A client's first message is capped well below
+that, so the master never has to forward something the link can't carry.
+"""
+import asyncio
+import errno
+import itertools
+import json
+import os
+import signal
+import socket
+import subprocess
+import threading
+from contextlib import asynccontextmanager
+
+from catalog import Catalog
+from file_locks import FileLockManager
+from staging import StagingArea
+from storage import STORAGE_BACKENDS
+
+MAX_PACKET = 64 * 1024  # Largest message a link sends or receives
+MAX_FIRST_MESSAGE = 4 * 1024  # Longest first message the master hands over; JSON-escaped it still fits a packet
+FIRST_MESSAGE_TIMEOUT = 30  # Seconds the master waits for a new connection to say who it is
+WORKER_STOP_TIMEOUT = 10  # Seconds workers get to shut down before they are killed
+LISTEN_BACKLOG = 1024
+
+
+def supported():
+    return hasattr(socket, "send_fds") and hasattr(socket, "AF_UNIX")
+
+
+class Link:
+    """One end of a master-worker socket pair.
+
+    post() queues a message and returns at once; a writer task sends the
+    queue in order, so messages always arrive in the order they were posted.
+    request() posts a message and returns a future for the reply with the
+    same "id".  Everything else received goes to on_message(message, fds).
+    """
+
+    def __init__(self, sock, loop, on_message):
+        sock.setblocking(False)
+        self.sock = sock
+        self.loop = loop
+        self.on_message = on_message
+        self.outbox = asyncio.Queue()
+        self.replies = {}  # request id -> future
+        self.request_ids = itertools.count(1)
+        self.closed = False
+        loop.add_reader(sock.fileno(), self._readable)
+        self.writer = loop.create_task(self._write())
+
+    def post(self, message, fds=()):
+        """Queue message; any fds are sent along with it and then closed on this side.
+
+        Raises ValueError (after closing the fds) if the message is larger than MAX_PACKET.
+        """
+        data = json.dumps(message, separators=(",", ":")).encode()
+        if not self.closed and len(data) <= MAX_PACKET:
+            self.outbox.put_nowait((data, fds))
+            return
+        for fd in fds:
+            os.close(fd)
+        if len(data) > MAX_PACKET:
+            raise ValueError(f"Message of {len(data)} bytes is too large for the cluster link.")
+
+    def request(self, message):
+        """Post message with a fresh "id"; returns (id, future of the reply)."""
+        message["id"] = request_id = next(self.request_ids)
+        reply = self.replies[request_id] = self.loop.create_future()
+        if self.closed:
+            reply.set_exception(ConnectionError("Lost the link to the cluster master."))
+        self.post(message)
+        return request_id, reply
+
+    def reply(self, request_id, **fields):
+        self.post({"op": "reply", "id": request_id, **fields})
+
+    async def drain(self):
+        """Wait until everything posted so far has been sent."""
+        if not self.closed:
+            await self.outbox.join()
+
+    async def _write(self):
+        while True:
+            data, fds = await self.outbox.get()
+            try:
+                while True:
+                    try:
+                        if fds:
+                            socket.send_fds(self.sock, [data], fds)
+                        else:
+                            self.sock.send(data)
+                        break
+                    except BlockingIOError:
+                        writable = self.loop.create_future()
+                        self.loop.add_writer(self.sock.fileno(), writable.set_result, None)
+                        try:
+                            await writable
+                        finally:
+                            self.loop.remove_writer(self.sock.fileno())
+            except OSError as e:
+                # Only a broken link loses the link; any other failure loses just this message.
+                if e.errno in (errno.EPIPE, errno.ECONNRESET, errno.ENOTCONN, errno.EBADF):
+                    self._lost()
+            finally:
+                for fd in fds:
+                    os.close(fd)
+                self.outbox.task_done()
+
+    def _readable(self):
+        try:
+            data, fds, flags, _ = socket.recv_fds(self.sock, MAX_PACKET, 4)
+        except BlockingIOError:
+            return
+        except OSError:
+            data, fds, flags = b"", [], 0
+        if not data:
+            self._lost()
+            return
+        if flags & socket.MSG_TRUNC:  # Larger than any message post() sends; drop it
+            for fd in fds:
+                os.close(fd)
+            return
+        message = json.loads(data)
+        if message.get("op") == "reply":
+            reply = self.replies.pop(message["id"], None)
+            if reply is not None and not reply.done():
+                reply.set_result(message)
+            return
+        self.on_message(message, fds)
+
+    def _lost(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.loop.remove_reader(self.sock.fileno())
+        while not self.outbox.empty():  # Nothing will send these now
+            _, fds = self.outbox.get_nowait()
+            for fd in fds:
+                os.close(fd)
+            self.outbox.task_done()
+        for reply in self.replies.values():
+            if not reply.done():
+                reply.set_exception(ConnectionError("Lost the link to the cluster master."))
+        self.replies.clear()
+        self.on_message(None, [])
+
+    def close(self):
+        self._lost()
+        self.writer.cancel()
+        self.sock.close()
+
+
+class SharedFileLocks:
+    """Same interface as FileLockManager, but the locks are held in the master so they cover every worker."""
+
+    def __init__(self, link, on_wait=None):
+        self.link = link
+        self.on_wait = on_wait
+        self.active = 0  # Locks this worker holds or waits for
+
+    @asynccontextmanager
+    async def read(self, key):
+        async with self._lock(key, "read"):
+            yield
+
+    @asynccontextmanager
+    async def write(self, key):
+        async with self._lock(key, "write"):
+            yield
+
+    @asynccontextmanager
+    async def _lock(self, key, mode):
+        self.active += 1
+        request_id, granted = self.link.request({"op": "lock", "key": key, "mode": mode})
+        try:
+            started = self.link.loop.time()
+            await granted
+            if self.on_wait:
+                self.on_wait(mode, self.link.loop.time() - started)
+            yield
+        finally:
+            self.active -= 1
+            self.link.replies.pop(request_id, None)
+            self.link.post({"op": "unlock", "lock": request_id})  # Also withdraws a request still waiting
+
+    def __len__(self):
+        return self.active
+
+
+class Cluster:
+    """The master process: accepts connections and keeps what the workers share.
+
+    worker_command is the command line that starts one worker; the master
+    appends --worker-link and --worker-index to it.
+    """
+
+    def __init__(self, worker_command, workers, storage_dir, storage="flat", layout="flat", host="0.0.0.0", port=0,
+                 log=print):
+        self.worker_command = worker_command
+        self.worker_count = workers
+        self.storage_dir = storage_dir
+        self.host = host
+        self.port = port
+        self.log_message = log
+        self.storage = STORAGE_BACKENDS[storage](storage_dir, layout)
+        self.catalog = Catalog(storage_dir, self.storage)  # Kept up to date from the workers' changes
+        self.file_locks = FileLockManager()
+        self.workers = []  # (process, Link) per worker, by index
+        self.users = {}  # username -> (worker index, data channel token)
+        self.tokens = {}  # data channel token -> worker index
+        self.locks = {}  # (worker index, lock id) -> task holding or waiting for the lock
+        self.next_worker = itertools.cycle(range(workers))
+        self.loop = None
+        self._stopped = None
+        self._tasks = set()
+
+    def run(self):
+        asyncio.run(self.serve())
+
+    def stop(self):
+        if self.loop and self._stopped:
+            self.loop.call_soon_threadsafe(self._stopped.set)
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self._stopped = asyncio.Event()
+        if threading.current_thread() is threading.main_thread():
+            for sig in (signal.SIGINT, signal.SIGTERM):
+                self.loop.add_signal_handler(sig, self._stopped.set)
+
+        # Get storage and the manifest ready once, so the workers find a clean manifest to load.
+        storage_status = self.storage.prepare()
+        if storage_status:
+            self.log_message(storage_status)
+        self.catalog.load()
+        self.catalog.save()
+        removed = StagingArea(self.storage_dir).cleanup()
+        if removed:
+            self.log_message(f"[STAGING] Removed {removed} abandoned partial uploads.")
+        self.log_message(f"[CATALOG] {len(self.catalog)} files in {self.storage_dir}.")
+
+        for index in range(self.worker_count):
+            master_end, worker_end = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+            process = subprocess.Popen(
+                self.worker_command + ["--worker-link", str(worker_end.fileno()), "--worker-index", str(index)],
+                pass_fds=[worker_end.fileno()])
+            worker_end.close()
+            link = Link(master_end, self.loop, lambda message, fds, index=index: self.on_message(index, message, fds))
+            link.post({"op": "numbering", "epoch": self.catalog.epoch, "seq": self.catalog.sequence})
+            self.workers.append((process, link))
+        self.log_message(f"[CLUSTER] Started {self.worker_count} worker processes.")
+
+        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server_socket.bind((self.host, self.port))
+        server_socket.listen(LISTEN_BACKLOG)
+        server_socket.setblocking(False)
+        self.port = server_socket.getsockname()[1]
+        self.log_message(f"[STARTING] Server is starting on {self.host}:{self.port}")
+        self.log_message("[LISTENING] Server is listening for connections...")
+        accept_task = self.loop.create_task(self.accept_loop(server_socket))
+        try:
+            await self._stopped.wait()
+        finally:
+            accept_task.cancel()
+            server_socket.close()
+            for task in list(self._tasks):
+                task.cancel()
+            await asyncio.gather(accept_task, *self._tasks, return_exceptions=True)
+            await self.stop_workers()
+            try:
+                self.catalog.save()
+            except OSError as e:
+                self.log_message(f"[ERROR] Failed to save catalog: {e}")
+            self.log_message("[STOPPED] Server stopped.")
+
+    async def stop_workers(self):
+        for process, _ in self.workers:
+            if process.poll() is None:
+                process.send_signal(signal.SIGTERM)
+        for process, link in self.workers:
+            try:
+                await asyncio.wait_for(self.loop.run_in_executor(None, process.wait), WORKER_STOP_TIMEOUT)
+            except asyncio.TimeoutError:
+                process.kill()
+            # Catalog changes the worker sent while stopping are already queued for on_message.
+            await asyncio.sleep(0)
+            link.close()
+
+    def spawn(self, coro):
+        task = self.loop.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def accept_loop(self, server_socket):
+        while True:
+            try:
+                client_socket, address = await self.loop.sock_accept(server_socket)
+            except asyncio.CancelledError:
+                raise
+            except OSError as e:
+                self.log_message(f"[ERROR] {e}")
+                await asyncio.sleep(0.1)
+                continue
+            self.spawn(self.hand_over(client_socket, address))
+
+    async def hand_over(self, client_socket, address):
+        """Read a new connection's first message and pass the connection to the worker that should serve it."""
+        client_socket.setblocking(False)
+        try:
+            first_message = await asyncio.wait_for(self.receive_first_message(client_socket), FIRST_MESSAGE_TIMEOUT)
+        except (OSError, ValueError, asyncio.TimeoutError):
+            first_message = None
+        if not first_message:
+            client_socket.close()
+            return
+        index = None
+        if first_message.startswith("[ATTACH]"):
+            token = first_message.split("|", 1)[-1].strip("[] ")
+            index = self.tokens.get(token)
+        if index is None:
+            index = self.pick_worker()
+        if index is None:
+            client_socket.close()
+            return
+        _, link = self.workers[index]
+        try:
+            link.post({"op": "connection", "first": first_message, "address": list(address)}, [client_socket.detach()])
+        except ValueError as e:  # The socket went with the message, so only this connection is lost
+            self.log_message(f"[ERROR] Could not hand over {address}: {e}")
+
+    def pick_worker(self):
+        """The next worker in turn whose link is still up, or None if all are gone."""
+        for _ in range(self.worker_count):
+            index = next(self.next_worker)
+            if not self.workers[index][1].closed:
+                return index
+        return None
+
+    async def receive_first_message(self, client_socket):
+        header = await self.receive_exactly(client_socket, 4)
+        size = int.from_bytes(header, byteorder="big")
+        if size > MAX_FIRST_MESSAGE:
+            raise ValueError(f"First message of {size} bytes is too long.")
+        return (await self.receive_exactly(client_socket, size)).decode()
+
+    async def receive_exactly(self, client_socket, size):
+        data = b""
+        while len(data) < size:
+            chunk = await self.loop.sock_recv(client_socket, size - len(data))
+            if not chunk:
+                raise ConnectionError("Connection closed before it said who it is.")
+            data += chunk
+        return data
+
+    # ------------------------------------------------------------------ requests from workers
+
+    def on_message(self, index, message, fds):
+        for fd in fds:
+            os.close(fd)  # Workers never send us sockets
+        _, link = self.workers[index]
+        if message is None:
+            self.worker_lost(index)
+            return
+        op = message["op"]
+        if op == "claim":
+            user = message["user"]
+            ok = user not in self.users
+            if ok:
+                self.users[user] = (index, message["token"])
+                self.tokens[message["token"]] = index
+            link.reply(message["id"], ok=ok)
+        elif op == "release":
+            claim = self.users.get(message["user"])
+            if claim is not None and claim[0] == index:
+                del self.users[message["user"]]
+                self.tokens.pop(claim[1], None)
+        elif op == "lock":
+            self.locks[(index, message["id"])] = self.spawn(self.hold_lock(link, message))
+        elif op == "unlock":
+            task = self.locks.pop((index, message["lock"]), None)
+            if task is not None:
+                task.cancel()
+        elif op in ("catalog", "relocate"):
+            sequence = self.catalog.sequence
+            if op == "relocate":
+                self.catalog.relocate(message["owner"], message["filename"], message["path"])
+            elif message["entry"] is None:
+                self.catalog.remove(message["owner"], message["filename"])
+            else:
+                self.catalog.add(*message["entry"])
+            change = list(self.catalog.changes[-1]) if self.catalog.sequence != sequence else None
+            for other, (_, other_link) in enumerate(self.workers):
+                if other != index:
+                    other_link.post({**message, "change": change} if change else message)
+                elif change:
+                    other_link.post({"op": "change", "change": change})  # Its own change, numbered
+        elif op == "notify":
+            claim = self.users.get(message["user"])
+            if claim is not None:
+                self.workers[claim[0]][1].post(message)
+
+    async def hold_lock(self, link, message):
+        """Hold one worker's lock until it unlocks it (which cancels this task)."""
+        lock = self.file_locks.read if message["mode"] == "read" else self.file_locks.write
+        async with lock(message["key"]):
+            link.reply(message["id"])
+            await asyncio.Event().wait()
+
+    def worker_lost(self, index):
+        process, _ = self.workers[index]
+        if self._stopped.is_set():
+            return
+        self.log_message(f"[ERROR] Worker {index} (pid {process.pid}) exited; its clients were disconnected.")
+        for user, (owner, token) in list(self.users.items()):
+            if owner == index:
+                del self.users[user]
+                self.tokens.pop(token, None)
+        for key in [key for key in self.locks if key[0] == index]:
+            self.locks.pop(key).cancel()
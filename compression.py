@@ -0,0 +1,341 @@
+"""Streaming compression for transfers and for files at rest.
+
+Peers agree on a codec per transfer: the server lists the codecs it has in
+its [DATA_CHANNEL] reply, and an [UPLOAD] or [DOWNLOAD] over a data channel
+may then ask for one with compress=<codec>.  The sender samples the data
+first and sends it as is if it doesn't shrink (media, archives), so asking
+costs next to nothing.  Compressed payloads go in frames flagged
+FRAME_COMPRESSED; sizes, offsets and byte ranges always refer to the
+uncompressed file.
+
+zlib and lzma ship with Python; zstd is offered when the optional zstandard
+package is installed.
+
+The server can also keep files compressed on disk.  Such a file starts with
+CONTAINER_HEADER (magic, codec, original size) followed by one compressed
+stream.
+"""
+import lzma
+import os
+import struct
+import zlib
+
+try:
+    import zstandard
+except ImportError:  # Optional; zlib and lzma are always there
+    zstandard = None
+
+CHUNK_SIZE = 256 * 1024  # Bytes read, or decompressed, at a time
+SAMPLE_SIZE = 64 * 1024  # Bytes compressed to decide whether compression pays off
+COMPRESSIBLE_RATIO = 0.9  # ...it does if the sample shrinks below this fraction
+ZLIB_LEVEL = 6
+LZMA_PRESET = 1
+ZSTD_LEVEL = 3
+
+CONTAINER_MAGIC = b"\x89CZ\x01"
+CONTAINER_HEADER = struct.Struct("!4sBQ")  # magic, codec id, original size
+CONTAINER_CODECS = ("zlib", "lzma", "zstd")  # Codec ids, by position; never reorder
+
+
+def available_codecs():
+    """Codecs this side can use, most preferred first."""
+    return (["zstd"] if zstandard else []) + ["zlib", "lzma"]
+
+
+def choose_codec(offered):
+    """The codec we prefer among those the peer offered, or None."""
+    for codec in available_codecs():
+        if codec in offered:
+            return codec
+    return None
+
+
+def make_compressor(codec):
+    if codec == "zlib":
+        return zlib.compressobj(ZLIB_LEVEL)
+    if codec == "lzma":
+        return lzma.LZMACompressor(preset=LZMA_PRESET)
+    if codec == "zstd" and zstandard:
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+    raise ValueError(f"Unsupported codec: {codec}")
+
+
+class _NeedInput(Exception):
+    """Raised by _PendingInput when the bytes fed so far are used up."""
+
+
+class _PendingInput:
+    """Source for zstandard's stream reader holding the bytes of the current feed() call.
+
+    Running dry raises instead of returning b"", so the reader doesn't take it for the end of
+    its input and can carry on with the next call's bytes.
+    """
+
+    def __init__(self):
+        self.data = b""
+
+    def read(self, size):
+        if not self.data:
+            raise _NeedInput
+        piece, self.data = self.data[:size], self.data[size:]
+        return piece
+
+
+class _ZstdFrame:
+    """Follows the block headers of a zstd frame as its bytes go by, to tell where it ends.
+
+    zstandard's stream reader, unlike its decompressobj(), doesn't say when the frame is done.
+    """
+
+    FRAME_HEADER = 5  # Magic number and frame header descriptor
+    BLOCK_HEADER = 3
+
+    def __init__(self):
+        self.complete = False
+        self._want = self.FRAME_HEADER  # Length of the header being gathered
+        self._pending = bytearray()
+        self._skip = 0  # Bytes left before the next header
+        self._checksum = False
+        self._last = False
+
+    def feed(self, data):
+        view = memoryview(data)
+        while view and not self.complete:
+            if self._skip:
+                count = min(self._skip, len(view))
+                self._skip -= count
+                view = view[count:]
+                self.complete = self._last and not self._skip
+                continue
+            count = self._want - len(self._pending)
+            self._pending += view[:count]
+            view = view[count:]
+            if len(self._pending) == self._want:
+                self._header(bytes(self._pending))
+                self._pending.clear()
+
+    def _header(self, header):
+        if self._want == self.FRAME_HEADER:
+            descriptor = header[4]
+            single_segment = descriptor >> 5 & 1
+            self._checksum = bool(descriptor >> 2 & 1)
+            self._skip = (
+                (0 if single_segment else 1)  # Window descriptor
+                + (0, 1, 2, 4)[descriptor & 3]  # Dictionary ID
+                + (single_segment, 2, 4, 8)[descriptor >> 6]  # Content size
+            )
+            self._want = self.BLOCK_HEADER
+            return
+        value = int.from_bytes(header, "little")
+        self._last = bool(value & 1)
+        size = 1 if (value >> 1 & 3) == 1 else value >> 3  # An RLE block stores one byte
+        self._skip = size + (4 if self._last and self._checksum else 0)
+        self.complete = self._last and not self._skip
+
+
+class Decompressor:
+    """Incremental decompressor that hands its output out in bounded pieces."""
+
+    def __init__(self, codec):
+        self.codec = codec
+        if codec == "zlib":
+            self._decompressor = zlib.decompressobj()
+        elif codec == "lzma":
+            self._decompressor = lzma.LZMADecompressor()
+        elif codec == "zstd" and zstandard:
+            # decompressobj() has no output limit, so read the frame through a stream reader
+            self._input = _PendingInput()
+            self._frame = _ZstdFrame()
+            self._decompressor = zstandard.ZstdDecompressor().stream_reader(
+                self._input, read_size=CHUNK_SIZE
+            )
+        else:
+            raise ValueError(f"Unsupported codec: {codec}")
+
+    @property
+    def eof(self):
+        if self.codec == "zstd":
+            return self._frame.complete
+        return getattr(self._decompressor, "eof", True)
+
+    def feed(self, data):
+        """Yield the output for data, at most CHUNK_SIZE bytes at a time."""
+        decompressor = self._decompressor
+        if self.codec == "zlib":
+            piece = decompressor.decompress(data, CHUNK_SIZE)
+            while piece:
+                yield piece
+                piece = decompressor.decompress(decompressor.unconsumed_tail, CHUNK_SIZE)
+        elif self.codec == "lzma":
+            if decompressor.eof:
+                return  # Trailing garbage after the stream
+            piece = decompressor.decompress(data, CHUNK_SIZE)
+            while True:
+                if piece:
+                    yield piece
+                if decompressor.eof or decompressor.needs_input:
+                    break
+                piece = decompressor.decompress(b"", CHUNK_SIZE)
+        else:
+            self._frame.feed(data)
+            self._input.data = bytes(data)
+            while True:
+                try:
+                    piece = decompressor.read1(CHUNK_SIZE)
+                except _NeedInput:
+                    break
+                if not piece:
+                    break
+                yield piece
+
+
+class DecompressingSink:
+    """Wraps a stream sink so FRAME_COMPRESSED payloads are decompressed before they reach it.
+
+    Frames without the flag pass straight through: a sender may decide not to
+    compress data that doesn't shrink.  With a limit, at most that many bytes
+    are inflated: the piece that crosses it still goes to the sink, so it
+    can tell the stream overran, and the rest of the stream is dropped undecompressed.
+    """
+
+    def __init__(self, sink, codec, limit=None):
+        self.sink = sink
+        self.decompressor = Decompressor(codec)
+        self.compressed = False
+        self.remaining = limit
+
+    @property
+    def overflowed(self):
+        return self.remaining is not None and self.remaining < 0
+
+    def write(self, data):
+        if not self.overflowed:
+            self._pass(data)
+
+    def write_compressed(self, data):
+        self.compressed = True
+        for piece in self.decompressor.feed(data):
+            if self.overflowed:
+                break  # Don't inflate what nobody will take
+            self._pass(piece)
+
+    def _pass(self, data):
+        if self.remaining is not None:
+            self.remaining -= len(data)
+        self.sink.write(data)
+
+    def finish(self, completed):
+        if self.compressed and not self.decompressor.eof or self.overflowed:
+            completed = False  # The compressed stream was cut short, or carried too much
+        self.sink.finish(completed)
+
+
+# ---------------------------------------------------------------------- sending
+
+def sample_compresses(file, offset, codec):
+    """Whether the data at offset in file is worth compressing with codec."""
+    return data_compresses(os.pread(file.fileno(), SAMPLE_SIZE, offset), codec)
+
+
+def data_compresses(sample, codec):
+    """Whether data like sample (up to SAMPLE_SIZE bytes of it are tried) is worth compressing with codec."""
+    sample = sample[:SAMPLE_SIZE]
+    if not sample:
+        return False
+    compressor = make_compressor(codec)
+    size = len(compressor.compress(sample)) + len(compressor.flush())
+    return size < len(sample) * COMPRESSIBLE_RATIO
+
+
+def read_chunks(file, offset, count=None):
+    """Yield count bytes of file from offset (to the end if count is None)."""
+    file.seek(offset)
+    while count is None or count > 0:
+        chunk = file.read(CHUNK_SIZE if count is None else min(CHUNK_SIZE, count))
+        if not chunk:
+            break
+        if count is not None:
+            count -= len(chunk)
+        yield chunk
+
+
+def compress_chunks(chunks, codec):
+    """Compress an iterable of chunks into one stream, yielding its non-empty pieces."""
+    compressor = make_compressor(codec)
+    yield from compress_into(compressor, chunks)
+    piece = compressor.flush()
+    if piece:
+        yield piece
+
+
+def compress_into(compressor, chunks):
+    """Feed chunks to a compressor that outlives them (e.g. across the files of a batch)."""
+    for chunk in chunks:
+        piece = compressor.compress(chunk)
+        if piece:
+            yield piece
+
+
+# ---------------------------------------------------------------------- at rest
+
+def read_container_header(file):
+    """(codec, original size) if file is stored compressed, else None."""
+    header = os.pread(file.fileno(), CONTAINER_HEADER.size, 0)
+    if len(header) < CONTAINER_HEADER.size:
+        return None
+    magic, codec_id, size = CONTAINER_HEADER.unpack(header)
+    if magic != CONTAINER_MAGIC or codec_id >= len(CONTAINER_CODECS):
+        return None
+    return CONTAINER_CODECS[codec_id], size
+
+
+def original_size(path):
+    """Size of the file's content, looking through compression at rest."""
+    with open(path, "rb") as file:
+        header = read_container_header(file)
+        return header[1] if header else os.fstat(file.fileno()).st_size
+
+
+def stored_chunks(file, header, offset, count):
+    """Yield count bytes of the file's content from offset, decompressing if it is stored compressed."""
+    if header is None:
+        yield from read_chunks(file, offset, count)
+        return
+    if not count:
+        return
+    decompressor = Decompressor(header[0])
+    for chunk in read_chunks(file, CONTAINER_HEADER.size):
+        for piece in decompressor.feed(chunk):
+            if offset >= len(piece):
+                offset -= len(piece)  # Still before the requested range
+                continue
+            piece = piece[offset:offset + count]
+            offset = 0
+            count -= len(piece)
+            yield piece
+            if not count:
+                return
+
+
+def compress_file(path, codec):
+    """Rewrite path compressed at rest if that makes it smaller. Returns True if it did.
+
+    A file whose content happens to start with CONTAINER_MAGIC is always
+    wrapped, so the magic on disk never means anything but a container.
+    """
+    with open(path, "rb") as source:
+        size = os.fstat(source.fileno()).st_size
+        ambiguous = read_container_header(source) is not None
+        if not ambiguous and not sample_compresses(source, 0, codec):
+            return False
+        temp_path = path + ".z"
+        with open(temp_path, "wb") as target:
+            target.write(CONTAINER_HEADER.pack(CONTAINER_MAGIC, CONTAINER_CODECS.index(codec), size))
+            for piece in compress_chunks(read_chunks(source, 0), codec):
+                target.write(piece)
+            compressed_size = target.tell()
+    if compressed_size >= size and not ambiguous:
+        os.remove(temp_path)
+        return False
+    os.replace(temp_path, path)
+    return True
@@ -0,0 +1,229 @@
+"""rsync-style deltas for re-uploads of a file the server already has.
+
+Before sending a large file again, the client asks for the signatures of
+the server's copy ([SIGNATURES]): the copy is cut into blocks and each gets
+a weak checksum (Adler-32, which can be rolled along one byte at a time)
+and a strong hash (BLAKE2b).  The client slides a block-sized window over
+its own version; where the weak checksum matches a block and the strong
+hash confirms it, the delta refers to that block instead of carrying its
+bytes.  Everything in between is sent as literal data.  The server rebuilds
+the file from its copy and the delta and only keeps it if the result has
+the SHA-256 the client announced.
+
+A delta is a sequence of ops, each an OP_HEADER:
+
+    COPY     first block, block count    (the blocks of the server's copy)
+    LITERAL  length, 0                   (followed by length bytes)
+"""
+import hashlib
+import math
+import mmap
+import struct
+import zlib
+
+MIN_BLOCK_SIZE = 2048
+MAX_BLOCKS = 65536  # Blocks per signature; larger files get larger blocks
+STRONG_HASH_SIZE = 16  # Bytes of BLAKE2b per block
+MAX_LITERAL_PIECE = 1024 * 1024  # Longer literal runs are split into several ops
+CHUNK_SIZE = 256 * 1024  # Bytes read, written or handed out at a time
+ADLER_MOD = 65521
+PROBE_SAMPLES = 32  # Places in a large file checked for matches before the whole of it is searched
+
+OP_HEADER = struct.Struct("!BII")
+OP_COPY = 1
+OP_LITERAL = 2
+
+
+def block_size_for(size):
+    """Block size for a file of size bytes: about its square root, as rsync does."""
+    return max(MIN_BLOCK_SIZE, math.isqrt(size), -(-size // MAX_BLOCKS))
+
+
+def strong_hash(block):
+    return hashlib.blake2b(block, digest_size=STRONG_HASH_SIZE).digest()
+
+
+def file_signatures(chunks, block_size):
+    """Signatures of the content given as chunks: ([(weak, strong)] per block, SHA-256 hex of it all)."""
+    signatures = []
+    digest = hashlib.sha256()
+    pending = b""
+    for chunk in chunks:
+        digest.update(chunk)
+        pending += chunk
+        full = len(pending) - len(pending) % block_size
+        for start in range(0, full, block_size):
+            block = pending[start:start + block_size]
+            signatures.append((zlib.adler32(block), strong_hash(block)))
+        pending = pending[full:]
+    if pending:
+        signatures.append((zlib.adler32(pending), strong_hash(pending)))
+    return signatures, digest.hexdigest()
+
+
+def compute_delta(path, signatures, block_size, base_size, max_literal):
+    """The ops that turn the file the signatures describe (base_size bytes) into the file at path.
+
+    Returns None if more than max_literal bytes would have to be sent as
+    literals; the file has changed too much to be worth it.  The search
+    rolls a checksum along byte by byte, so in a large file a sample of
+    places is checked first, and a file that matches too little of the
+    server's copy there is given up on without searching the rest.
+    """
+    with open(path, "rb") as file:
+        size = file.seek(0, 2)
+        if not size:
+            return []
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return _match_blocks(data, size, signatures, block_size, base_size, max_literal)
+
+
+def _match_blocks(data, size, signatures, block_size, base_size, max_literal):
+    full_blocks = base_size // block_size
+    blocks = {}  # weak checksum -> [(index, strong)] of the full-sized blocks
+    for index, (weak, strong) in enumerate(signatures[:full_blocks]):
+        blocks.setdefault(weak, []).append((index, strong))
+    # A shorter last block can only match right at the end of the new file.
+    tail = (full_blocks, base_size - full_blocks * block_size, *signatures[full_blocks]) if len(signatures) > full_blocks else None
+    if _mostly_changed(data, size, blocks, block_size, max_literal):
+        return None
+
+    ops = []
+    literal_bytes = 0
+    literal_start = position = 0
+
+    def match(index):
+        nonlocal literal_bytes, literal_start
+        literal_bytes += _add_literal(ops, literal_start, position - literal_start)
+        if ops and ops[-1][0] == OP_COPY and ops[-1][1] + ops[-1][2] == index:
+            ops[-1] = (OP_COPY, ops[-1][1], ops[-1][2] + 1)
+        else:
+            ops.append((OP_COPY, index, 1))
+
+    while position + block_size <= size:
+        # Search no further than the literal bytes still allowed reach.
+        last = min(size - block_size, literal_start + math.floor(max_literal - literal_bytes))
+        found = _next_match(data, position, last, blocks, block_size)
+        if found is None:
+            if last < size - block_size:
+                return None
+            break
+        position, index = found
+        match(index)
+        position += block_size
+        literal_start = position
+
+    if tail is not None:
+        index, length, tail_weak, tail_strong = tail
+        start = size - length
+        if start >= literal_start and zlib.adler32(data[start:size]) == tail_weak and strong_hash(data[start:size]) == tail_strong:
+            position = start
+            match(index)
+            literal_start = size
+    literal_bytes += _add_literal(ops, literal_start, size - literal_start)
+    return None if literal_bytes > max_literal else ops
+
+
+def _next_match(data, position, last, blocks, block_size):
+    """(position, block index) of the first window starting in [position, last] that matches a block, or None."""
+    weak = zlib.adler32(data[position:position + block_size])
+    low, high = weak & 0xFFFF, weak >> 16
+    while True:
+        candidates = blocks.get(weak)
+        if candidates:
+            strong = strong_hash(data[position:position + block_size])
+            index = next((index for index, candidate in candidates if candidate == strong), None)
+            if index is not None:
+                return position, index
+        if position >= last:
+            return None
+        # Roll the window one byte along: drop data[position], take in data[position + block_size].
+        out, new = data[position], data[position + block_size]
+        low = (low - out + new) % ADLER_MOD
+        high = (high - block_size * out + low - 1) % ADLER_MOD
+        weak = high << 16 | low
+        position += 1
+
+
+def _mostly_changed(data, size, blocks, block_size, max_literal):
+    """Whether the file clearly matches too little of the server's copy, judging by PROBE_SAMPLES places in it.
+
+    Every block-sized stretch of unchanged content holds a match, so the
+    share of places with one estimates the share of the file that can be
+    copied; only a share well below what is needed gives up, since it is
+    just a sample.  Small files are searched whole anyway.
+    """
+    if size < 4 * PROBE_SAMPLES * block_size:
+        return False
+    needed = 1 - max_literal / size
+    step = size // PROBE_SAMPLES
+    found = sum(
+        _next_match(data, start, min(start + block_size - 1, size - block_size), blocks, block_size) is not None
+        for start in range(0, size - block_size + 1, step)
+    )
+    return found < needed * PROBE_SAMPLES / 2
+
+
+def _add_literal(ops, offset, length):
+    for start in range(offset, offset + length, MAX_LITERAL_PIECE):
+        ops.append((OP_LITERAL, start, min(MAX_LITERAL_PIECE, offset + length - start)))
+    return length
+
+
+def delta_size(ops):
+    """Bytes of the encoded delta."""
+    return sum(OP_HEADER.size + (length if op == OP_LITERAL else 0) for op, _, length in ops)
+
+
+def delta_chunks(path, ops):
+    """The encoded delta, in pieces of about CHUNK_SIZE bytes; literals are read from the file at path."""
+    with open(path, "rb") as file:
+        piece = bytearray()
+        for op, first, count in ops:
+            if op == OP_COPY:
+                piece += OP_HEADER.pack(OP_COPY, first, count)
+            else:
+                piece += OP_HEADER.pack(OP_LITERAL, count, 0)
+                file.seek(first)
+                piece += file.read(count)
+            if len(piece) >= CHUNK_SIZE:
+                yield bytes(piece)
+                piece.clear()
+        if piece:
+            yield bytes(piece)
+
+
+def apply_delta(delta, base, out, block_size):
+    """Write the file a delta describes to out, copying blocks from base (both open files).
+
+    Returns (size, SHA-256 hex) of what was written; raises ValueError if
+    the delta is malformed.
+    """
+    digest = hashlib.sha256()
+    size = 0
+
+    def copy(source, count):
+        nonlocal size
+        while count > 0:
+            chunk = source.read(min(CHUNK_SIZE, count))
+            if not chunk:
+                return count
+            out.write(chunk)
+            digest.update(chunk)
+            size += len(chunk)
+            count -= len(chunk)
+        return 0
+
+    while header := delta.read(OP_HEADER.size):
+        if len(header) < OP_HEADER.size:
+            raise ValueError("Truncated delta")
+        op, first, count = OP_HEADER.unpack(header)
+        if op == OP_COPY:
+            base.seek(first * block_size)
+            copy(base, count * block_size)  # The last block may be short; the digest check catches anything else
+        elif op == OP_LITERAL:
+            if copy(delta, first):
+                raise ValueError("Truncated delta")
+        else:
+            raise ValueError(f"Unknown delta op {op}")
+    return size, digest.hexdigest()
@@ -0,0 +1,154 @@
+"""Client-side cache of downloaded files, for conditional downloads.
+
+Every file the server sends comes with its version (see
+catalog.file_version).  A copy of each downloaded file is kept in the cache
+directory, named by its SHA-256 so identical files are stored once, and
+indexed by (server, owner, filename) in index.json, server being the
+host:port it came from.  The next download of the same
+file tells the server which version and content it has (if_version=,
+if_sha256=); if the file hasn't changed, the server answers not_modified=1
+without sending any data and the file is copied out of the cache, so a
+repeated pull costs one round trip.
+
+The cache holds at most budget bytes and evicts the least recently used
+files first; no file larger than max_entry is cached at all.
+"""
+import hashlib
+import json
+import os
+import shutil
+import threading
+import uuid
+from collections import OrderedDict, namedtuple
+
+INDEX_NAME = "index.json"
+INDEX_VERSION = 2
+DOWNLOAD_CACHE_SIZE = 1024 * 1024 * 1024  # Bytes of downloaded files kept for conditional downloads
+COPY_CHUNK_SIZE = 1024 * 1024
+
+CachedFile = namedtuple("CachedFile", "version sha256 size")
+
+
+class DownloadCache:
+    def __init__(self, cache_dir, budget=DOWNLOAD_CACHE_SIZE, max_entry=None):
+        self.cache_dir = cache_dir
+        self.budget = budget
+        self.max_entry = budget // 4 if max_entry is None else max_entry
+        self.index_path = os.path.join(cache_dir, INDEX_NAME)
+        self.entries = OrderedDict()  # (server, owner, filename) -> CachedFile, least recently used first
+        self.lock = threading.Lock()  # Downloads running in several threads share the cache
+        self.load()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def content_path(self, cached):
+        return os.path.join(self.cache_dir, cached.sha256)
+
+    # ------------------------------------------------------------------ lookups
+
+    def get(self, server, owner, filename):
+        """The CachedFile for a file of server, or None if there is none (or its content has gone missing)."""
+        with self.lock:
+            cached = self.entries.get((server, owner, filename))
+            if cached is None:
+                return None
+            try:
+                if os.path.getsize(self.content_path(cached)) == cached.size:
+                    return cached
+            except OSError:
+                pass
+            self._remove((server, owner, filename))
+            self.save()
+            return None
+
+    def restore(self, server, owner, filename, cached, filepath):
+        """Copy a cached file to filepath. Returns False if it is no longer in the cache."""
+        temp_path = f"{filepath}.{uuid.uuid4().hex[:8]}.tmp"
+        try:
+            shutil.copyfile(self.content_path(cached), temp_path)
+            os.replace(temp_path, filepath)
+        except FileNotFoundError:
+            self.discard(server, owner, filename)
+            return False
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        with self.lock:
+            if self.entries.get((server, owner, filename)) == cached:
+                self.entries.move_to_end((server, owner, filename))
+                self.save()
+        return True
+
+    # ------------------------------------------------------------------ updates
+
+    def store(self, server, owner, filename, version, filepath):
+        """Keep a copy of a file just downloaded to filepath, as that version of (server, owner, filename)."""
+        size = os.path.getsize(filepath)
+        if not self.budget or size > self.max_entry:
+            self.discard(server, owner, filename)
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        temp_path = os.path.join(self.cache_dir, f"{uuid.uuid4().hex}.tmp")
+        digest = hashlib.sha256()
+        with open(filepath, "rb") as source, open(temp_path, "wb") as copy:
+            while chunk := source.read(COPY_CHUNK_SIZE):
+                digest.update(chunk)
+                copy.write(chunk)
+        cached = CachedFile(version, digest.hexdigest(), size)
+        with self.lock:
+            os.replace(temp_path, self.content_path(cached))  # Same content under the same name, if already there
+            self._remove((server, owner, filename), keep=cached.sha256)
+            self.entries[(server, owner, filename)] = cached
+            self._evict()
+            self.save()
+
+    def discard(self, server, owner, filename):
+        with self.lock:
+            if (server, owner, filename) in self.entries:
+                self._remove((server, owner, filename))
+                self.save()
+
+    def _remove(self, key, keep=None):
+        """Drop an entry, and its content unless another entry (or the content being stored, keep) has it."""
+        cached = self.entries.pop(key, None)
+        if cached is None or cached.sha256 == keep or any(other.sha256 == cached.sha256 for other in self.entries.values()):
+            return
+        try:
+            os.remove(self.content_path(cached))
+        except FileNotFoundError:
+            pass
+
+    def _evict(self):
+        sizes = {cached.sha256: cached.size for cached in self.entries.values()}
+        total = sum(sizes.values())
+        while self.entries and total > self.budget:
+            key = next(iter(self.entries))
+            sha256 = self.entries[key].sha256
+            self._remove(key)
+            if all(cached.sha256 != sha256 for cached in self.entries.values()):
+                total -= sizes[sha256]
+
+    # ------------------------------------------------------------------ persistence
+
+    def load(self):
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as index:
+                data = json.load(index)
+        except (OSError, ValueError):
+            return
+        if data.get("version") != INDEX_VERSION:
+            return
+        for server, owner, filename, version, sha256, size in data["entries"]:
+            self.entries[(server, owner, filename)] = CachedFile(version, sha256, size)
+
+    def save(self):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        data = {
+            "version": INDEX_VERSION,
+            "entries": [[*key, *cached] for key, cached in self.entries.items()],
+        }
+        temp_path = self.index_path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as index:
+            json.dump(data, index, separators=(",", ":"))
+        os.replace(temp_path, self.index_path)
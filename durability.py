@@ -0,0 +1,73 @@
+"""How hard the server works to make a committed upload survive a crash.
+
+An upload is written to a staging file and renamed into the storage
+directory once complete, so nobody ever sees half a file.  What is left to
+choose is whether the bytes and the rename are on disk before the client is
+told the upload succeeded:
+
+    none   Neither is synced; the OS writes them out in its own time.  A
+           crash can lose uploads acknowledged shortly before it.
+    fsync  Each upload's file is fsynced before the rename, and the
+           directories the rename touched after it.
+    group  As fsync, but commits happening at the same time share the work:
+           syncs requested while a batch is being synced wait for the next
+           batch, which syncs its files side by side and each directory
+           only once, however many uploads landed in it.
+"""
+import asyncio
+import os
+
+DURABILITY_MODES = ("none", "fsync", "group")
+
+
+def sync_path(path):
+    """fsync a file or a directory."""
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except (IsADirectoryError, PermissionError):
+        return  # Directories can't be opened (or synced) on Windows; renames are journaled there
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class Durability:
+    def __init__(self, mode="none", loop=None):
+        if mode not in DURABILITY_MODES:
+            raise ValueError(f"Unknown durability mode: {mode}")
+        self.mode = mode
+        self.loop = loop
+        self.pending = {}  # path -> future, for the next group sync
+        self.syncing = False  # A group sync is running
+        self._sync_task = None  # Task running it; the loop keeps only a weak reference
+
+    def __bool__(self):
+        return self.mode != "none"
+
+    async def sync(self, paths):
+        """Make paths (files or directories) durable, as the mode says."""
+        if self.mode == "fsync":
+            for path in paths:
+                await self.loop.run_in_executor(None, sync_path, path)
+        elif self.mode == "group":
+            futures = [self.pending.get(path) or self.pending.setdefault(path, self.loop.create_future()) for path in paths]
+            if not self.syncing:
+                self.syncing = True
+                self._sync_task = self.loop.create_task(self._sync_groups())
+            await asyncio.gather(*futures)
+
+    async def _sync_groups(self):
+        try:
+            while self.pending:
+                group, self.pending = self.pending, {}
+                # Side by side, so the filesystem can fold them into as few journal commits as it likes.
+                results = await asyncio.gather(*(self.loop.run_in_executor(None, sync_path, path) for path in group),
+                                               return_exceptions=True)
+                for future, result in zip(group.values(), results):
+                    if isinstance(result, BaseException):
+                        future.set_exception(result)
+                    else:
+                        future.set_result(None)
+        finally:
+            self.syncing = False
@@ -0,0 +1,103 @@
+"""Per-file reader/writer locks for the server engine.
+
+Locks are keyed by stored filename ("<user>_<file>"), so a slow upload only
+holds up transfers of that same file.  Each lock lets any number of readers
+in at once but gives writers priority: once a writer is waiting, new readers
+queue behind it, so a steady stream of downloads cannot starve an upload.
+"""
+import asyncio
+import time
+from contextlib import asynccontextmanager
+
+
+class ReadWriteLock:
+    def __init__(self):
+        self.condition = asyncio.Condition()
+        self.readers = 0
+        self.writer = False
+        self.waiting_writers = 0
+        self.users = 0  # Holders plus waiters; the manager drops the lock at zero
+
+    async def acquire_read(self):
+        async with self.condition:
+            await self.condition.wait_for(lambda: not self.writer and not self.waiting_writers)
+            self.readers += 1
+
+    async def release_read(self):
+        async with self.condition:
+            self.readers -= 1
+            if not self.readers:
+                self.condition.notify_all()
+
+    async def acquire_write(self):
+        async with self.condition:
+            self.waiting_writers += 1
+            try:
+                await self.condition.wait_for(lambda: not self.writer and not self.readers)
+            finally:
+                self.waiting_writers -= 1
+                if not self.waiting_writers:
+                    self.condition.notify_all()  # A cancelled writer may have been blocking readers
+            self.writer = True
+
+    async def release_write(self):
+        async with self.condition:
+            self.writer = False
+            self.condition.notify_all()
+
+
+class FileLockManager:
+    """Hands out a ReadWriteLock per key, keeping only the ones in use.
+
+    on_wait, if given, is called with ("read" or "write", seconds) each time a
+    lock is acquired, so contention can be measured.
+    """
+
+    def __init__(self, on_wait=None):
+        self._locks = {}
+        self.on_wait = on_wait
+
+    def _checkout(self, key):
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = self._locks[key] = ReadWriteLock()
+        lock.users += 1
+        return lock
+
+    def _checkin(self, key, lock):
+        lock.users -= 1
+        if not lock.users:
+            del self._locks[key]
+
+    @asynccontextmanager
+    async def read(self, key):
+        lock = self._checkout(key)
+        try:
+            started = time.perf_counter()
+            await lock.acquire_read()
+            if self.on_wait:
+                self.on_wait("read", time.perf_counter() - started)
+            try:
+                yield
+            finally:
+                await asyncio.shield(lock.release_read())
+        finally:
+            self._checkin(key, lock)
+
+    @asynccontextmanager
+    async def write(self, key):
+        lock = self._checkout(key)
+        try:
+            started = time.perf_counter()
+            await lock.acquire_write()
+            if self.on_wait:
+                self.on_wait("write", time.perf_counter() - started)
+            try:
+                yield
+            finally:
+                await asyncio.shield(lock.release_write())
+        finally:
+            self._checkin(key, lock)
+
+    def __len__(self):
+        return len(self._locks)
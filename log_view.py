@@ -0,0 +1,87 @@
+"""Thread-safe log pane shared by the server and client GUIs.
+
+Any thread may call LogView.write(); it only appends to a queue.  The Tk
+main loop drains the queue every DRAIN_INTERVAL_MS and inserts everything
+that arrived as one block, so a burst of transfer messages costs one widget
+update instead of one per line, and worker threads never wait on a redraw.
+The pane keeps at most max_lines lines, dropping the oldest.  With a log
+file, every line is also written there (timestamped, rotated by size) from
+the same drain, so disk writes never run on a socket thread either.
+If lines arrive faster than the drain keeps up with, the queue keeps only
+the newest MAX_PENDING_LINES and the next drain says how many were dropped.
+"""
+import logging
+import logging.handlers
+import tkinter as tk
+from collections import deque
+from tkinter.scrolledtext import ScrolledText
+
+DRAIN_INTERVAL_MS = 100
+MAX_LINES = 5000  # Lines kept in the pane
+MAX_PENDING_LINES = 50000  # Lines waiting for the next drain; older ones are dropped and counted
+LOG_FILE_MAX_BYTES = 10 * 1024 * 1024
+LOG_FILE_BACKUPS = 3
+
+
+class LogView:
+    def __init__(self, root, max_lines=MAX_LINES, log_file=None, **widget_options):
+        self.root = root
+        self.max_lines = max_lines
+        self.widget = ScrolledText(root, state='disabled', **widget_options)
+        self.pending = deque(maxlen=MAX_PENDING_LINES)  # Lines not yet shown; appends and pops are thread-safe
+        self.dropped = 0  # Lines pushed out of pending since the last drain
+        self.line_count = 0
+        self.file_handler = None
+        if log_file:
+            self.file_handler = logging.handlers.RotatingFileHandler(
+                log_file, maxBytes=LOG_FILE_MAX_BYTES, backupCount=LOG_FILE_BACKUPS, encoding="utf-8")
+            self.file_handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+        self._after_id = self.root.after(DRAIN_INTERVAL_MS, self.drain)
+
+    def pack(self, **options):
+        self.widget.pack(**options)
+
+    def write(self, message):
+        """Queue a message for the pane. Safe to call from any thread."""
+        if len(self.pending) == MAX_PENDING_LINES:
+            self.dropped += 1  # Only a count for the notice; a lost increment under a race doesn't matter
+        self.pending.append(str(message))
+
+    def drain(self):
+        lines = []
+        if self.dropped:
+            dropped, self.dropped = self.dropped, 0
+            lines.append(f"[LOG] {dropped} lines dropped; they came faster than they could be shown.")
+        try:
+            while True:
+                lines.append(self.pending.popleft())
+        except IndexError:
+            pass
+        if lines:
+            if self.file_handler is not None:
+                for line in lines:
+                    self.file_handler.handle(logging.makeLogRecord({"msg": line, "levelno": logging.INFO}))
+            self.show(lines[-self.max_lines:])  # Anything before these would be trimmed right away
+        self._after_id = self.root.after(DRAIN_INTERVAL_MS, self.drain)
+
+    def show(self, lines):
+        text = "\n".join(lines) + "\n"
+        self.widget.config(state='normal')
+        self.widget.insert(tk.END, text)
+        self.line_count += text.count("\n")
+        if self.line_count > self.max_lines:
+            excess = self.line_count - self.max_lines
+            self.widget.delete("1.0", f"{excess + 1}.0")
+            self.line_count = self.max_lines
+        self.widget.see(tk.END)
+        self.widget.config(state='disabled')
+
+    def close(self):
+        """Stop draining and flush what is left, e.g. before the window is destroyed."""
+        if self._after_id is not None:
+            self.root.after_cancel(self._after_id)
+            self._after_id = None
+        if self.file_handler is not None:
+            while self.pending:
+                self.file_handler.handle(logging.makeLogRecord({"msg": self.pending.popleft(), "levelno": logging.INFO}))
+            self.file_handler.close()
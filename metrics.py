@@ -0,0 +1,221 @@
+"""Counters, gauges and latency histograms for the server engine.
+
+The engine records into one Metrics object as it handles commands and
+transfers.  It can be read two ways: snapshot() gives a summary (with
+percentiles estimated from the histogram buckets) that the [STATS] command
+sends back as JSON, and render_prometheus() gives the Prometheus text
+exposition format that the engine serves on --metrics-port.
+
+Everything is updated from the event loop thread, so nothing here locks.
+"""
+import bisect
+import json
+import time
+
+# Bucket upper bounds; the last bucket is +Inf.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+THROUGHPUT_BUCKETS = tuple(float(base * 10**power) for power in range(5, 10) for base in (1, 2.5, 5))  # Bytes/s
+PERCENTILES = (50, 90, 99)
+PREFIX = "fileserver"
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def percentile(self, percent):
+        """Estimate a percentile by interpolating within its bucket, as Prometheus' histogram_quantile does."""
+        if not self.count:
+            return None
+        rank = percent / 100 * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lower = self.buckets[index - 1] if index else 0.0
+                upper = min(self.buckets[index], self.max) if index < len(self.buckets) else self.max
+                return min(self.max, lower + (upper - lower) * (rank - seen) / count)
+            seen += count
+        return self.max
+
+    def summary(self, scale=1.0, digits=3):
+        """count, mean, percentiles and max, with values multiplied by scale (e.g. 1000 for ms)."""
+        if not self.count:
+            return {"count": 0}
+        summary = {"count": self.count, "mean": round(self.sum / self.count * scale, digits)}
+        for percent in PERCENTILES:
+            summary[f"p{percent}"] = round(self.percentile(percent) * scale, digits)
+        summary["max"] = round(self.max * scale, digits)
+        return summary
+
+    def prometheus_lines(self, name, labels):
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            cumulative += count
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            yield f"{name}_bucket{format_labels(labels, le=le)} {cumulative}"
+        yield f"{name}_sum{format_labels(labels)} {self.sum}"
+        yield f"{name}_count{format_labels(labels)} {self.count}"
+
+
+def format_labels(labels, **extra):
+    labels = {**labels, **extra}
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels.items()) + "}"
+
+
+class Metrics:
+    def __init__(self):
+        self.started = time.time()
+        self.command_latency = {}  # command -> Histogram of seconds from request to handled
+        self.transfer_duration = {}  # direction -> Histogram of seconds per transfer
+        self.transfer_throughput = {}  # direction -> Histogram of bytes/s per transfer
+        self.transfers = {}  # (direction, result) -> count
+        self.transfer_bytes = {}  # direction -> bytes moved
+        self.active_transfers = {}  # direction -> transfers in progress
+        self.lock_wait = {}  # "read" or "write" -> Histogram of seconds waited for a file lock
+        self.queue_wait = Histogram()  # Seconds transfers waited for a slot from the scheduler
+        self.commit_sync = Histogram()  # Seconds a commit waited for its data to reach the disk
+        self.errors = {}  # kind -> count
+        self.connections = 0  # Open connections on the server port (control and data channels)
+        self.gauges = {}  # name -> (kind, help, callable), for values the engine already tracks
+
+    # ------------------------------------------------------------------ recording
+
+    def observe_command(self, command, seconds):
+        self.command_latency.setdefault(command, Histogram()).observe(seconds)
+
+    def observe_lock_wait(self, mode, seconds):
+        self.lock_wait.setdefault(mode, Histogram()).observe(seconds)
+
+    def observe_queue_wait(self, seconds):
+        self.queue_wait.observe(seconds)
+
+    def observe_commit_sync(self, seconds):
+        self.commit_sync.observe(seconds)
+
+    def count_error(self, kind):
+        self.errors[kind] = self.errors.get(kind, 0) + 1
+
+    def add_gauge(self, name, help_text, read, kind="gauge"):
+        """Report read() as name; kind="counter" for totals that only go up."""
+        self.gauges[name] = (kind, help_text, read)
+
+    def transfer(self, direction):
+        """Track one transfer: `with metrics.transfer("upload") as transfer: ... transfer.done(n)`."""
+        return TransferTimer(self, direction)
+
+    def _transfer_finished(self, direction, seconds, count, ok):
+        key = (direction, "ok" if ok else "failed")
+        self.transfers[key] = self.transfers.get(key, 0) + 1
+        self.transfer_bytes[direction] = self.transfer_bytes.get(direction, 0) + count
+        self.transfer_duration.setdefault(direction, Histogram()).observe(seconds)
+        if ok and count and seconds > 0:
+            self.transfer_throughput.setdefault(direction, Histogram(THROUGHPUT_BUCKETS)).observe(count / seconds)
+
+    # ------------------------------------------------------------------ reading
+
+    def snapshot(self):
+        transfers = {}
+        for direction in sorted(set(self.transfer_bytes) | set(self.active_transfers)):
+            throughput = self.transfer_throughput.get(direction, Histogram(THROUGHPUT_BUCKETS))
+            transfers[direction] = {
+                "active": self.active_transfers.get(direction, 0),
+                "ok": self.transfers.get((direction, "ok"), 0),
+                "failed": self.transfers.get((direction, "failed"), 0),
+                "bytes": self.transfer_bytes.get(direction, 0),
+                "duration_ms": self.transfer_duration.get(direction, Histogram()).summary(1000),
+                "throughput_mb_s": throughput.summary(1 / 2**20, 2),
+            }
+        return {
+            "uptime_s": round(time.time() - self.started, 1),
+            "connections": self.connections,
+            **{name: read() for name, (_, _, read) in self.gauges.items()},
+            "commands_ms": {command: histogram.summary(1000) for command, histogram in sorted(self.command_latency.items())},
+            "transfers": transfers,
+            "lock_wait_ms": {mode: histogram.summary(1000) for mode, histogram in sorted(self.lock_wait.items())},
+            "queue_wait_ms": self.queue_wait.summary(1000),
+            "commit_sync_ms": self.commit_sync.summary(1000),
+            "errors": dict(sorted(self.errors.items())),
+        }
+
+    def to_json(self):
+        return json.dumps(self.snapshot(), separators=(",", ":"))
+
+    def render_prometheus(self):
+        lines = []
+
+        def metric(name, kind, help_text):
+            lines.append(f"# HELP {PREFIX}_{name} {help_text}")
+            lines.append(f"# TYPE {PREFIX}_{name} {kind}")
+            return f"{PREFIX}_{name}"
+
+        name = metric("uptime_seconds", "gauge", "Seconds since the server started.")
+        lines.append(f"{name} {time.time() - self.started:.1f}")
+        name = metric("connections", "gauge", "Open connections on the server port (control and data channels).")
+        lines.append(f"{name} {self.connections}")
+        for gauge, (kind, help_text, read) in self.gauges.items():
+            name = metric(gauge, kind, help_text)
+            lines.append(f"{name} {read()}")
+        name = metric("active_transfers", "gauge", "Transfers in progress.")
+        for direction, count in sorted(self.active_transfers.items()):
+            lines.append(f"{name}{format_labels({'direction': direction})} {count}")
+        name = metric("transfers_total", "counter", "Finished transfers.")
+        for (direction, result), count in sorted(self.transfers.items()):
+            lines.append(f"{name}{format_labels({'direction': direction, 'result': result})} {count}")
+        name = metric("transfer_bytes_total", "counter", "File bytes moved by transfers.")
+        for direction, count in sorted(self.transfer_bytes.items()):
+            lines.append(f"{name}{format_labels({'direction': direction})} {count}")
+        for histograms, metric_name, help_text, label in (
+                (self.command_latency, "command_duration_seconds", "Time to handle a control command.", "command"),
+                (self.transfer_duration, "transfer_duration_seconds", "Time taken by a transfer.", "direction"),
+                (self.transfer_throughput, "transfer_throughput_bytes_per_second", "Throughput of a transfer.", "direction"),
+                (self.lock_wait, "lock_wait_seconds", "Time spent waiting for a file lock.", "mode")):
+            name = metric(metric_name, "histogram", help_text)
+            for key, histogram in sorted(histograms.items()):
+                lines.extend(histogram.prometheus_lines(name, {label: key}))
+        name = metric("transfer_queue_wait_seconds", "histogram", "Time a transfer waited for a free transfer slot.")
+        lines.extend(self.queue_wait.prometheus_lines(name, {}))
+        name = metric("commit_sync_seconds", "histogram", "Time a commit spent syncing uploaded data to disk.")
+        lines.extend(self.commit_sync.prometheus_lines(name, {}))
+        name = metric("errors_total", "counter", "Errors by kind.")
+        for kind, count in sorted(self.errors.items()):
+            lines.append(f"{name}{format_labels({'kind': kind})} {count}")
+        return "\n".join(lines) + "\n"
+
+
+class TransferTimer:
+    """Counts a transfer as active while in the with block and records it on the way out.
+
+    The transfer counts as failed unless done() is called with the bytes moved.
+    """
+
+    def __init__(self, metrics, direction):
+        self.metrics = metrics
+        self.direction = direction
+        self.count = 0
+        self.ok = False
+
+    def done(self, count, ok=True):
+        self.count = count
+        self.ok = ok
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        active = self.metrics.active_transfers
+        active[self.direction] = active.get(self.direction, 0) + 1
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.active_transfers[self.direction] -= 1
+        self.metrics._transfer_finished(self.direction, time.perf_counter() - self.started, self.count, self.ok)
@@ -0,0 +1,130 @@
+"""Wire format shared by the client and the server.
+
+Control messages are a 4-byte big-endian length followed by a UTF-8 payload
+such as "[UPLOAD]|[notes.txt]|[1024]".  The first fields of a command are
+positional; any fields after them are "key=value" options, e.g.
+"[DOWNLOAD]|[notes.txt]|[alice]|[stream=3]".  Old peers ignore the options
+they don't know about.
+
+Clients and servers that both speak protocol 2 switch the control connection
+to binary framing right after logging in: the server lists protocol=2 in its
+[DATA_CHANNEL] reply, the client sends "[PROTOCOL]|[2]", and the server's
+"[PROTOCOL]|[2]" answer is the last text-framed message either way.  From
+then on each control message is
+
+    length (4 bytes) | opcode (1 byte) | request_id (4 bytes) | payload
+
+where the opcode stands for the message's leading [TAG] and the payload is
+the rest of the message.  The server puts the request ID of a command on
+every reply it sends for it (0 on notifications), so a client with several
+operations in flight knows which one each reply answers.
+
+File bytes either go over a short-lived data port per transfer (the original
+scheme) or over a long-lived data channel shared by every transfer of a
+client.  A data channel carries frames tagged with a stream ID:
+
+    stream_id (4 bytes) | flags (1 byte) | length (4 bytes) | payload
+
+DATA frames of a compressed stream also carry FRAME_COMPRESSED (see
+compression.py).
+
+Batch commands ([BATCH_UPLOAD], [BATCH_DOWNLOAD], [BATCH_DELETE]) put one
+file per line after the command line, e.g.
+
+    [BATCH_UPLOAD]|[stream=4]|[channel=1]
+    [a.txt]|[120]
+    [b.txt]|[4096]
+
+and move all of the files' bytes over a single stream.  A batch upload stream
+is the files back to back, in the order listed; a batch download stream puts
+a BATCH_FILE_HEADER with each file's size (BATCH_MISSING if it could not be
+sent) in front of each one.
+"""
+import struct
+
+PROTOCOL_VERSION = 2  # Highest control protocol spoken here; 1 is length-prefixed text
+CONTROL_HEADER = struct.Struct("!IBI")  # Protocol 2: payload length, opcode, request ID
+OPCODE_TEXT = 0  # Message without a tag in OPCODES; the payload is all of it
+# Opcode n stands for OPCODES[n - 1].  Only ever append to this.
+OPCODES = ("UPLOAD", "DOWNLOAD", "LIST_FILES", "DELETE", "DISCONNECT", "DATA_CHANNEL", "BATCH_UPLOAD",
+           "BATCH_DOWNLOAD", "BATCH_DELETE", "STATS", "PROTOCOL", "ERROR", "NOTIFICATION", "DOWNLOADS", "SIGNATURES",
+           "SUBSCRIBE", "CATALOG")
+OPCODE_BY_TAG = {f"[{tag}]": opcode for opcode, tag in enumerate(OPCODES, 1)}
+
+FRAME_HEADER = struct.Struct("!IBI")
+FRAME_DATA = 0
+FRAME_END = 1  # Last frame of a stream; no payload
+FRAME_ABORT = 2  # Sender gave up on the stream; no payload
+FRAME_COMPRESSED = 4  # Flag on DATA frames whose payload is part of a compressed stream
+MAX_FRAME_PAYLOAD = 256 * 1024
+
+BATCH_FILE_HEADER = struct.Struct("!Q")
+BATCH_MISSING = 2 ** 64 - 1
+
+
+def encode_message(message):
+    payload = message.encode()
+    return len(payload).to_bytes(4, byteorder="big") + payload
+
+
+def encode_control(message, request_id=0):
+    """A control message framed for protocol 2, ready for a single write."""
+    tag, sep, rest = message.partition("]")
+    opcode = OPCODE_BY_TAG.get(tag + sep)
+    if opcode is None:
+        opcode, rest = OPCODE_TEXT, message
+    payload = rest.encode()
+    return CONTROL_HEADER.pack(len(payload), opcode, request_id) + payload
+
+
+def decode_control(opcode, payload):
+    """The text of a protocol 2 message. Raises ValueError for an unknown opcode."""
+    text = payload.decode()
+    if opcode == OPCODE_TEXT:
+        return text
+    if opcode > len(OPCODES):
+        raise ValueError(f"Unknown opcode {opcode}")
+    return f"[{OPCODES[opcode - 1]}]" + text
+
+
+def format_command(name, *fields, **options):
+    parts = [f"[{name}]"]
+    parts.extend(f"[{field}]" for field in fields)
+    parts.extend(f"[{key}={value}]" for key, value in options.items() if value is not None)
+    return "|".join(parts)
+
+
+def parse_command(command, positional):
+    """Split a command into its positional fields and its key=value options.
+
+    Raises ValueError if fewer than positional fields are present.
+    """
+    parts = command.split("|")
+    fields = [part.strip("[] ") for part in parts[1:1 + positional]]
+    if len(fields) < positional:
+        raise ValueError(f"Malformed command: {command!r}")
+    options = {}
+    for part in parts[1 + positional:]:
+        key, sep, value = part.strip("[] ").partition("=")
+        if sep:
+            options[key] = value
+    return fields, options
+
+
+def format_batch(command, entries):
+    """A command line followed by one line per entry, each a sequence of fields."""
+    return "\n".join([command] + ["|".join(f"[{field}]" for field in entry) for entry in entries])
+
+
+def parse_batch(message):
+    """Split a batch message into its command line and the fields of each entry line."""
+    command, *lines = message.split("\n")
+    return command, [[field.strip("[] ") for field in line.split("|")] for line in lines if line]
+
+
+def encode_frame_header(stream_id, flags, length=0):
+    return FRAME_HEADER.pack(stream_id, flags, length)
+
+
+def decode_frame_header(header):
+    return FRAME_HEADER.unpack(header)
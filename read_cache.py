@@ -0,0 +1,75 @@
+"""In-memory cache of the content of frequently downloaded files.
+
+Downloads of a cached file are sent straight from memory: no open, no disk
+read and, for files kept compressed on disk, no decompression.  The cache
+holds at most budget bytes and evicts the least recently used files first.
+A file is only loaded once it has been asked for admit_after times, so a
+single download of a large file cannot flush the files that are actually
+hot, and no file larger than max_entry is cached at all.
+
+Entries are keyed by (owner, filename) and remember the catalog entry they
+were loaded for; the engine invalidates them when a file is replaced or
+deleted, and a lookup with a different catalog entry is a miss anyway.
+"""
+from collections import OrderedDict
+
+ADMIT_AFTER = 2  # Requests for a file before it is worth caching
+MAX_TRACKED = 10000  # Files whose request counts are kept; the counts start over beyond this
+
+
+class ReadCache:
+    def __init__(self, budget, max_entry=None, admit_after=ADMIT_AFTER):
+        self.budget = budget
+        self.max_entry = budget // 4 if max_entry is None else max_entry
+        self.admit_after = admit_after
+        self.entries = OrderedDict()  # key -> (version, content), least recently used first
+        self.size = 0  # Bytes of content held
+        self.requests = {}  # key -> requests so far, for files not cached
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, version):
+        """The cached content of key if it was loaded for this version, else None."""
+        cached = self.entries.get(key)
+        if cached is not None and cached[0] == version:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return cached[1]
+        if cached is not None:
+            self.invalidate(key)  # Stale
+        self.misses += 1
+        return None
+
+    def admit(self, key, size):
+        """Count a request for an uncached file; True once it should be loaded."""
+        if not self.budget or size > self.max_entry:
+            return False
+        count = self.requests.get(key, 0) + 1
+        if count >= self.admit_after:
+            self.requests.pop(key, None)
+            return True
+        if len(self.requests) >= MAX_TRACKED:
+            self.requests.clear()
+        self.requests[key] = count
+        return False
+
+    def put(self, key, version, content):
+        self.invalidate(key)
+        if len(content) > self.max_entry:
+            return
+        while self.entries and self.size + len(content) > self.budget:
+            _, (_, evicted) = self.entries.popitem(last=False)
+            self.size -= len(evicted)
+            self.evictions += 1
+        self.entries[key] = (version, content)
+        self.size += len(content)
+
+    def invalidate(self, key):
+        cached = self.entries.pop(key, None)
+        if cached is not None:
+            self.size -= len(cached[1])
+        self.requests.pop(key, None)
@@ -0,0 +1,144 @@
+"""Admission control and bandwidth limits for transfers.
+
+TransferScheduler caps how many transfers run at once, overall and per
+user.  A transfer over the cap waits in a queue, first come first served,
+except that a user already at their own cap is skipped so other users'
+transfers can go ahead.  While it waits, its on_queued callback hears its
+position now and then, so the client can be told.
+
+Throttle paces one user's transfer bytes against token buckets: the user's
+own and, if set, one shared by everybody.  Transfers await wait(count)
+after moving each chunk; a chunk bigger than what a bucket holds still goes
+through, and the bucket's debt is paid off by waiting longer.
+"""
+import asyncio
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+
+MAX_TRANSFERS = 64  # Transfers running at once; the rest queue
+MAX_TRANSFERS_PER_USER = 8  # Transfers one user may run at once (parallel ranges count separately)
+POSITION_INTERVAL = 1  # Seconds between queue position updates to a waiting client
+
+
+class TokenBucket:
+    def __init__(self, rate, burst=None):
+        self.rate = rate  # Bytes per second
+        self.capacity = burst or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def take(self, count):
+        """Take count bytes' worth of tokens; returns the seconds to wait before using them."""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= count
+        return -self.tokens / self.rate if self.tokens < 0 else 0
+
+
+class Throttle:
+    """The buckets one user's transfers draw from. False if there are none."""
+
+    def __init__(self, *buckets):
+        self.buckets = [bucket for bucket in buckets if bucket is not None]
+
+    def __bool__(self):
+        return bool(self.buckets)
+
+    async def wait(self, count):
+        delay = max(bucket.take(count) for bucket in self.buckets)
+        if delay:
+            await asyncio.sleep(delay)
+
+
+class Waiter:
+    def __init__(self, user, loop):
+        self.user = user
+        self.admitted = loop.create_future()
+
+
+class TransferScheduler:
+    def __init__(self, max_transfers=MAX_TRANSFERS, max_per_user=MAX_TRANSFERS_PER_USER,
+                 user_rate=None, total_rate=None):
+        self.max_transfers = max_transfers
+        self.max_per_user = max_per_user
+        self.user_rate = user_rate  # Bytes/s per user, if limited
+        self.total_bucket = TokenBucket(total_rate) if total_rate else None
+        self.active = 0
+        self.active_by_user = {}  # user -> transfers running
+        self.queue = deque()  # Waiters, oldest first
+
+    def throttle(self):
+        """A new Throttle for one user's transfers."""
+        return Throttle(TokenBucket(self.user_rate) if self.user_rate else None, self.total_bucket)
+
+    def _can_start(self, user):
+        return self.active < self.max_transfers and self.active_by_user.get(user, 0) < self.max_per_user
+
+    def _start(self, user):
+        self.active += 1
+        self.active_by_user[user] = self.active_by_user.get(user, 0) + 1
+
+    def _finish(self, user):
+        self.active -= 1
+        count = self.active_by_user[user] - 1
+        if count:
+            self.active_by_user[user] = count
+        else:
+            del self.active_by_user[user]
+        self._admit_waiting()
+
+    def _admit_waiting(self):
+        skipped = set()  # Users at their own cap; their later waiters can't start either
+        for waiter in list(self.queue):
+            if self.active >= self.max_transfers:
+                break
+            if waiter.user in skipped:
+                continue
+            if self._can_start(waiter.user):
+                self.queue.remove(waiter)
+                self._start(waiter.user)
+                waiter.admitted.set_result(None)
+            else:
+                skipped.add(waiter.user)
+
+    def position(self, waiter):
+        return self.queue.index(waiter) + 1
+
+    @asynccontextmanager
+    async def slot(self, user, on_queued=None):
+        """Hold one transfer slot while in the block, waiting in the queue for it if needed.
+
+        on_queued, if given, is awaited with the queue position when the
+        transfer starts waiting and every POSITION_INTERVAL while the
+        position keeps changing.
+        """
+        waiter = Waiter(user, asyncio.get_running_loop())
+        self.queue.append(waiter)
+        self._admit_waiting()  # Starts it right away if nothing ahead of it can use the slot
+        reported = None
+        try:
+            while not waiter.admitted.done():
+                position = self.position(waiter)
+                if on_queued is not None and position != reported:
+                    await on_queued(position)
+                    reported = position
+                try:
+                    await asyncio.wait_for(asyncio.shield(waiter.admitted), POSITION_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+        except BaseException:
+            if waiter.admitted.done():
+                self._finish(user)  # Admitted just as we gave up; pass the slot on
+            else:
+                self.queue.remove(waiter)
+            raise
+        try:
+            yield
+        finally:
+            self._finish(user)
+
+    def __len__(self):
+        """Transfers waiting for a slot."""
+        return len(self.queue)
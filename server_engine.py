@@ -0,0 +1,1866 @@
+"""Headless asyncio core of the file server.
+
+The engine speaks the same length-prefixed text protocol as the original
+thread-per-connection server ([UPLOAD], [DOWNLOAD], [LIST_FILES], [DELETE],
+[DISCONNECT]) but serves every control and data connection from a single
+event loop, so thousands of idle clients cost a socket and a coroutine each
+instead of an OS thread.  ServerGUI is only an optional frontend on top of it;
+run this module directly to start the server without Tkinter.
+
+File bytes travel either over a data port opened for one transfer (what the
+original clients expect) or, when the client asks for it, over long-lived
+data channels that multiplex many transfers as framed streams (see
+protocol.py).  Streams may be compressed, and files may be kept compressed
+on disk (see compression.py).  Files that are downloaded again and again are
+served from memory (see read_cache.py).  A client re-uploading a file it
+changed can send just the changes ([SIGNATURES], then [UPLOAD] with
+delta=N; see delta.py).  Clients that [SUBSCRIBE] are pushed catalog
+changes as they happen instead of listing the files over and over.
+
+Commands, transfers and lock waits are measured (see metrics.py); [STATS]
+returns a summary and --metrics-port serves them to Prometheus.
+
+With --workers N the server runs as N worker processes behind a master that
+hands them the connections (see cluster.py); each worker is a ServerEngine
+started with the link to the master.
+"""
+import argparse
+import asyncio
+import contextlib
+import contextvars
+import errno
+import inspect
+import itertools
+import os
+import secrets
+import signal
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+from catalog import Catalog, file_version, stored_name, valid_filename
+from cluster import Cluster, Link, SharedFileLocks, supported as cluster_supported
+from compression import (CONTAINER_CODECS, CONTAINER_HEADER, DecompressingSink, available_codecs,
+                         compress_chunks, compress_file, compress_into, data_compresses, make_compressor, read_chunks,
+                         read_container_header, sample_compresses, stored_chunks)
+from delta import apply_delta, block_size_for, file_signatures
+from durability import DURABILITY_MODES, Durability
+from file_locks import FileLockManager
+from metrics import Metrics
+from protocol import (BATCH_FILE_HEADER, BATCH_MISSING, CONTROL_HEADER, FRAME_ABORT, FRAME_COMPRESSED, FRAME_DATA,
+                      FRAME_END, FRAME_HEADER, MAX_FRAME_PAYLOAD, PROTOCOL_VERSION, decode_control, decode_frame_header,
+                      encode_control, encode_frame_header, encode_message, format_batch, format_command, parse_batch,
+                      parse_command)
+from read_cache import ReadCache
+from scheduler import MAX_TRANSFERS, MAX_TRANSFERS_PER_USER, Throttle, TransferScheduler
+from staging import StagingArea
+from storage import BLOB_DIR, STORAGE_BACKENDS, STORAGE_LAYOUTS, file_digest
+
+HOST = "0.0.0.0"
+DATA_PORT_BASE = 5000  # Base port for data connections
+DATA_ACCEPT_TIMEOUT = 60  # Seconds a data port waits for the client to connect
+LISTEN_BACKLOG = 1024
+CHUNK_SIZE = 256 * 1024  # Receive buffer size per transfer
+READ_CACHE_SIZE = 128 * 1024 * 1024  # Bytes of popular files kept in memory for downloads
+NOTIFICATION_INTERVAL = 1  # Seconds between a client's notification messages; downloads meanwhile are summed up
+MAX_PENDING_NOTIFICATIONS = 1000  # Files with undelivered notifications per client; the rest are only counted
+NOTIFICATION_NAMES = 3  # Downloaders named in a summary
+CATALOG_FEED_INTERVAL = 0.2  # Seconds between a subscriber's [CATALOG] messages; changes meanwhile are batched
+CATALOG_BATCH = 1000  # Changes per [CATALOG] message
+MAX_LIST_PAGE = 10000  # Files per page of a paginated [LIST_FILES]
+MIGRATION_LOG_INTERVAL = 10000  # Files moved between progress lines while migrating to another layout
+METRICS_HOST = "127.0.0.1"  # The metrics endpoint is for local scrapers only
+METRICS_REQUEST_TIMEOUT = 5  # Seconds a metrics scraper gets to send its request
+# Commands timed by name; anything else is counted as OTHER.
+COMMANDS = ("UPLOAD", "DOWNLOAD", "DATA_CHANNEL", "LIST_FILES", "DELETE", "BATCH_UPLOAD", "BATCH_DOWNLOAD",
+            "BATCH_DELETE", "STATS", "PROTOCOL", "SIGNATURES", "SUBSCRIBE")
+
+# Request ID of the protocol 2 command being handled.  Set when a command is
+# read; the tasks spawned to handle it inherit it, so their replies carry it.
+current_request = contextvars.ContextVar("current_request", default=0)
+
+
+async def run_iterator(loop, iterator):
+    """Step a blocking iterator (file reads, compression) on the default executor."""
+    while (item := await loop.run_in_executor(None, next, iterator, None)) is not None:
+        yield item
+
+
+class Connection:
+    """Non-blocking socket driven by the event loop's sock_* primitives."""
+
+    def __init__(self, sock, loop):
+        sock.setblocking(False)
+        if sock.family in (socket.AF_INET, socket.AF_INET6):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # Commands are small; don't hold them back
+        self.sock = sock
+        self.loop = loop
+        self.send_lock = asyncio.Lock()  # Keeps concurrent writers from interleaving
+        self.protocol = 1  # Control message framing; see protocol.py
+
+    async def recv_into(self, view):
+        return await self.loop.sock_recv_into(self.sock, view)
+
+    async def recv_exactly(self, size):
+        """Read exactly size bytes, or return None if the peer closed first."""
+        buffer = bytearray(size)
+        view = memoryview(buffer)
+        received = 0
+        while received < size:
+            count = await self.loop.sock_recv_into(self.sock, view[received:])
+            if not count:
+                return None
+            received += count
+        return bytes(buffer)
+
+    async def sendall(self, data):
+        async with self.send_lock:
+            await self.loop.sock_sendall(self.sock, data)
+
+    async def sendfile(self, file, offset, count, header=b""):
+        """Send header, then count bytes of file straight from the page cache."""
+        async with self.send_lock:
+            if header:
+                await self.loop.sock_sendall(self.sock, header)
+            await self.loop.sock_sendfile(self.sock, file, offset, count)
+
+    async def send_message(self, message, request_id=None):
+        """Send a control message; under protocol 2 it answers request_id (default: the current request)."""
+        async with self.send_lock:
+            if self.protocol == 1:
+                data = encode_message(message)
+            else:
+                data = encode_control(message, current_request.get() if request_id is None else request_id)
+            await self.loop.sock_sendall(self.sock, data)
+
+    async def switch_protocol(self, version):
+        """Confirm a protocol switch in the old framing and use the new one for everything after it."""
+        async with self.send_lock:
+            await self.loop.sock_sendall(self.sock, encode_message(format_command("PROTOCOL", version)))
+            self.protocol = version
+
+    async def receive_message(self):
+        if self.protocol == 1:
+            message_length_bytes = await self.recv_exactly(4)
+            if not message_length_bytes:
+                return None
+            message = await self.recv_exactly(int.from_bytes(message_length_bytes, byteorder="big"))
+            return None if message is None else message.decode()
+        header = await self.recv_exactly(CONTROL_HEADER.size)
+        if header is None:
+            return None
+        length, opcode, request_id = CONTROL_HEADER.unpack(header)
+        payload = await self.recv_exactly(length)
+        if payload is None:
+            return None
+        current_request.set(request_id)
+        return decode_control(opcode, payload)
+
+    def close(self):
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+
+class NotificationQueue:
+    """Download notifications waiting to be sent to one client.
+
+    Downloads only add to the queue; run() is the client's own writer task,
+    so a client that reads slowly (or not at all) holds up nobody but
+    itself.  The writer sends at most one message per NOTIFICATION_INTERVAL
+    for each file; downloads of a file in between are summed up into one
+    "downloaded N times" message.  At most max_files files are queued, and
+    downloads of any further files are only counted.
+    """
+
+    def __init__(self, connection, log=print, max_files=MAX_PENDING_NOTIFICATIONS):
+        self.connection = connection
+        self.log = log
+        self.max_files = max_files
+        self.pending = {}  # filename -> [downloads, first NOTIFICATION_NAMES downloaders, whether there were more]
+        self.overflow = 0  # Downloads of files that didn't fit in pending
+        self.ready = asyncio.Event()
+
+    def __len__(self):
+        return len(self.pending)
+
+    def add(self, filename, downloader):
+        entry = self.pending.get(filename)
+        if entry is None:
+            if len(self.pending) >= self.max_files:
+                self.overflow += 1
+                self.ready.set()
+                return
+            entry = self.pending[filename] = [0, [], False]
+        entry[0] += 1
+        if downloader not in entry[1]:
+            if len(entry[1]) < NOTIFICATION_NAMES:
+                entry[1].append(downloader)
+            else:
+                entry[2] = True
+        self.ready.set()
+
+    def messages(self):
+        """Take everything pending, as the messages to send."""
+        pending, overflow = self.pending, self.overflow
+        self.pending, self.overflow = {}, 0
+        self.ready.clear()
+        for filename, (count, downloaders, more) in pending.items():
+            if count == 1:
+                yield f"[NOTIFICATION]: Your file '{filename}' was downloaded by {downloaders[0]}."
+            else:
+                others = " and others" if more else ""
+                yield f"[NOTIFICATION]: Your file '{filename}' was downloaded {count} times by {', '.join(downloaders)}{others}."
+        if overflow:
+            yield f"[NOTIFICATION]: Your files were downloaded {overflow} more times."
+
+    async def run(self):
+        while True:
+            await self.ready.wait()
+            for message in self.messages():
+                try:
+                    await self.connection.send_message(message, request_id=0)
+                except OSError as e:
+                    self.log(f"[ERROR] Failed to send notification: {e}")
+                    return  # The client's own connection handler notices the broken socket
+            await asyncio.sleep(NOTIFICATION_INTERVAL)
+
+
+class CatalogFeed:
+    """Pushes catalog changes to one client that subscribed to them.
+
+    The changes themselves stay in the catalog's log; the feed only keeps
+    the sequence number the client has been sent up to.  run() is the
+    client's writer task, like NotificationQueue's: once woken it sends
+    everything that changed since, CATALOG_BATCH changes per [CATALOG]
+    message, then rests for CATALOG_FEED_INTERVAL so a burst of uploads
+    costs a few messages.  A client that falls so far behind that the log
+    no longer has its changes is sent reset=1 and has to list the files
+    again.
+    """
+
+    def __init__(self, connection, catalog, sequence, log=print):
+        self.connection = connection
+        self.catalog = catalog
+        self.sequence = sequence  # Latest change the client has been sent
+        self.log = log
+        self.ready = asyncio.Event()
+        self.ready.set()  # Catch up on anything after sequence first
+
+    def wake(self):
+        self.ready.set()
+
+    def messages(self):
+        """The [CATALOG] messages for everything that changed since the last ones."""
+        self.ready.clear()
+        catalog = self.catalog
+        changes = catalog.changes_since(self.sequence)
+        if changes is None:
+            self.sequence = catalog.sequence
+            yield format_command("CATALOG", epoch=catalog.epoch, seq=self.sequence, reset=1)
+            return
+        for start in range(0, len(changes), CATALOG_BATCH):
+            batch = changes[start:start + CATALOG_BATCH]
+            self.sequence = batch[-1].sequence
+            # The changes of a batch are numbered consecutively, up to seq.
+            yield format_batch(format_command("CATALOG", epoch=catalog.epoch, seq=self.sequence),
+                               [(change.kind, change.filename, change.owner) + ((change.size,) if change.size is not None else ())
+                                for change in batch])
+
+    async def run(self):
+        while True:
+            await self.ready.wait()
+            for message in self.messages():
+                try:
+                    await self.connection.send_message(message, request_id=0)
+                except OSError as e:
+                    self.log(f"[ERROR] Failed to send catalog changes: {e}")
+                    return  # The client's own connection handler notices the broken socket
+            await asyncio.sleep(CATALOG_FEED_INTERVAL)
+
+
+class ClientSession:
+    """An authenticated client: its control connection, data channels, notification queue and catalog feed."""
+
+    def __init__(self, username, connection, log=print, throttle=None):
+        self.username = username
+        self.connection = connection
+        self.throttle = throttle or Throttle()  # Bandwidth limits for this client's transfers
+        self.token = secrets.token_hex(16)  # Lets extra connections attach as data channels
+        self.data_channels = {}  # channel id -> DataChannel
+        self._next_channel_id = 1
+        self.notifications = NotificationQueue(connection, log)
+        self.notifier = None  # Task running self.notifications
+        self.feed = None  # CatalogFeed, once the client subscribes
+        self.feed_task = None
+
+    def add_data_channel(self, connection, chunk_size=CHUNK_SIZE):
+        channel = DataChannel(self, connection, self._next_channel_id, chunk_size)
+        self.data_channels[channel.channel_id] = channel
+        self._next_channel_id += 1
+        return channel
+
+    def get_data_channel(self, channel_id=None):
+        if channel_id is None:
+            return next(iter(self.data_channels.values()), None)
+        return self.data_channels.get(int(channel_id))
+
+    def close(self):
+        if self.notifier is not None:
+            self.notifier.cancel()
+        if self.feed_task is not None:
+            self.feed_task.cancel()
+        for channel in list(self.data_channels.values()):
+            channel.close()
+
+
+class UploadOverrun(Exception):
+    """An upload stream carried more bytes than the upload declared."""
+
+
+class UploadSink:
+    """Receives the frames of one upload stream into an open file, up to the declared length.
+
+    write() runs on the default executor (see DataChannel.read_frames), the rest on the event loop.
+    """
+
+    def __init__(self, file, loop, length):
+        self.file = file
+        self.loop = loop
+        self.remaining = length
+        self.bytes_received = 0
+        self.overrun = False
+        self.done = loop.create_future()  # True once END arrives, False on ABORT or overrun
+
+    def write(self, data):
+        if self.overrun or self.done.done():
+            return  # Aborted; the rest of the stream is dropped
+        if len(data) > self.remaining:
+            self.overrun = True
+            self.loop.call_soon_threadsafe(self.finish, False)
+            return
+        self.file.write(data)
+        self.bytes_received += len(data)
+        self.remaining -= len(data)
+
+    def finish(self, completed):
+        if not self.done.done():
+            self.done.set_result(completed)
+
+
+class BatchUploadSink:
+    """Splits the stream of a batch upload into its files, in the order they were listed.
+
+    Like UploadSink, write() runs on the default executor.
+    """
+
+    def __init__(self, staged_files, loop):
+        self.staged_files = staged_files  # [(filename, StagedUpload)]
+        self.files_received = 0  # Leading files that arrived in full
+        self.file = None
+        self.written = 0  # Bytes of the current file so far
+        self.done = loop.create_future()  # True once END arrives, False on ABORT
+        self._skip_finished()
+
+    def write(self, data):
+        view = memoryview(data)
+        while view and self.files_received < len(self.staged_files):
+            staged = self.staged_files[self.files_received][1]
+            if self.file is None:
+                self.file = staged.open()
+            count = min(len(view), staged.size - self.written)
+            self.file.write(view[:count])
+            self.written += count
+            view = view[count:]
+            self._skip_finished()
+        # Bytes past the last listed file are dropped.
+
+    def _skip_finished(self):
+        """Close every file that is complete, including empty ones that need no data."""
+        while self.files_received < len(self.staged_files):
+            staged = self.staged_files[self.files_received][1]
+            if self.written < staged.size:
+                break
+            if self.file is None:
+                self.file = staged.open()
+            self.file.close()
+            self.file = None
+            self.written = 0
+            self.files_received += 1
+
+    def finish(self, completed):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        if not self.done.done():
+            self.done.set_result(completed)
+
+
+class DataChannel:
+    """A long-lived data connection carrying the framed streams of one client."""
+
+    def __init__(self, session, connection, channel_id, chunk_size=CHUNK_SIZE):
+        self.session = session
+        self.connection = connection
+        self.channel_id = channel_id
+        self.chunk_size = chunk_size
+        self.streams = {}  # stream id -> UploadSink
+        self.reader_task = None
+
+    async def read_frames(self):
+        self.reader_task = asyncio.current_task()
+        # One buffer per channel, reused for every frame: payloads are handed to
+        # the sink without a copy, and the sink writes them out (decompressing
+        # them first, if need be) on the default executor, so the disk never
+        # stalls the event loop.  The buffer is filled before each write, so
+        # there is one hop to the executor per buffer, and the next read
+        # waits for the write.
+        loop = asyncio.get_running_loop()
+        buffer = memoryview(bytearray(self.chunk_size))
+        throttle = self.session.throttle
+        try:
+            while True:
+                header = await self.connection.recv_exactly(FRAME_HEADER.size)
+                if header is None:
+                    break
+                stream_id, flags, length = decode_frame_header(header)
+                sink = self.streams.get(stream_id)  # None: aborted or never opened, drop its bytes
+                if sink is not None:
+                    # Only streams that negotiated a codec accept compressed frames; on any
+                    # other the sender is broken, so that stream (only) is aborted.
+                    write = getattr(sink, "write_compressed", None) if flags & FRAME_COMPRESSED else sink.write
+                    if write is None:
+                        del self.streams[stream_id]
+                        sink.finish(False)
+                        sink = None
+                while length:
+                    count = min(length, len(buffer))
+                    filled = 0
+                    while filled < count:
+                        received = await self.connection.recv_into(buffer[filled:count])
+                        if not received:
+                            return
+                        filled += received
+                    if sink is not None:
+                        await loop.run_in_executor(None, write, buffer[:count])
+                    length -= count
+                    if throttle:
+                        await throttle.wait(count)
+                if sink is not None and flags in (FRAME_END, FRAME_ABORT):
+                    sink.finish(flags == FRAME_END)
+        finally:
+            for sink in self.streams.values():
+                sink.finish(False)
+            self.close()
+
+    async def send_frame(self, stream_id, flags, payload=b""):
+        await self.connection.sendall(encode_frame_header(stream_id, flags, len(payload)) + payload)
+        if payload and self.session.throttle:
+            await self.session.throttle.wait(len(payload))
+
+    async def send_data(self, stream_id, data, compressed=False):
+        """Send data as DATA frames of at most MAX_FRAME_PAYLOAD bytes."""
+        flags = FRAME_DATA | FRAME_COMPRESSED if compressed else FRAME_DATA
+        view = memoryview(data)
+        for start in range(0, len(view), MAX_FRAME_PAYLOAD):
+            await self.send_frame(stream_id, flags, view[start:start + MAX_FRAME_PAYLOAD])
+
+    async def send_file_frames(self, stream_id, file, offset, count):
+        """Send a byte range of file as DATA frames, each payload via sendfile."""
+        end = offset + count
+        while offset < end:
+            length = min(MAX_FRAME_PAYLOAD, end - offset)
+            await self.connection.sendfile(file, offset, length, header=encode_frame_header(stream_id, FRAME_DATA, length))
+            offset += length
+            if self.session.throttle:
+                await self.session.throttle.wait(length)
+
+    def close(self):
+        if self.session.data_channels.get(self.channel_id) is self:
+            del self.session.data_channels[self.channel_id]
+        if self.reader_task and self.reader_task is not asyncio.current_task():
+            self.reader_task.cancel()  # Its cleanup closes the connection
+        else:
+            self.connection.close()
+
+
+class PortTransfer:
+    """A transfer over a data port opened just for it (the original scheme)."""
+
+    codec = None  # Raw bytes only; the original clients know nothing else
+
+    def __init__(self, data_connection, chunk_size=CHUNK_SIZE, throttle=None):
+        self.data_connection = data_connection
+        self.chunk_size = chunk_size
+        self.throttle = throttle or Throttle()
+
+    async def receive_into(self, file, filesize):
+        buffer = memoryview(bytearray(min(self.chunk_size, max(filesize, 1))))
+        bytes_received = 0
+        while bytes_received < filesize:
+            count = await self.data_connection.recv_into(buffer[:min(len(buffer), filesize - bytes_received)])
+            if not count:
+                break
+            await self.data_connection.loop.run_in_executor(None, file.write, buffer[:count])
+            bytes_received += count
+            if self.throttle:
+                await self.throttle.wait(count)
+        return bytes_received
+
+    async def start_download(self, filesize, offset, count, codec=None):
+        await self.data_connection.send_message(f"{count}")
+
+    async def send_file(self, file, offset, count):
+        if not self.throttle:
+            await self.data_connection.sendfile(file, offset, count)
+            return
+        for start in range(offset, offset + count, self.chunk_size):
+            length = min(self.chunk_size, offset + count - start)
+            await self.data_connection.sendfile(file, start, length)
+            await self.throttle.wait(length)
+
+    async def send_bytes(self, data):
+        if not self.throttle:
+            await self.data_connection.sendall(data)
+            return
+        for start in range(0, len(data), self.chunk_size):
+            piece = data[start:start + self.chunk_size]
+            await self.data_connection.sendall(piece)
+            await self.throttle.wait(len(piece))
+
+    async def send_chunks(self, chunks, compressed=False):
+        async for chunk in run_iterator(self.data_connection.loop, chunks):
+            await self.data_connection.sendall(chunk)
+            if self.throttle:
+                await self.throttle.wait(len(chunk))
+
+    async def finish(self):
+        pass
+
+    async def fail(self):
+        pass
+
+
+class StreamTransfer:
+    """A transfer carried as one stream of a client's data channel."""
+
+    def __init__(self, engine, connection, channel, stream_id, filename, options=None, codec=None):
+        self.engine = engine
+        self.connection = connection
+        self.channel = channel
+        self.stream_id = stream_id
+        self.filename = filename
+        self.options = options or {}  # Extra fields for the reply, e.g. offset/length
+        self.codec = codec  # Compression the client asked for, if any
+
+    async def receive_into(self, file, filesize):
+        sink = UploadSink(file, self.engine.loop, filesize)
+        self.channel.streams[self.stream_id] = DecompressingSink(sink, self.codec, filesize) if self.codec else sink
+        try:
+            # The client starts sending once it sees this reply.
+            await self.engine.send_message(self.connection, format_command("UPLOAD", f"stream={self.stream_id}", self.filename,
+                                                                           compress=self.codec, **self.options))
+            await sink.done
+        finally:
+            self.channel.streams.pop(self.stream_id, None)
+        if sink.overrun:
+            raise UploadOverrun(f"more than {filesize} bytes sent")
+        return sink.bytes_received
+
+    async def start_download(self, filesize, offset, count, codec=None):
+        await self.engine.send_message(self.connection, format_command("DOWNLOAD", f"stream={self.stream_id}", self.filename,
+                                                                       size=filesize, compress=codec, **self.options))
+
+    async def refuse_download(self, **options):
+        """Answer the request without sending anything, e.g. with changed=1."""
+        await self.engine.send_message(self.connection, format_command("DOWNLOAD", f"stream={self.stream_id}", self.filename,
+                                                                       **options))
+
+    async def send_file(self, file, offset, count):
+        await self.channel.send_file_frames(self.stream_id, file, offset, count)
+
+    async def send_bytes(self, data):
+        await self.channel.send_data(self.stream_id, data)
+
+    async def send_chunks(self, chunks, compressed=False):
+        async for chunk in run_iterator(self.engine.loop, chunks):
+            await self.channel.send_data(self.stream_id, chunk, compressed)
+
+    async def finish(self):
+        await self.channel.send_frame(self.stream_id, FRAME_END)
+
+    async def fail(self):
+        try:
+            await self.channel.send_frame(self.stream_id, FRAME_ABORT)
+        except OSError:
+            pass
+
+
+class ServerEngine:
+    def __init__(self, storage_dir, host=HOST, port=0, data_port_base=DATA_PORT_BASE,
+                 chunk_size=CHUNK_SIZE, storage="flat", layout="flat", migrate=True, compress_at_rest=None, metrics_port=None,
+                 read_cache_size=READ_CACHE_SIZE, max_transfers=MAX_TRANSFERS, max_transfers_per_user=MAX_TRANSFERS_PER_USER,
+                 user_rate=None, total_rate=None, durability="none", cluster_link=None, log=print):
+        self.storage_dir = storage_dir
+        self.host = host
+        self.port = port
+        self.data_port_base = data_port_base
+        self.chunk_size = chunk_size
+        self.compress_at_rest = compress_at_rest  # Codec to keep uploads compressed on disk with, if any
+        self.metrics_port = metrics_port  # Local port for Prometheus to scrape, if any
+        self.cluster_link = cluster_link  # Socket to the cluster master when running as a worker (see cluster.py)
+        self.migrate = migrate  # Move files stored under another layout into this one (one worker of a cluster does)
+        self.link = None
+        self.log_message = log
+
+        self.clients = {}  # Active clients: username -> ClientSession
+        self.sessions_by_token = {}  # Data channel token -> ClientSession
+        self.storage = STORAGE_BACKENDS[storage](storage_dir, layout)  # Where committed uploads live
+        self.catalog = Catalog(storage_dir, self.storage)  # Uploaded files by (owner, filename)
+        self.staging = StagingArea(storage_dir)  # Uploads that have not fully arrived yet
+        self.durability = Durability(durability)  # Whether commits wait for the disk (see durability.py)
+        self.read_cache = ReadCache(read_cache_size)  # Content of hot files, for downloads
+        self._cache_loads = {}  # (owner, filename) -> future of a read_cache load in progress
+        # Caps on transfers running at once and on bytes/s per user and overall (per process with --workers).
+        self.scheduler = TransferScheduler(max_transfers, max_transfers_per_user, user_rate, total_rate)
+        self.loop = None
+        self.server_socket = None
+        self.is_running = False
+        self._next_data_port = data_port_base
+        self._tasks = set()
+        self._stopped = None
+        self.metrics = Metrics()
+        self.file_locks = FileLockManager(on_wait=self.metrics.observe_lock_wait)  # Readers/writer lock per stored file
+        # Part files of uploads in progress; only the uploader's own session (so one worker) writes them.
+        self.part_locks = FileLockManager(on_wait=self.metrics.observe_lock_wait)
+        self.metrics.add_gauge("clients", "Logged-in clients.", lambda: len(self.clients))
+        self.metrics.add_gauge("catalog_files", "Files in the catalog.", lambda: len(self.catalog))
+        self.metrics.add_gauge("file_locks", "File locks held or waited for.",
+                               lambda: len(self.file_locks) + len(self.part_locks))
+        self.metrics.add_gauge("transfers_queued", "Transfers waiting for a free slot.", lambda: len(self.scheduler))
+        self.metrics.add_gauge("notifications_pending", "Files with download notifications not yet sent.",
+                               lambda: sum(len(session.notifications) for session in self.clients.values()))
+        self.metrics.add_gauge("read_cache_bytes", "Bytes of file content in the read cache.", lambda: self.read_cache.size)
+        self.metrics.add_gauge("read_cache_files", "Files in the read cache.", lambda: len(self.read_cache))
+        self.metrics.add_gauge("read_cache_hits_total", "Downloads served from the read cache.",
+                               lambda: self.read_cache.hits, kind="counter")
+        self.metrics.add_gauge("read_cache_misses_total", "Downloads read from disk.",
+                               lambda: self.read_cache.misses, kind="counter")
+        self.metrics.add_gauge("read_cache_evictions_total", "Files evicted from the read cache to make room.",
+                               lambda: self.read_cache.evictions, kind="counter")
+
+    # ------------------------------------------------------------------ lifecycle
+
+    def run(self):
+        """Run the server until stop() is called. Blocks the calling thread."""
+        asyncio.run(self.serve())
+
+    def stop(self):
+        """Ask a running server to shut down. Safe to call from any thread."""
+        if self.loop and self._stopped:
+            self.loop.call_soon_threadsafe(self._stopped.set)
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.durability.loop = self.loop
+        self._stopped = asyncio.Event()
+        if threading.current_thread() is threading.main_thread():
+            for sig in (signal.SIGINT, signal.SIGTERM):
+                try:
+                    self.loop.add_signal_handler(sig, self._stopped.set)
+                except (NotImplementedError, RuntimeError):
+                    pass  # Not supported on Windows; Ctrl+C still raises KeyboardInterrupt
+
+        if self.cluster_link is not None:
+            # The master prepared storage and the manifest; connections come from it too.
+            self.catalog.load()
+            self.link = Link(self.cluster_link, self.loop, self.on_cluster_message)
+            self.file_locks = SharedFileLocks(self.link, on_wait=self.metrics.observe_lock_wait)
+        else:
+            storage_status = self.storage.prepare()
+            if storage_status:
+                self.log_message(storage_status)
+            if self.catalog.load():
+                self.log_message(f"[CATALOG] Loaded {len(self.catalog)} files from the manifest.")
+            else:
+                self.log_message(f"[CATALOG] Indexed {len(self.catalog)} files from {self.storage_dir}.")
+            removed = self.staging.cleanup()
+            if removed:
+                self.log_message(f"[STAGING] Removed {removed} abandoned partial uploads.")
+
+            self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.server_socket.bind((self.host, self.port))
+            self.server_socket.listen(LISTEN_BACKLOG)
+            self.server_socket.setblocking(False)
+            self.port = self.server_socket.getsockname()[1]
+            self.log_message(f"[STARTING] Server is starting on {self.host}:{self.port}")
+            self.log_message("[LISTENING] Server is listening for connections...")
+        self.is_running = True
+        metrics_server = None
+        if self.metrics_port is not None:
+            metrics_server = await asyncio.start_server(self.serve_metrics, METRICS_HOST, self.metrics_port)
+            port = metrics_server.sockets[0].getsockname()[1]
+            self.log_message(f"[METRICS] Serving metrics on http://{METRICS_HOST}:{port}/metrics")
+
+        if self.server_socket is not None:
+            self.spawn(self.accept_loop())
+        if self.migrate:
+            self.spawn(self.migrate_layout())
+        try:
+            await self._stopped.wait()
+        finally:
+            self.is_running = False
+            if metrics_server is not None:
+                metrics_server.close()
+            for task in list(self._tasks):
+                task.cancel()
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+            if self.link is not None:
+                await self.link.drain()  # The last unlocks and catalog changes
+                self.link.close()  # The master saves the catalog
+            else:
+                self.server_socket.close()
+                try:
+                    self.catalog.save()
+                except OSError as e:
+                    self.log_message(f"[ERROR] Failed to save catalog: {e}")
+            self.log_message("[STOPPED] Server stopped.")
+
+    async def accept_loop(self):
+        while self.is_running:
+            try:
+                client_socket, address = await self.loop.sock_accept(self.server_socket)
+            except asyncio.CancelledError:
+                raise
+            except OSError as e:
+                self.log_message(f"[ERROR] {e}")
+                self.metrics.count_error("accept")
+                await asyncio.sleep(0.1)  # e.g. EMFILE; back off instead of spinning
+                continue
+            self.spawn(self.handle_client(Connection(client_socket, self.loop), address))
+            self.log_message(f"[NEW CONNECTION] {address} connected.")
+            self.log_message(f"[ACTIVE CONNECTIONS] {len(self.clients)}")
+
+    def spawn(self, coro):
+        task = self.loop.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def serve_metrics(self, reader, writer):
+        """Answer one HTTP request with the metrics in Prometheus text format, whatever the path."""
+        try:
+            await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), METRICS_REQUEST_TIMEOUT)
+            body = self.metrics.render_prometheus().encode()
+            writer.write(b"HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                         b"Content-Length: " + str(len(body)).encode() + b"\r\n\r\n" + body)
+            await writer.drain()
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            pass
+        finally:
+            writer.close()
+
+    # ------------------------------------------------------------------ helpers
+
+    async def send_message(self, connection, message):
+        try:
+            await connection.send_message(message)
+        except OSError as e:
+            self.log_message(f"[ERROR] Failed to send message: {e}")
+            self.metrics.count_error("send")
+
+    async def receive_message(self, connection):
+        try:
+            return await connection.receive_message()
+        except (OSError, ValueError) as e:  # ValueError includes UnicodeDecodeError
+            self.log_message(f"[ERROR] Failed to receive message: {e}")
+            self.metrics.count_error("receive")
+            return None
+
+    def notify_uploader(self, uploader_name, filename, downloader):
+        """Queue a download notification for the uploader; its writer task sends it (see NotificationQueue)."""
+        if uploader_name == downloader:
+            return
+        if uploader_name in self.clients:
+            self.clients[uploader_name].notifications.add(filename, downloader)
+            self.log_message(f"[NOTIFICATION QUEUED] To: {uploader_name} - File '{filename}' downloaded by {downloader}.")
+        elif self.link is not None:  # Maybe logged in on another worker
+            self.link.post({"op": "notify", "user": uploader_name, "filename": filename, "downloader": downloader})
+
+    def catalog_changed(self, owner, filename):
+        """Forget cached content of a file that was replaced or deleted, here and on the other workers, and tell subscribers."""
+        self.read_cache.invalidate((owner, filename))
+        self.wake_feeds()
+        if self.link is not None:
+            entry = self.catalog.get(owner, filename)
+            self.link.post({"op": "catalog", "owner": owner, "filename": filename,
+                            "entry": list(entry) if entry else None})
+
+    def wake_feeds(self):
+        for session in self.clients.values():
+            if session.feed is not None:
+                session.feed.wake()
+
+    def on_cluster_message(self, message, fds):
+        """Handle what the cluster master sends a worker (see cluster.py)."""
+        if message is None:
+            if self.is_running:
+                self.log_message("[ERROR] Lost the cluster master; stopping.")
+                self._stopped.set()
+            return
+        op = message["op"]
+        if op == "connection":
+            address = tuple(message["address"])
+            connection = Connection(socket.socket(fileno=fds[0]), self.loop)
+            self.spawn(self.handle_client(connection, address, message["first"]))
+            self.log_message(f"[NEW CONNECTION] {address} connected.")
+        elif op == "numbering":
+            self.catalog.follow(message["epoch"], message["seq"])
+        elif op == "catalog":
+            if message["entry"] is None:
+                self.catalog.remove(message["owner"], message["filename"])
+            else:
+                self.catalog.add(*message["entry"])
+            if message.get("change"):
+                self.catalog.record(*message["change"])
+            self.read_cache.invalidate((message["owner"], message["filename"]))
+            self.wake_feeds()
+        elif op == "change":  # One of ours, as the master numbered it
+            self.catalog.record(*message["change"])
+            self.wake_feeds()
+        elif op == "relocate":
+            self.catalog.relocate(message["owner"], message["filename"], message["path"])
+        elif op == "notify":
+            if message["user"] in self.clients:
+                self.notify_uploader(message["user"], message["filename"], message["downloader"])
+
+    # ------------------------------------------------------------------ transfers
+
+    async def handle_upload(self, transfer, connection, username, filename, staged, offset, length, exclusive=True):
+        try:
+            with self.metrics.transfer("upload") as timer:
+                # Resumed uploads of one name take turns on the part file; byte
+                # ranges of it may arrive side by side since they never overlap.
+                part_lock = self.part_locks.write if exclusive else self.part_locks.read
+                async with part_lock(staged.path):
+                    with await self.loop.run_in_executor(None, staged.open) as file:
+                        file.seek(offset)
+                        self.log_message(f"[UPLOADING] Receiving {filename} from {username}...")
+                        bytes_received = await transfer.receive_into(file, length)
+                    staged.add_range(offset, offset + bytes_received)
+                timer.done(bytes_received, ok=bytes_received == length)
+
+            if bytes_received < length:
+                self.metrics.count_error("upload_incomplete")
+                received = staged.resume_offset()
+                retry = "Upload it again to resume." if staged.resumable else "Upload it again."
+                await self.send_message(connection, f"[ERROR] Upload of '{filename}' incomplete: {received} of {staged.size} bytes received. {retry}")
+                self.log_message(f"[UPLOAD INCOMPLETE] {filename} from {username}: {received} of {staged.size} bytes.")
+            elif staged.is_complete():
+                # A file put together from ranges or resumes is checked against the sha256 it was declared with.
+                pieced = (offset, length) != (0, staged.size)
+                if pieced and staged.digest and not staged.committed and \
+                        await self.loop.run_in_executor(None, file_digest, staged.path) != staged.digest:
+                    self.metrics.count_error("upload_mismatch")
+                    staged.ranges = []  # Sent again from scratch
+                    if staged.resumable:
+                        staged.save()
+                    await self.send_message(connection, f"[ERROR] Upload of '{filename}' failed: the received file doesn't match its sha256. Upload it again.")
+                    self.log_message(f"[UPLOAD FAILED] {filename} from {username} doesn't match its sha256.")
+                    return
+                # False if a range finishing at the same moment committed it; the file is in place either way.
+                if await self.commit_upload(username, filename, staged):
+                    self.log_message(f"[UPLOAD SUCCESS] {filename} uploaded by {username}.")
+                await self.send_message(connection, f"[UPLOAD][SERVER RESPONSE] File '{filename}' uploaded successfully.")
+            else:  # More ranges to come
+                await self.send_message(connection, f"[UPLOAD][SERVER RESPONSE] Received bytes {offset}-{offset + length} of '{filename}'.")
+        except UploadOverrun as e:
+            self.metrics.count_error("upload_overrun")
+            await self.send_message(connection, f"[ERROR] Upload of '{filename}' failed: {e}.")
+            self.log_message(f"[UPLOAD FAILED] {filename} from {username}: {e}.")
+        except OSError as e:
+            disk_full = e.errno == errno.ENOSPC
+            self.metrics.count_error("disk_full" if disk_full else "upload_failed")
+            reason = "not enough disk space on the server" if disk_full else e.strerror or str(e)
+            await self.send_message(connection, f"[ERROR] Upload of '{filename}' failed: {reason}.")
+            self.log_message(f"[UPLOAD FAILED] {filename} from {username}: {reason}.")
+        finally:
+            self.staging.checkin(staged)
+
+    async def commit_upload(self, username, filename, staged):
+        """Move a fully received upload into place. Returns False if another transfer already did."""
+        if staged.committed:
+            return False
+        staged.committed = True
+        if self.compress_at_rest:
+            await self.loop.run_in_executor(None, compress_file, staged.path, self.compress_at_rest)
+        # The content must be on disk before the rename makes it visible, or a crash could leave a hole under the name.
+        await self.sync_commit([staged.path])
+        async with self.file_locks.write(stored_name(username, filename)):
+            path = self.storage.path_for(username, filename)
+            replaced = self.catalog.get(username, filename)
+            # Hashing a large file for the dedup backend must not stall the event loop.
+            async with self.blob_locks(replaced and replaced.digest):
+                digest = await self.loop.run_in_executor(None, self.storage.commit, staged.path, path, replaced)
+            staged.discard()
+            self.catalog.add_file(username, filename, path, digest)
+            self.catalog_changed(username, filename)
+        await self.sync_commit(self.storage.commit_dirs(path, digest))
+        return True
+
+    async def migrate_layout(self):
+        """Move files stored under another layout to where the current one puts them, while serving.
+
+        Each file is moved under its write lock, so transfers of it simply
+        wait for the rename; a file deleted or uploaded again in the
+        meantime needs no move.
+        """
+        misplaced = self.catalog.misplaced()
+        if not misplaced:
+            return
+        self.log_message(f"[MIGRATION] Moving {len(misplaced)} files to the {self.storage.layout} layout...")
+        moved = 0
+        for owner, filename in misplaced:
+            async with self.file_locks.write(stored_name(owner, filename)):
+                entry = self.catalog.get(owner, filename)
+                path = self.storage.path_for(owner, filename)
+                if entry is None or entry.path == path:
+                    continue
+                try:
+                    await self.loop.run_in_executor(None, self.storage.move, entry.path, path)
+                except OSError as e:
+                    self.log_message(f"[ERROR] Failed to move {entry.path} to {path}: {e}")
+                    continue
+                self.catalog.relocate(owner, filename, path)
+                if self.link is not None:
+                    self.link.post({"op": "relocate", "owner": owner, "filename": filename, "path": path})
+            moved += 1
+            if moved % MIGRATION_LOG_INTERVAL == 0:
+                self.log_message(f"[MIGRATION] Moved {moved} of {len(misplaced)} files.")
+        self.log_message(f"[MIGRATION] Done: {moved} files moved to the {self.storage.layout} layout.")
+
+    async def sync_commit(self, paths):
+        """Wait for paths to reach the disk, if the durability mode asks for it."""
+        if self.durability:
+            started = time.perf_counter()
+            await self.durability.sync(paths)
+            self.metrics.observe_commit_sync(time.perf_counter() - started)
+
+    async def handle_delta_upload(self, transfer, connection, username, filename, delta, filesize, block_size, digest):
+        """Receive a delta against the stored copy of a file and commit the file it rebuilds (see delta.py)."""
+        rebuilt = self.staging.reserve(stored_name(username, filename), filesize)
+        try:
+            with self.metrics.transfer("upload") as timer:
+                with await self.loop.run_in_executor(None, delta.open) as file:
+                    self.log_message(f"[UPLOADING] Receiving changes to {filename} from {username}...")
+                    bytes_received = await transfer.receive_into(file, delta.size)
+                timer.done(bytes_received, ok=bytes_received == delta.size)
+            if bytes_received < delta.size:
+                self.metrics.count_error("upload_incomplete")
+                await self.send_message(connection, f"[ERROR] Upload of '{filename}' incomplete: {bytes_received} of {delta.size} bytes of changes received.")
+                return
+
+            # The stored copy must not change while blocks are copied out of it.
+            async with self.file_locks.read(stored_name(username, filename)):
+                entry = self.catalog.get(username, filename)
+                try:
+                    result = entry and await self.loop.run_in_executor(None, rebuild_file, self.catalog.path_of(entry),
+                                                                       delta.path, rebuilt.path, block_size)
+                except ValueError:
+                    result = None
+            if result != (filesize, digest):  # Replaced or deleted since the signatures were sent
+                self.metrics.count_error("delta_mismatch")
+                await self.send_message(connection, f"[ERROR] Upload of '{filename}' failed: the changes don't apply to the stored copy.")
+                self.log_message(f"[UPLOAD FAILED] Changes to {filename} from {username} don't apply to the stored copy.")
+            elif await self.commit_upload(username, filename, rebuilt):
+                await self.send_message(connection, f"[UPLOAD][SERVER RESPONSE] File '{filename}' uploaded successfully.")
+                self.log_message(f"[UPLOAD SUCCESS] {filename} uploaded by {username} ({delta.size} bytes of changes sent).")
+        except UploadOverrun as e:
+            self.metrics.count_error("upload_overrun")
+            await self.send_message(connection, f"[ERROR] Upload of '{filename}' failed: {e}.")
+            self.log_message(f"[UPLOAD FAILED] Changes to {filename} from {username}: {e}.")
+        finally:
+            delta.discard()
+            if not rebuilt.committed:
+                rebuilt.discard()
+
+    async def handle_signatures(self, connection, username, command):
+        """Answer [SIGNATURES] with the block signatures of the client's stored copy of a file.
+
+        sha256=<hex> is the digest of the client's new version: if the
+        stored copy already has it, the reply says unchanged=1 and the upload
+        is done without any data sent.  missing=1 means there is no copy to
+        build on.
+        """
+        (filename,), options = parse_command(command, 1)
+        digest = options.get("sha256")
+        async with self.file_locks.read(stored_name(username, filename)):
+            entry = self.catalog.get(username, filename)
+            block_size = block_size_for(entry.size) if entry else None
+            if entry is None:
+                signatures = stored_digest = None
+            elif entry.digest and entry.digest == digest:  # The dedup backend knows it without reading the file
+                signatures, stored_digest = [], entry.digest
+            else:
+                try:
+                    signatures, stored_digest = await self.loop.run_in_executor(None, read_signatures,
+                                                                                self.catalog.path_of(entry), block_size)
+                except OSError as e:
+                    self.log_message(f"[ERROR] Failed to read {filename} for signatures: {e}")
+                    signatures = stored_digest = None
+        if signatures is None:
+            await self.send_message(connection, format_command("SIGNATURES", filename, missing=1))
+        elif stored_digest == digest:
+            await self.send_message(connection, format_command("SIGNATURES", filename, unchanged=1))
+            self.log_message(f"[UPLOAD SUCCESS] {filename} uploaded by {username} (unchanged, no data sent).")
+        else:
+            await self.send_message(connection, format_batch(
+                format_command("SIGNATURES", filename, block=block_size, size=entry.size),
+                [(f"{weak:08x}", strong.hex()) for weak, strong in signatures]))
+
+    async def link_upload(self, connection, username, filename, digest, key):
+        """Store an upload whose content the dedup backend already has, without any data transfer.
+
+        Returns False, having told the client nothing, if the content was
+        deleted since it was looked up; the data has to be sent after all.
+        """
+        async with self.file_locks.write(stored_name(username, filename)):
+            path = self.storage.path_for(username, filename)
+            replaced = self.catalog.get(username, filename)
+            async with self.blob_locks(digest, replaced and replaced.digest):
+                try:
+                    await self.loop.run_in_executor(None, self.storage.link_existing, digest, path, replaced)
+                except FileNotFoundError:
+                    return False
+            self.catalog.add_file(username, filename, path, digest)
+            self.catalog_changed(username, filename)
+        # stored=1 tells the client to skip sending the data.
+        await self.send_message(connection, format_command("UPLOAD", key, filename, stored=1))
+        await self.sync_commit(self.storage.commit_dirs(path))
+        await self.send_message(connection, f"[UPLOAD][SERVER RESPONSE] File '{filename}' uploaded successfully.")
+        self.log_message(f"[UPLOAD SUCCESS] {filename} uploaded by {username} (content already stored, no data sent).")
+        return True
+
+    @contextlib.asynccontextmanager
+    async def blob_locks(self, *digests):
+        """Hold the locks of the dedup blobs with these digests, so none is deleted while it gets another name."""
+        async with contextlib.AsyncExitStack() as stack:
+            for digest in sorted({digest for digest in digests if digest}):
+                await stack.enter_async_context(self.file_locks.write(f"{BLOB_DIR}/{digest}"))
+            yield
+
+    async def start_batch_upload(self, session, command):
+        """Parse a [BATCH_UPLOAD] and, if it holds up, receive its files in a task of their own."""
+        connection = session.connection
+        try:
+            header, entries = parse_batch(command)
+            _, options = parse_command(header, 0)
+            files = [(filename, int(size)) for filename, size in entries]
+            if any(size < 0 for _, size in files):
+                raise ValueError("negative file size")
+            stream_id = int(options["stream"]) if "stream" in options else None
+        except ValueError:
+            await self.send_message(connection, "[ERROR] Malformed batch upload.")
+            return
+        channel = session.get_data_channel(options.get("channel"))
+        if stream_id is None or channel is None:
+            await self.send_message(connection, "[ERROR] Batch transfers need a data channel.")
+            return
+        invalid = next((filename for filename, _ in files if not valid_filename(filename)), None)
+        if invalid is not None:
+            await self.send_message(connection, f"[BATCH_UPLOAD][ERROR]|[Invalid file name '{invalid}'.]|[stream={stream_id}]")
+            return
+        upload = self.handle_batch_upload(session, channel, stream_id, files, self.accepted_codec(options))
+        self.spawn(self.admitted(session, "Batch upload", upload))
+
+    async def handle_batch_upload(self, session, channel, stream_id, files, codec):
+        """Receive a batch's files over one stream and commit each that arrives.
+
+        Should anything fail, the client gets [BATCH_UPLOAD][ERROR] and only
+        this stream is closed; the data channel carries on.
+        """
+        connection, username = session.connection, session.username
+        staged_files = []
+        try:
+            staged_files = [(filename, self.staging.reserve(stored_name(username, filename), size)) for filename, size in files]
+            sink = BatchUploadSink(staged_files, self.loop)
+            channel.streams[stream_id] = DecompressingSink(sink, codec, sum(size for _, size in files)) if codec else sink
+            with self.metrics.transfer("upload") as timer:
+                self.log_message(f"[BATCH UPLOAD] Receiving {len(files)} files from {username}...")
+                await self.send_message(connection, format_command("BATCH_UPLOAD", f"stream={stream_id}", len(files), compress=codec))
+                await sink.done
+                timer.done(sum(size for _, size in files[:sink.files_received]), ok=sink.files_received == len(files))
+            statuses = []
+            for index, (filename, staged) in enumerate(staged_files):
+                if index >= sink.files_received:
+                    statuses.append((filename, "ERROR Incomplete"))
+                elif await self.commit_upload(username, filename, staged):
+                    statuses.append((filename, "OK"))
+            uploaded = sum(status == "OK" for _, status in statuses)
+            await self.send_message(connection, format_batch(
+                f"[BATCH_UPLOAD][SERVER RESPONSE]|[{uploaded} of {len(files)} files uploaded]|[stream={stream_id}]", statuses))
+            self.log_message(f"[BATCH UPLOAD] {uploaded} of {len(files)} files uploaded by {username}.")
+        except Exception as e:
+            await self.batch_failed(connection, "BATCH_UPLOAD", stream_id, e)
+        finally:
+            channel.streams.pop(stream_id, None)
+            for _, staged in staged_files:
+                if not staged.committed:
+                    staged.discard()
+
+    async def start_batch_download(self, session, command):
+        """Parse a [BATCH_DOWNLOAD] and, if it holds up, send its files in a task of their own."""
+        connection = session.connection
+        try:
+            header, entries = parse_batch(command)
+            _, options = parse_command(header, 0)
+            files = [(filename, uploader) for filename, uploader in entries]
+            stream_id = int(options["stream"]) if "stream" in options else None
+        except ValueError:
+            await self.send_message(connection, "[ERROR] Malformed batch download.")
+            return
+        channel = session.get_data_channel(options.get("channel"))
+        if stream_id is None or channel is None:
+            await self.send_message(connection, "[ERROR] Batch transfers need a data channel.")
+            return
+        download = self.handle_batch_download(session, channel, stream_id, files, self.accepted_codec(options))
+        self.spawn(self.admitted(session, "Batch download", download))
+
+    async def handle_batch_download(self, session, channel, stream_id, files, codec):
+        """Send a batch's files back to back over one stream.
+
+        Each file is preceded by a BATCH_FILE_HEADER with its size; with
+        compression the whole stream, headers included, is one compressed
+        stream, so many small files share one dictionary.  Should anything
+        fail, the stream is aborted and the client gets [BATCH_DOWNLOAD][ERROR].
+        """
+        connection, username = session.connection, session.username
+        compressor = make_compressor(codec) if codec else None
+
+        async def send(chunks):
+            if compressor:
+                chunks = compress_into(compressor, chunks)
+            async for chunk in run_iterator(self.loop, chunks):
+                await channel.send_data(stream_id, chunk, compressor is not None)
+
+        self.log_message(f"[BATCH DOWNLOAD] Sending {len(files)} files to {username}...")
+        await self.send_message(connection, format_command("BATCH_DOWNLOAD", f"stream={stream_id}", len(files), compress=codec))
+        statuses = []
+        bytes_sent = 0
+        try:
+            with self.metrics.transfer("download") as timer:
+                for filename, uploader in files:
+                    async with self.file_locks.read(stored_name(uploader, filename)):
+                        entry = self.catalog.get(uploader, filename)
+                        if entry is None:
+                            await send(iter([BATCH_FILE_HEADER.pack(BATCH_MISSING)]))
+                            statuses.append((filename, "ERROR File not found"))
+                            continue
+                        size_header = BATCH_FILE_HEADER.pack(entry.size)
+                        content = await self.cached_content(entry)
+                        if content is not None and compressor is None:
+                            await channel.send_data(stream_id, size_header)
+                            await channel.send_data(stream_id, content)
+                        elif content is not None:
+                            await send(iter([size_header, content]))
+                        else:
+                            with open(self.catalog.path_of(entry), "rb") as file:
+                                stored = read_container_header(file)
+                                if compressor is None and stored is None:
+                                    await channel.send_data(stream_id, size_header)
+                                    await channel.send_file_frames(stream_id, file, 0, entry.size)
+                                else:
+                                    await send(itertools.chain([size_header], stored_chunks(file, stored, 0, entry.size)))
+                    statuses.append((filename, "OK"))
+                    bytes_sent += entry.size
+                    self.notify_uploader(uploader, filename, username)
+                if compressor:
+                    await channel.send_data(stream_id, compressor.flush(), compressed=True)
+                await channel.send_frame(stream_id, FRAME_END)
+                timer.done(bytes_sent)
+        except Exception as e:
+            self.metrics.count_error("download_failed")
+            try:
+                await channel.send_frame(stream_id, FRAME_ABORT)
+            except OSError:
+                pass
+            await self.batch_failed(connection, "BATCH_DOWNLOAD", stream_id, e)
+            return
+        sent = sum(status == "OK" for _, status in statuses)
+        await self.send_message(connection, format_batch(
+            f"[BATCH_DOWNLOAD][SERVER RESPONSE]|[{sent} of {len(files)} files sent]|[stream={stream_id}]", statuses))
+        self.log_message(f"[BATCH DOWNLOAD] {sent} of {len(files)} files sent to {username}.")
+
+    async def handle_download(self, transfer, connection, filename, uploader, downloader, offset=0, length=None,
+                              if_match=None):
+        stored_filename = stored_name(uploader, filename)
+
+        async with self.file_locks.read(stored_filename):
+            try:
+                entry = self.catalog.get(uploader, filename)
+                if entry is None:
+                    await transfer.fail()
+                    await self.send_message(connection, "[ERROR]: File not found.")
+                    self.metrics.count_error("not_found")
+                    return
+                if if_match is not None and file_version(entry) != if_match:
+                    # Replaced since an earlier range of this download was sent.
+                    await transfer.refuse_download(changed=1, version=file_version(entry))
+                    self.metrics.count_error("version_changed")
+                    return
+                filesize = entry.size
+                offset = min(offset, filesize)
+                count = filesize - offset if length is None else min(length, filesize - offset)
+
+                with self.metrics.transfer("download") as timer:
+                    # Files kept compressed the way the client wants them are cheapest sent from disk as they are.
+                    passthrough = transfer.codec is not None and transfer.codec == self.compress_at_rest
+                    content = None if passthrough else await self.cached_content(entry)
+                    if content is not None:
+                        await self.send_content(transfer, content, offset, count)
+                    else:
+                        with open(self.catalog.path_of(entry), "rb") as file:
+                            stored = read_container_header(file)  # Kept compressed on disk?
+                            codec = transfer.codec
+                            if codec and stored is None and not await self.loop.run_in_executor(None, sample_compresses, file, offset, codec):
+                                codec = None  # Doesn't shrink (media, archives); send it as is
+                            await transfer.start_download(filesize, offset, count, codec)
+                            if stored is None and codec is None:
+                                await transfer.send_file(file, offset, count)
+                            elif stored and stored[0] == codec and count == filesize:
+                                # Already compressed the way the client wants it: send the bytes on disk.
+                                await transfer.send_chunks(read_chunks(file, CONTAINER_HEADER.size), compressed=True)
+                            else:
+                                chunks = stored_chunks(file, stored, offset, count)
+                                if codec:
+                                    chunks = compress_chunks(chunks, codec)
+                                await transfer.send_chunks(chunks, compressed=codec is not None)
+                    await transfer.finish()
+                    timer.done(count)
+            except OSError:
+                self.metrics.count_error("download_failed")
+                await transfer.fail()
+                raise
+
+        if offset + count < filesize:  # One range of a larger download
+            await self.send_message(connection, f"[DOWNLOADS][SERVER RESPONSE] Sent bytes {offset}-{offset + count} of '{filename}'.")
+            return
+        # Log and notify once per download, when its last byte goes out.
+        self.log_message(f"[DOWNLOAD SUCCESS] {filename} sent to {downloader}.")
+        self.notify_uploader(uploader, filename, downloader)
+        await self.send_message(connection, "[DOWNLOADS][SERVER RESPONSE] File downloaded")
+
+    async def cached_content(self, entry):
+        """The file's content from the read cache, loading it once it is popular; None to read it from disk.
+
+        Call with the file's read lock held, so the content can't change while it loads.
+        """
+        key = (entry.owner, entry.filename)
+        content = self.read_cache.get(key, entry)
+        if content is not None:
+            return content
+        loading = self._cache_loads.get(key)
+        if loading is not None:
+            return await asyncio.shield(loading)  # Someone else is already reading it in
+        if not self.read_cache.admit(key, entry.size):
+            return None
+        loading = self._cache_loads[key] = self.loop.create_future()
+        content = None
+        try:
+            content = await self.loop.run_in_executor(None, read_content, self.catalog.path_of(entry))
+        finally:
+            del self._cache_loads[key]
+            loading.set_result(content)  # None sends the waiters to the disk instead
+        if self.catalog.get(entry.owner, entry.filename) == entry:  # Not replaced or deleted meanwhile
+            self.read_cache.put(key, entry, content)
+        return content
+
+    async def send_content(self, transfer, content, offset, count):
+        """Send a byte range of a file's content from memory."""
+        view = memoryview(content)[offset:offset + count]
+        codec = transfer.codec
+        if codec and not await self.loop.run_in_executor(None, data_compresses, view, codec):
+            codec = None  # Doesn't shrink (media, archives); send it as is
+        await transfer.start_download(len(content), offset, count, codec)
+        if codec:
+            chunks = (view[start:start + self.chunk_size] for start in range(0, count, self.chunk_size))
+            await transfer.send_chunks(compress_chunks(chunks, codec), compressed=True)
+        else:
+            await transfer.send_bytes(view)
+
+    def open_data_listener(self):
+        """Bind the next free data port, wrapping around instead of walking forever."""
+        for _ in range(65536):
+            port = self._next_data_port
+            self._next_data_port = port + 1 if port < 65535 else self.data_port_base
+            listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            try:
+                listener.bind((self.host, port))
+            except OSError:
+                listener.close()
+                continue
+            listener.listen(1)
+            listener.setblocking(False)
+            return listener, port
+        raise OSError("No free data port available")
+
+    async def accept_data_connection(self, listener, port, purpose, filename):
+        self.log_message(f"[DATA SOCKET] Listening on port {port} for {purpose} of {filename}.")
+        try:
+            conn, addr = await asyncio.wait_for(self.loop.sock_accept(listener), DATA_ACCEPT_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.log_message(f"[DATA SOCKET] No connection on port {port}; {purpose} of {filename} abandoned.")
+            self.metrics.count_error("data_port_timeout")
+            return None
+        finally:
+            listener.close()
+        self.log_message(f"[DATA SOCKET] Connection established with {addr}.")
+        return Connection(conn, self.loop)
+
+    async def handle_data_connection_upload(self, session, filename, staged, offset, length, exclusive, reply_options):
+        connection = session.connection
+        listener, port = self.open_data_listener()
+        await self.send_message(connection, format_command("UPLOAD", port, filename, **reply_options))
+        data_connection = await self.accept_data_connection(listener, port, "upload", filename)
+        if data_connection is None:
+            self.staging.checkin(staged)
+            return
+        try:
+            await self.handle_upload(PortTransfer(data_connection, self.chunk_size, session.throttle), connection,
+                                     session.username, filename, staged, offset, length, exclusive)
+        finally:
+            data_connection.close()
+
+    async def handle_data_connection(self, session, filename, uploader, offset, length, reply_options):
+        connection = session.connection
+        listener, port = self.open_data_listener()
+        await self.send_message(connection, format_command("DOWNLOAD", port, filename, **reply_options))
+        data_connection = await self.accept_data_connection(listener, port, "download", filename)
+        if data_connection is None:
+            return
+        try:
+            await self.handle_download(PortTransfer(data_connection, self.chunk_size, session.throttle), connection,
+                                       filename, uploader, session.username, offset, length)
+        finally:
+            data_connection.close()
+
+    async def admitted(self, session, description, transfer, abandoned=None):
+        """Run a transfer coroutine once the scheduler has a slot for it, telling the client its place in the queue meanwhile.
+
+        abandoned, if given, is called if the transfer never got to start
+        (the client went away while it was queued).
+        """
+        async def on_queued(position):
+            await self.send_message(session.connection,
+                                    f"[QUEUED] {description} is waiting for a free transfer slot (position {position}).")
+
+        try:
+            started = time.perf_counter()
+            async with self.scheduler.slot(session.username, on_queued):
+                self.metrics.observe_queue_wait(time.perf_counter() - started)
+                await transfer
+        finally:
+            if inspect.getcoroutinestate(transfer) == inspect.CORO_CREATED:
+                transfer.close()
+                if abandoned is not None:
+                    abandoned()
+
+    # ------------------------------------------------------------------ commands
+
+    async def authenticate(self, connection, username):
+        while True:
+            if not username:
+                return None
+            session = None if username in self.clients else ClientSession(username, connection, self.log_message,
+                                                                                 self.scheduler.throttle())
+            if session is not None and self.link is not None:
+                # Also not logged in on another worker?
+                _, claimed = self.link.request({"op": "claim", "user": username, "token": session.token})
+                if not (await claimed)["ok"]:
+                    session = None
+            if session is None:
+                await self.send_message(connection, "[ERROR]: Username already in use.")
+            else:
+                session.notifier = self.spawn(session.notifications.run())
+                self.clients[username] = session
+                self.sessions_by_token[session.token] = session
+                await self.send_message(connection, f"[AUTHENTICATED] Welcome, {username}!")
+                self.log_message(f"[AUTHENTICATED] {username} connected.")
+                return session
+            username = await self.receive_message(connection)
+
+    async def attach_data_channel(self, connection, command):
+        (token,), _ = parse_command(command, 1)
+        session = self.sessions_by_token.get(token)
+        if session is None:
+            await self.send_message(connection, "[ERROR]: Unknown data channel token.")
+            connection.close()
+            return
+        channel = session.add_data_channel(connection, self.chunk_size)
+        await self.send_message(connection, format_command("ATTACHED", channel.channel_id))
+        self.log_message(f"[DATA CHANNEL] {session.username} attached data channel {channel.channel_id}.")
+        await channel.read_frames()
+        self.log_message(f"[DATA CHANNEL] {session.username} closed data channel {channel.channel_id}.")
+
+    async def negotiate_protocol(self, connection, command):
+        """Switch the control connection to the framing a [PROTOCOL] request asks for, if we speak it."""
+        try:
+            (version,), _ = parse_command(command, 1)
+            version = int(version)
+        except ValueError:
+            version = connection.protocol
+        if version in (1, 2):
+            await connection.switch_protocol(version)
+        else:
+            await self.send_message(connection, format_command("PROTOCOL", connection.protocol))
+
+    async def handle_client(self, connection, address, first_message=None):
+        """Serve one connection; first_message is given if the cluster master already read it."""
+        session = None
+        self.metrics.connections += 1
+
+        try:
+            if first_message is None:
+                first_message = await self.receive_message(connection)
+            if first_message and first_message.startswith("[ATTACH]"):
+                await self.attach_data_channel(connection, first_message)
+                return
+
+            session = await self.authenticate(connection, first_message)
+            if session is None:
+                return
+            username = session.username
+
+            while True:
+                command = await self.receive_message(connection)
+                if not command:
+                    break
+                started = time.perf_counter()
+
+                # A malformed command (a missing field, offset=abc) or a disk error gets an error; the connection stays.
+                try:
+                    if command.startswith("[UPLOAD]"):
+                        await self.start_upload(session, command)
+                    elif command.startswith("[DOWNLOAD]"):
+                        await self.start_download(session, command)
+                    elif command == "[DATA_CHANNEL]":
+                        # Tell new clients what else this server supports.
+                        await self.send_message(connection, format_command("DATA_CHANNEL", session.token,
+                                                                           dedup=1 if self.storage.name == "dedup" else None,
+                                                                           compress=",".join(available_codecs()),
+                                                                           protocol=PROTOCOL_VERSION, delta=1, feed=1))
+                    elif command.startswith("[SIGNATURES]"):
+                        self.spawn(self.answered(connection, username, command,
+                                                 self.handle_signatures(connection, username, command)))
+                    elif command.startswith("[PROTOCOL]"):
+                        await self.negotiate_protocol(connection, command)
+                    elif command.startswith("[LIST_FILES]"):
+                        await self.handle_list_files(connection, command)
+                    elif command.startswith("[SUBSCRIBE]"):
+                        await self.handle_subscribe(session, command)
+                    elif command.startswith("[DELETE]"):
+                        await self.handle_delete(connection, username, command)
+                    elif command.startswith("[BATCH_UPLOAD]"):
+                        await self.start_batch_upload(session, command)
+                    elif command.startswith("[BATCH_DOWNLOAD]"):
+                        await self.start_batch_download(session, command)
+                    elif command.startswith("[BATCH_DELETE]"):
+                        await self.handle_batch_delete(connection, username, command)
+                    elif command == "[STATS]":
+                        await self.send_message(connection, "[STATS]\n" + self.metrics.to_json())
+                    elif command == "[DISCONNECT]":
+                        self.log_message(f"[DISCONNECTED] {username} disconnected.")
+                        break
+                except (ValueError, KeyError, OSError) as e:
+                    await self.command_failed(connection, username, command, e)
+                self.metrics.observe_command(command_name(command), time.perf_counter() - started)
+
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.log_message(f"[ERROR] {e}")
+            self.metrics.count_error("unhandled")
+        finally:
+            self.metrics.connections -= 1
+            if session is not None:
+                if self.clients.get(session.username) is session:
+                    del self.clients[session.username]
+                    if self.link is not None:
+                        self.link.post({"op": "release", "user": session.username})
+                self.sessions_by_token.pop(session.token, None)
+                session.close()
+            connection.close()
+
+    async def command_failed(self, connection, username, command, error):
+        """Answer a command that raised error with [ERROR]; the session carries on."""
+        name = command_name(command)
+        if isinstance(error, OSError):
+            self.metrics.count_error("command_failed")
+            self.log_message(f"[ERROR] {name} command from {username} failed: {error}")
+            await self.send_message(connection, f"[ERROR] {name} failed: {error.strerror or error}.")
+        else:
+            self.metrics.count_error("malformed_command")
+            self.log_message(f"[ERROR] Malformed {name} command from {username}: {error!r}")
+            await self.send_message(connection, f"[ERROR] Malformed {name} command.")
+
+    async def answered(self, connection, username, command, handler):
+        """Run a command handler spawned off the session, answering its failures as handle_client does."""
+        try:
+            await handler
+        except (ValueError, KeyError, OSError) as e:
+            await self.command_failed(connection, username, command, e)
+
+    @staticmethod
+    def accepted_codec(options):
+        """The codec a request's compress= option asks for, if we have it."""
+        codec = options.get("compress")
+        return codec if codec in available_codecs() else None
+
+    async def start_upload(self, session, command):
+        """Parse an [UPLOAD] request and set up the transfer it asks for.
+
+        Options: resume=1 continues a dropped upload where it stopped,
+        offset=N|length=M sends only that byte range of the file, and
+        compress=<codec> sends it compressed (data channel streams only).
+        source=<token> names the version of the file being sent (the client
+        uses its size and mtime), so a resume or range never lands on bytes
+        of another version; sha256= is checked before the file is committed.
+        """
+        connection, username = session.connection, session.username
+        (filename, filesize), options = parse_command(command, 2)
+        filesize = int(filesize)
+        if not valid_filename(filename):
+            await self.send_message(connection, f"[ERROR] Invalid file name '{filename}'.")
+            return
+        resume = options.get("resume") == "1"
+        ranged = "offset" in options or "length" in options
+        digest = options.get("sha256")
+        if digest and not (resume or ranged) and self.storage.has_blob(digest, filesize):
+            key = f"stream={options['stream']}" if "stream" in options else 0
+            if await self.link_upload(connection, username, filename, digest, key):
+                return
+            self.log_message(f"[UPLOAD] The stored content of {filename} is gone; receiving it from {username} after all.")
+
+        channel = session.get_data_channel(options.get("channel"))
+        if "delta" in options:
+            await self.start_delta_upload(session, filename, filesize, digest, channel, options)
+            return
+
+        # Parse everything before checking out the part file, so a malformed request holds nothing.
+        if not resume:
+            offset = int(options.get("offset", 0))
+            length = int(options.get("length", filesize - offset))
+        stream_id = int(options["stream"]) if "stream" in options else None
+        staged = self.staging.checkout(stored_name(username, filename), filesize, fresh=not (resume or ranged),
+                                       source=options.get("source"), digest=digest)
+        if staged is None:
+            await self.send_message(connection, f"[ERROR] Upload of '{filename}' failed: another version of it is being uploaded.")
+            return
+        if resume:
+            offset = staged.resume_offset()
+            length = filesize - offset
+        if offset < 0 or length < 0 or offset + length > filesize:
+            self.staging.checkin(staged)
+            await self.send_message(connection, f"[ERROR] Invalid byte range for '{filename}'.")
+            return
+        if resume:
+            self.log_message(f"[UPLOAD RESUME] {filename} from {username} resumes at byte {offset}.")
+        reply_options = {"offset": offset, "length": length} if resume or ranged else {}
+
+        if stream_id is not None and channel:
+            transfer = StreamTransfer(self, connection, channel, stream_id, filename, reply_options,
+                                      self.accepted_codec(options))
+            upload = self.handle_upload(transfer, connection, username, filename, staged, offset, length, not ranged)
+        else:
+            upload = self.handle_data_connection_upload(session, filename, staged, offset, length, not ranged, reply_options)
+        self.spawn(self.admitted(session, f"Upload of '{filename}'", upload, lambda: self.staging.checkin(staged)))
+
+    async def start_delta_upload(self, session, filename, filesize, digest, channel, options):
+        """Set up an [UPLOAD] that sends delta=N bytes of changes against the stored copy instead of the file.
+
+        block=B is the block size of the signatures the delta was made
+        from, and sha256= the digest the rebuilt file must have.
+        """
+        if "stream" not in options or channel is None or not digest:
+            await self.send_message(session.connection, f"[ERROR] Upload of '{filename}' failed: delta uploads need a data channel and sha256.")
+            return
+        delta_size, stream_id, block_size = int(options["delta"]), int(options["stream"]), int(options["block"])
+        delta = self.staging.reserve(stored_name(session.username, filename) + ".delta", delta_size)
+        transfer = StreamTransfer(self, session.connection, channel, stream_id, filename, codec=self.accepted_codec(options))
+        upload = self.handle_delta_upload(transfer, session.connection, session.username, filename, delta, filesize,
+                                          block_size, digest)
+        self.spawn(self.admitted(session, f"Upload of '{filename}'", upload, delta.discard))
+
+    async def start_download(self, session, command):
+        """Parse a [DOWNLOAD] request; offset=N and length=M ask for a byte range.
+
+        compress=<codec> asks for the file compressed; the reply names the
+        codec only if the server actually compresses it.  A client holding a
+        copy sends if_version= (or if_sha256=, which a dedup server can check
+        too) and, if the file hasn't changed, gets not_modified=1 back
+        instead of the data.  Replies to such requests, and to stream
+        requests, carry the file's version=; plain port replies keep the
+        original three fields the first clients split on.  A stream request
+        with if_match= (a version= from an earlier reply) is only served if
+        the file is still that version, and gets changed=1 otherwise, so a
+        download split into ranges never mixes two versions.
+        """
+        connection, username = session.connection, session.username
+        (filename, uploader), options = parse_command(command, 2)
+        offset = int(options.get("offset", 0))
+        length = int(options["length"]) if "length" in options else None
+        if offset < 0 or (length is not None and length < 0):
+            await self.send_message(connection, f"[ERROR] Invalid byte range for '{filename}'.")
+            return
+        reply_options = {key: options[key] for key in ("offset", "length") if key in options}
+
+        channel = session.get_data_channel(options.get("channel"))
+        stream = "stream" in options and channel
+        entry = self.catalog.get(uploader, filename)
+        if entry is not None and (stream or "if_version" in options or "if_sha256" in options):
+            version = file_version(entry)
+            reply_options["version"] = version
+            if options.get("if_version") == version or (entry.digest and options.get("if_sha256") == entry.digest):
+                # Unchanged: no data connection, no transfer slot, just this reply.
+                key = f"stream={options['stream']}" if stream else "-"
+                await self.send_message(connection, format_command("DOWNLOAD", key, filename, not_modified=1, version=version))
+                self.log_message(f"[DOWNLOAD SUCCESS] {filename} unchanged for {username}; not sent again.")
+                self.notify_uploader(uploader, filename, username)
+                return
+        if stream:
+            transfer = StreamTransfer(self, connection, channel, int(options["stream"]), filename, reply_options,
+                                      self.accepted_codec(options))
+            download = self.handle_download(transfer, connection, filename, uploader, username, offset, length,
+                                            options.get("if_match"))
+        else:
+            download = self.handle_data_connection(session, filename, uploader, offset, length, reply_options)
+        self.spawn(self.admitted(session, f"Download of '{filename}'", download))
+
+    async def handle_list_files(self, connection, command):
+        """Answer [LIST_FILES]: every file, or with options one page of them.
+
+        prefix=P and owner=O keep only the files whose name starts with P and
+        that O uploaded; limit=N returns at most N of them (up to
+        MAX_LIST_PAGE), in (filename, owner) order, starting after the file
+        after=F uploaded by after_owner=O.  Such a reply has a header line
+        with more=1 if there are further pages, and the catalog's epoch= and
+        seq=, from which a [SUBSCRIBE] picks up every change since.
+        """
+        if command == "[LIST_FILES]":
+            file_list = self.catalog.listing()
+            if file_list:
+                await self.send_message(connection, "[LIST_FILES]\n" + "\n".join(file_list))
+            else:
+                await self.send_message(connection, "[LIST_FILES]\nNo files available.")
+            return
+        _, options = parse_command(command, 0)
+        try:
+            limit = min(int(options.get("limit", MAX_LIST_PAGE)), MAX_LIST_PAGE)
+        except ValueError:
+            limit = MAX_LIST_PAGE
+        after = (options["after"], options.get("after_owner", "")) if "after" in options else None
+        entries, more = self.catalog.page(options.get("prefix", ""), options.get("owner"), after, limit)
+        header = format_command("LIST_FILES", epoch=self.catalog.epoch, seq=self.catalog.sequence, more=1 if more else None)
+        await self.send_message(connection, "\n".join([header] + [f"{entry.filename} (Uploaded by {entry.owner})"
+                                                                  for entry in entries]))
+
+    async def handle_subscribe(self, session, command):
+        """Start pushing catalog changes to the client as [CATALOG] messages (see CatalogFeed).
+
+        epoch=E|seq=N picks up after change N, e.g. where a feed left off
+        before a reconnect or where a paginated listing was taken.  The
+        reply gives the epoch and sequence number the feed starts from, with
+        reset=1 if the changes after N are no longer known; the client then
+        has to list the files again.
+        """
+        _, options = parse_command(command, 0)
+        catalog = self.catalog
+        sequence, reset = catalog.sequence, None
+        if "seq" in options:
+            try:
+                requested = int(options["seq"])
+            except ValueError:
+                requested = -1
+            if options.get("epoch") == catalog.epoch and catalog.changes_since(requested) is not None:
+                sequence = requested
+            else:
+                reset = 1
+        await self.send_message(session.connection, format_command("SUBSCRIBE", epoch=catalog.epoch, seq=sequence, reset=reset))
+        if session.feed_task is not None:
+            session.feed_task.cancel()
+        session.feed = CatalogFeed(session.connection, catalog, sequence, self.log_message)
+        session.feed_task = self.spawn(session.feed.run())
+
+    async def delete_file(self, username, filename):
+        """Delete one of username's files. Returns "deleted", "forbidden" or "missing"."""
+        if self.catalog.get(username, filename):
+            async with self.file_locks.write(stored_name(username, filename)):
+                entry = self.catalog.remove(username, filename)
+                self.catalog_changed(username, filename)
+                if entry:  # Still there after waiting for transfers of it to finish
+                    async with self.blob_locks(entry.digest):
+                        await self.loop.run_in_executor(None, self.storage.remove, entry.path, entry.digest)
+            self.log_message(f"[DELETE SUCCESS] {filename} deleted by {username}.")
+            return "deleted"
+        if self.catalog.owners_of(filename):  # File exists but belongs to another user
+            self.log_message(f"[DELETE ERROR] {username} attempted to delete {filename}, owned by another user.")
+            return "forbidden"
+        return "missing"
+
+    async def handle_delete(self, connection, username, command):
+        try:
+            (filename,), _ = parse_command(command, 1)
+            result = await self.delete_file(username, filename)
+            if result == "deleted":
+                await self.send_message(connection, f"[DELETE] File '{filename}' deleted successfully.")
+            elif result == "forbidden":
+                await self.send_message(connection, "[ERROR] You do not have permission to delete this file.")
+            else:
+                await self.send_message(connection, "[ERROR] File not found.")
+        except (OSError, ValueError) as e:
+            self.log_message(f"[ERROR] Failed to delete file: {e}")
+            self.metrics.count_error("delete")
+            await self.send_message(connection, "[ERROR] Could not delete file.")
+
+    async def batch_failed(self, connection, name, stream_id, error):
+        """Tell the client a batch transfer on stream_id failed with error."""
+        self.metrics.count_error("batch_failed")
+        self.log_message(f"[ERROR] {name} on stream {stream_id} failed: {error!r}")
+        reason = error.strerror if isinstance(error, OSError) and error.strerror else str(error) or type(error).__name__
+        await self.send_message(connection, f"[{name}][ERROR]|[{reason}]|[stream={stream_id}]")
+
+    async def handle_batch_delete(self, connection, username, command):
+        _, entries = parse_batch(command)
+        statuses = []
+        for fields in entries:
+            filename = fields[0]
+            try:
+                result = await self.delete_file(username, filename)
+            except OSError as e:
+                self.log_message(f"[ERROR] Failed to delete file: {e}")
+                self.metrics.count_error("delete")
+                result = "failed"
+            statuses.append((filename, {"deleted": "OK", "forbidden": "ERROR Permission denied",
+                                        "missing": "ERROR File not found"}.get(result, "ERROR Could not delete file")))
+        deleted = sum(status == "OK" for _, status in statuses)
+        await self.send_message(connection, format_batch(
+            f"[BATCH_DELETE][SERVER RESPONSE]|[{deleted} of {len(entries)} files deleted]", statuses))
+
+
+def read_content(path):
+    """A stored file's whole content, decompressed if it is kept compressed on disk."""
+    with open(path, "rb") as file:
+        header = read_container_header(file)
+        return b"".join(stored_chunks(file, header, 0, header[1] if header else None))
+
+
+def read_signatures(path, block_size):
+    """Block signatures and SHA-256 of a stored file's content (see delta.py)."""
+    with open(path, "rb") as file:
+        header = read_container_header(file)
+        return file_signatures(stored_chunks(file, header, 0, header[1] if header else None), block_size)
+
+
+def rebuild_file(stored_path, delta_path, out_path, block_size):
+    """Apply a delta to a stored file, writing the new version to out_path. Returns its (size, SHA-256 hex)."""
+    with open(stored_path, "rb") as stored, open(delta_path, "rb") as delta, open(out_path, "wb") as out:
+        header = read_container_header(stored)
+        if header is None:
+            return apply_delta(delta, stored, out, block_size)
+        # Kept compressed on disk; copying blocks needs random access to the plain bytes.
+        with tempfile.TemporaryFile(dir=os.path.dirname(out_path)) as base:
+            for chunk in stored_chunks(stored, header, 0, header[1]):
+                base.write(chunk)
+            return apply_delta(delta, base, out, block_size)
+
+
+def command_name(command):
+    """The name a command's latency is recorded under, e.g. "UPLOAD" for "[UPLOAD]|[a.txt]|[12]"."""
+    name = command[1:command.find("]")] if command.startswith("[") else ""
+    return name if name in COMMANDS else "OTHER"
+
+
+def raise_fd_limit():
+    """Lift the soft open-file limit to the hard limit so 10k+ clients fit."""
+    try:
+        import resource
+    except ImportError:  # Not available on Windows
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY or soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError):
+            pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the file server without a GUI.")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, required=True)
+    parser.add_argument("--storage", required=True, help="Directory to store uploaded files in")
+    parser.add_argument("--data-port-base", type=int, default=DATA_PORT_BASE)
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE, help="Receive buffer size in bytes")
+    parser.add_argument("--backend", choices=sorted(STORAGE_BACKENDS), default="flat",
+                        help="'dedup' stores identical uploads only once")
+    parser.add_argument("--layout", choices=sorted(STORAGE_LAYOUTS), default="flat",
+                        help="'sharded' spreads files over hashed subdirectories, for millions of files; "
+                             "files stored under another layout are moved over while the server runs")
+    parser.add_argument("--compress-at-rest", choices=[codec for codec in CONTAINER_CODECS if codec in available_codecs()],
+                        help="Keep uploads compressed on disk with this codec")
+    parser.add_argument("--read-cache-mb", type=int, default=READ_CACHE_SIZE // (1024 * 1024),
+                        help="Memory for caching popular files for downloads (0 to disable)")
+    parser.add_argument("--max-transfers", type=int, default=MAX_TRANSFERS,
+                        help="Transfers to run at once; more wait in a queue (per worker with --workers)")
+    parser.add_argument("--max-transfers-per-user", type=int, default=MAX_TRANSFERS_PER_USER,
+                        help="Transfers one user may run at once")
+    parser.add_argument("--user-rate-mb", type=float, help="Limit each user's transfers to this many MB/s")
+    parser.add_argument("--total-rate-mb", type=float,
+                        help="Limit all transfers together to this many MB/s (per worker with --workers)")
+    parser.add_argument("--durability", choices=DURABILITY_MODES, default="none",
+                        help="Sync uploads to disk before acknowledging them: 'fsync' each on its own, "
+                             "'group' together with others committing at the same time")
+    parser.add_argument("--metrics-port", type=int,
+                        help=f"Serve metrics in Prometheus text format on this port of {METRICS_HOST} "
+                             "(worker N of --workers uses this port + N)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Worker processes to spread clients over, to use more than one CPU core")
+    parser.add_argument("--worker-link", type=int, help=argparse.SUPPRESS)  # Set by the master for its workers
+    parser.add_argument("--worker-index", type=int, default=0, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    os.makedirs(args.storage, exist_ok=True)
+    raise_fd_limit()
+    if args.workers > 1 and args.worker_link is None:
+        if not cluster_supported():
+            parser.error("--workers needs a platform that can pass sockets between processes (Linux, macOS)")
+        server = Cluster([sys.executable, os.path.abspath(__file__)] + sys.argv[1:], args.workers, args.storage,
+                         storage=args.backend, layout=args.layout, host=args.host, port=args.port)
+    else:
+        cluster_link, log = None, print
+        if args.worker_link is not None:
+            cluster_link = socket.socket(fileno=args.worker_link)
+            log = lambda message, prefix=f"[WORKER {args.worker_index}] ": print(prefix + message, flush=True)
+        metrics_port = args.metrics_port + args.worker_index if args.metrics_port is not None else None
+        server = ServerEngine(args.storage, host=args.host, port=args.port, data_port_base=args.data_port_base,
+                              chunk_size=args.chunk_size, storage=args.backend, layout=args.layout,
+                              migrate=args.worker_index == 0,
+                              compress_at_rest=args.compress_at_rest, metrics_port=metrics_port,
+                              read_cache_size=args.read_cache_mb * 1024 * 1024, max_transfers=args.max_transfers,
+                              max_transfers_per_user=args.max_transfers_per_user,
+                              user_rate=args.user_rate_mb and args.user_rate_mb * 1024 * 1024,
+                              total_rate=args.total_rate_mb and args.total_rate_mb * 1024 * 1024,
+                              durability=args.durability, cluster_link=cluster_link, log=log)
+    try:
+        server.run()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
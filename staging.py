@@ -0,0 +1,207 @@
+"""Staging area for uploads that are still arriving.
+
+Uploads are written to <storage_dir>/.staging/<user>_<file>.part and only
+move into the storage directory once every byte has arrived.  A JSON sidecar
+next to each part file records the declared size and the byte ranges
+received so far, so a dropped upload can be resumed from where it stopped
+(even after a server restart) and ranges can arrive in any order.  The
+sidecar also records which version of the file the bytes came from (the
+client's source= token), so ranges of another version with the same size
+start over instead of being mixed in.
+
+A new part file is preallocated to the declared size, so the filesystem can
+lay it out in one piece and a disk too full for it is noticed before any
+data is sent rather than halfway through.
+"""
+import errno
+import json
+import os
+import time
+import uuid
+
+STAGING_DIR = ".staging"
+STAGING_MAX_AGE = 7 * 24 * 3600  # Seconds before an abandoned partial upload is removed
+
+
+def merge_range(ranges, start, end):
+    """Add [start, end) to a sorted list of disjoint ranges, merging neighbours."""
+    merged = []
+    for range_start, range_end in ranges:
+        if range_end < start or range_start > end:
+            merged.append([range_start, range_end])
+        else:
+            start, end = min(start, range_start), max(end, range_end)
+    merged.append([start, end])
+    merged.sort()
+    return merged
+
+
+def preallocate(file, size):
+    """Reserve size bytes of disk for an open file, where the platform and filesystem can.
+
+    Raises OSError(ENOSPC) if the disk is too full.  This can take a while:
+    where the filesystem has no fallocate, glibc reserves the space by
+    writing to every block, so call it off the event loop.
+    """
+    if size and hasattr(os, "posix_fallocate"):
+        try:
+            os.posix_fallocate(file.fileno(), 0, size)
+        except OSError as e:
+            if e.errno == errno.ENOSPC:
+                raise
+            # Refused for this file (EINVAL, EFBIG and the like); it just grows as written.
+
+
+class StagedUpload:
+    def __init__(self, staging_dir, name, size, source=None, digest=None):
+        self.name = name
+        self.size = size
+        self.source = source  # Client's token for the version being uploaded, if it sent one
+        self.digest = digest  # SHA-256 the complete file must have, if the client declared it
+        self.path = os.path.join(staging_dir, name + ".part")
+        self.meta_path = os.path.join(staging_dir, name + ".json")
+        self.ranges = []  # Sorted, disjoint [start, end) byte ranges received so far
+        self.users = 0  # Transfers currently writing into it
+        self.committed = False  # Moved into the storage directory
+        self.resumable = True  # Has a sidecar, so a dropped upload can continue from it
+
+    def load(self):
+        """Pick up a previous partial upload of the same size and source. Returns True if one existed."""
+        try:
+            with open(self.meta_path, "r", encoding="utf-8") as meta:
+                data = json.load(meta)
+        except (OSError, ValueError):
+            return False
+        if data.get("size") != self.size or data.get("source") != self.source or not os.path.exists(self.path):
+            return False
+        self.ranges = [list(received) for received in data.get("ranges", [])]
+        self.digest = self.digest or data.get("digest")
+        return True
+
+    def save(self):
+        temp_path = self.meta_path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as meta:
+            json.dump({"size": self.size, "source": self.source, "digest": self.digest, "ranges": self.ranges}, meta)
+        os.replace(temp_path, self.meta_path)
+
+    def matches(self, size, source):
+        return self.size == size and self.source == source
+
+    def open(self):
+        """Open the part file for writing at arbitrary offsets; a new one is preallocated (blocking, see preallocate)."""
+        if not os.path.exists(self.path):
+            with open(self.path, "wb") as file:
+                try:
+                    preallocate(file, self.size)
+                except OSError:
+                    file.close()
+                    os.remove(self.path)
+                    raise
+        return open(self.path, "r+b")
+
+    def add_range(self, start, end):
+        if end > start:
+            self.ranges = merge_range(self.ranges, start, end)
+            if self.resumable:
+                self.save()
+
+    def resume_offset(self):
+        """End of the contiguous run of bytes received from the start of the file."""
+        if self.ranges and self.ranges[0][0] == 0:
+            return self.ranges[0][1]
+        return 0
+
+    def missing_ranges(self):
+        missing = []
+        position = 0
+        for start, end in self.ranges:
+            if start > position:
+                missing.append((position, start))
+            position = max(position, end)
+        if position < self.size:
+            missing.append((position, self.size))
+        return missing
+
+    def is_complete(self):
+        return self.resume_offset() >= self.size
+
+    def discard(self):
+        for path in (self.path, self.meta_path):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+class StagingArea:
+    def __init__(self, storage_dir):
+        self.staging_dir = os.path.join(storage_dir, STAGING_DIR)
+        self.active = {}  # name -> StagedUpload being written
+
+    def checkout(self, name, size, fresh=False, source=None, digest=None):
+        """Return the staged upload for name, starting over if fresh or the size or source changed.
+
+        A fresh upload while another transfer is still writing name gets a
+        part file of its own (see reserve()), so neither overwrites the
+        other; whichever finishes last is the one kept.  Returns None for a
+        range or resume of another version while one is being written: the
+        two can't share a part file, and the other can't be thrown away.
+        """
+        staged = self.active.get(name)
+        busy = staged is not None and staged.users and not staged.committed
+        if fresh and busy:
+            staged = self.reserve(name, size)
+        elif busy and not staged.matches(size, source):
+            return None
+        elif staged is None or not staged.matches(size, source) or staged.committed:
+            os.makedirs(self.staging_dir, exist_ok=True)
+            staged = StagedUpload(self.staging_dir, name, size, source, digest)
+            if fresh or not staged.load():
+                staged.discard()
+                staged.save()
+            self.active[name] = staged
+        if digest and digest != staged.digest:
+            staged.digest = digest  # The last declaration wins; the commit checks it
+            if staged.resumable:
+                staged.save()
+        staged.users += 1
+        return staged
+
+    def reserve(self, name, size):
+        """A staged upload of name for one transfer alone, e.g. a file of a batch.
+
+        It is never shared or resumed, so it has no sidecar; cleanup() still
+        removes its part file if the transfer is abandoned.
+        """
+        os.makedirs(self.staging_dir, exist_ok=True)
+        staged = StagedUpload(self.staging_dir, f"{name}.{uuid.uuid4().hex[:8]}", size)
+        staged.resumable = False
+        return staged
+
+    def checkin(self, staged):
+        staged.users -= 1
+        if not staged.users and self.active.get(staged.name) is staged:
+            del self.active[staged.name]
+        elif not staged.users and not staged.resumable and not staged.committed:
+            staged.discard()  # Nothing can pick it up again
+
+    def cleanup(self, max_age=STAGING_MAX_AGE):
+        """Remove partial uploads nobody has touched for max_age seconds. Returns how many."""
+        if not os.path.isdir(self.staging_dir):
+            return 0
+        cutoff = time.time() - max_age
+        removed = 0
+        with os.scandir(self.staging_dir) as scan:
+            for item in scan:
+                name, ext = os.path.splitext(item.name)
+                if ext not in (".json", ".part") or name in self.active:
+                    continue
+                if ext == ".part" and os.path.exists(os.path.join(self.staging_dir, name + ".json")):
+                    continue  # Handled along with its sidecar
+                part_path = os.path.join(self.staging_dir, name + ".part")
+                newest = max(item.stat().st_mtime,
+                             os.path.getmtime(part_path) if os.path.exists(part_path) else 0)
+                if newest < cutoff:
+                    StagedUpload(self.staging_dir, name, None).discard()
+                    removed += 1
+        return removed
@@ -0,0 +1,275 @@
+"""Storage backends: how committed uploads are laid out on disk.
+
+FlatStorage keeps every upload as its own file, where the layout puts it:
+
+    flat     <owner>_<filename> right in the storage directory, which is
+             what the server has always done.
+    sharded  <aa>/<bb>/<owner>_<filename>, where aa is a hash of the owner
+             and bb one of the filename, so no directory holds more than a
+             small share of the files even with millions of them.  Both
+             names are quoted (see catalog.quote_name) so any character a
+             client sends is safe on disk and can be decoded again.
+
+Files are found by their catalog entry, which records each one's path, and
+a scan picks up files in either layout.  So a server can be switched to
+another layout at any time: files stored under the old one keep working,
+and the server moves them over in the background while it runs (see
+ServerEngine.migrate_layout).
+
+DedupStorage keeps the same names but makes each of them a hard link to a
+content-addressed blob, <storage_dir>/.blobs/<aa>/<sha256>, so identical
+uploads share one copy on disk.  The filesystem's link count is the blob's
+reference count: a blob is deleted once no name links to it any more.
+Because the names stay where they were, listing, downloading and deleting
+work exactly as with FlatStorage, and the catalog can still be rebuilt from
+a directory scan.  Where hard links are not supported the upload is simply
+stored as its own file.
+"""
+import hashlib
+import os
+import re
+import uuid
+from urllib.parse import unquote
+
+from catalog import quote_name, split_stored_name, stored_name
+
+BLOB_DIR = ".blobs"
+HASH_CHUNK_SIZE = 1024 * 1024
+DIGEST_PATTERN = re.compile(r"[0-9a-f]{64}")
+SHARD_PATTERN = re.compile(r"[0-9a-f]{2}")
+UNSAFE_CHARACTERS = '/\\:*?"<>|'  # Quoted in sharded names; not allowed in file names somewhere
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        while chunk := file.read(HASH_CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def shard(name):
+    return hashlib.blake2b(name.encode("utf-8", "surrogatepass"), digest_size=1).hexdigest()
+
+
+def sharded_path(owner, filename):
+    leaf = f"{quote_name(owner, '_' + UNSAFE_CHARACTERS)}_{quote_name(filename, UNSAFE_CHARACTERS)}"
+    return os.path.join(shard(owner), shard(filename), leaf)
+
+
+STORAGE_LAYOUTS = {
+    "flat": stored_name,
+    "sharded": sharded_path,
+}
+
+
+class FlatStorage:
+    name = "flat"
+
+    def __init__(self, storage_dir, layout="flat"):
+        self.storage_dir = storage_dir
+        self.layout = layout
+        self._path_for = STORAGE_LAYOUTS[layout]
+
+    def path_for(self, owner, filename):
+        """Path of an entry's file, relative to the storage directory."""
+        return self._path_for(owner, filename)
+
+    def full_path(self, path):
+        return os.path.join(self.storage_dir, path)
+
+    def prepare(self):
+        """Get ready to serve; returns a line for the log, or None."""
+        return None
+
+    def shard_dirs(self):
+        """Yield a DirEntry for every shard directory, both levels."""
+        with os.scandir(self.storage_dir) as scan:
+            for item in scan:
+                if SHARD_PATTERN.fullmatch(item.name) and item.is_dir():
+                    yield item
+                    with os.scandir(item.path) as sub_scan:
+                        for sub_item in sub_scan:
+                            if SHARD_PATTERN.fullmatch(sub_item.name) and sub_item.is_dir():
+                                yield sub_item
+
+    def scan(self):
+        """Yield (owner, filename, path, stat, digest) for every stored file, in any layout."""
+        with os.scandir(self.storage_dir) as scan:
+            for item in scan:
+                # Skip our own bookkeeping (dot entries) and files not named <owner>_<file>.
+                if item.name.startswith(".") or not item.is_file():
+                    continue
+                names = split_stored_name(item.name)
+                if names is not None:
+                    yield *names, item.name, item.stat(), None
+        for shard_dir in self.shard_dirs():
+            if os.path.dirname(shard_dir.path) == self.storage_dir:
+                continue  # Only the second level holds files
+            with os.scandir(shard_dir.path) as scan:
+                for item in scan:
+                    names = split_stored_name(item.name) if item.is_file() else None
+                    if names is not None:
+                        owner, filename = names
+                        yield owner, unquote(filename), os.path.relpath(item.path, self.storage_dir), item.stat(), None
+
+    def state(self):
+        """A value that changes whenever a file is added to or removed from the storage directory or a shard."""
+        newest = os.stat(self.storage_dir).st_mtime_ns
+        for shard_dir in self.shard_dirs():
+            newest = max(newest, shard_dir.stat().st_mtime_ns)
+        return newest
+
+    def make_dirs(self, path):
+        directory = os.path.dirname(self.full_path(path))
+        if directory != self.storage_dir:
+            os.makedirs(directory, exist_ok=True)
+
+    def commit(self, staged_path, path, replaced=None):
+        """Move a fully received upload into place, replacing the FileEntry replaced if given.
+
+        Returns the upload's content digest, if tracked.
+        """
+        self.make_dirs(path)
+        os.replace(staged_path, self.full_path(path))
+        self.drop_moved(path, replaced)
+        return None
+
+    def drop_moved(self, path, replaced):
+        """Remove the replaced entry's file if it was stored under another layout."""
+        if replaced is not None and replaced.path != path:
+            try:
+                os.remove(self.full_path(replaced.path))
+            except FileNotFoundError:
+                pass
+
+    def move(self, path, new_path):
+        """Move a stored file to new_path, e.g. into the current layout."""
+        self.make_dirs(new_path)
+        os.replace(self.full_path(path), self.full_path(new_path))
+
+    def commit_dirs(self, path, digest=None):
+        """Directories a commit or link of path changed, to sync for durability; shards that were created, too."""
+        dirs = []
+        directory = os.path.dirname(self.full_path(path))
+        while directory != self.storage_dir:
+            dirs.append(directory)
+            directory = os.path.dirname(directory)
+        return dirs + [self.storage_dir]
+
+    def remove(self, path, digest=None):
+        os.remove(self.full_path(path))
+
+    def has_blob(self, digest, size):
+        return False
+
+
+class DedupStorage(FlatStorage):
+    name = "dedup"
+
+    def __init__(self, storage_dir, layout="flat"):
+        super().__init__(storage_dir, layout)
+        self.blob_dir = os.path.join(storage_dir, BLOB_DIR)
+        self.blob_digests = {}  # (st_dev, st_ino) -> digest, to recognise links when rescanning
+
+    def blob_path(self, digest):
+        return os.path.join(self.blob_dir, digest[:2], digest)
+
+    def prepare(self):
+        """Index the blob store and drop blobs that nothing links to any more."""
+        os.makedirs(self.blob_dir, exist_ok=True)
+        self.blob_digests.clear()
+        removed = 0
+        for prefix in os.listdir(self.blob_dir):
+            prefix_dir = os.path.join(self.blob_dir, prefix)
+            if not os.path.isdir(prefix_dir):
+                os.remove(prefix_dir)  # Leftover temporary link from a crash
+                continue
+            for digest in os.listdir(prefix_dir):
+                stat = os.stat(os.path.join(prefix_dir, digest))
+                if stat.st_nlink <= 1:
+                    os.remove(os.path.join(prefix_dir, digest))
+                    removed += 1
+                else:
+                    self.blob_digests[(stat.st_dev, stat.st_ino)] = digest
+        return f"[STORAGE] {len(self.blob_digests)} shared blobs, {removed} unreferenced blobs removed."
+
+    def scan(self):
+        for owner, filename, path, stat, _ in super().scan():
+            yield owner, filename, path, stat, self.blob_digests.get((stat.st_dev, stat.st_ino))
+
+    def commit(self, staged_path, path, replaced=None):
+        self.make_dirs(path)
+        digest = file_digest(staged_path)
+        blob_path = self.blob_path(digest)
+        if self.has_blob(digest, os.path.getsize(staged_path)):
+            source_path = staged_path  # Same content is already stored; drop this copy
+        else:
+            os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            os.replace(staged_path, blob_path)
+            source_path = blob_path
+        try:
+            self.link(blob_path, path)
+        except OSError:
+            # No hard links here (e.g. FAT); keep this upload as a plain file.
+            os.replace(source_path, self.full_path(path))
+            digest = None
+        else:
+            if source_path == staged_path:
+                os.remove(staged_path)
+        self.release_replaced(path, replaced, digest)
+        return digest
+
+    def link(self, blob_path, path):
+        """Point path at blob_path, atomically replacing whatever was there."""
+        temp_path = os.path.join(self.blob_dir, f"link-{uuid.uuid4().hex}")
+        os.link(blob_path, temp_path)
+        try:
+            os.replace(temp_path, self.full_path(path))
+        except OSError:
+            os.remove(temp_path)
+            raise
+        stat = os.stat(blob_path)
+        self.blob_digests[(stat.st_dev, stat.st_ino)] = os.path.basename(blob_path)
+
+    def commit_dirs(self, path, digest=None):
+        dirs = super().commit_dirs(path)
+        return dirs + [os.path.dirname(self.blob_path(digest))] if digest else dirs
+
+    def link_existing(self, digest, path, replaced=None):
+        """Store path as another reference to an existing blob, without any data."""
+        self.make_dirs(path)
+        self.link(self.blob_path(digest), path)
+        self.release_replaced(path, replaced, digest)
+
+    def release_replaced(self, path, replaced, digest):
+        self.drop_moved(path, replaced)  # First, so its link doesn't keep the old blob alive
+        if replaced is not None and replaced.digest and replaced.digest != digest:
+            self.release(replaced.digest)
+
+    def remove(self, path, digest=None):
+        os.remove(self.full_path(path))
+        if digest:
+            self.release(digest)
+
+    def release(self, digest):
+        """Delete a blob once its last name is gone."""
+        blob_path = self.blob_path(digest)
+        try:
+            stat = os.stat(blob_path)
+        except FileNotFoundError:
+            return
+        if stat.st_nlink <= 1:
+            os.remove(blob_path)
+            self.blob_digests.pop((stat.st_dev, stat.st_ino), None)
+
+    def has_blob(self, digest, size):
+        if not DIGEST_PATTERN.fullmatch(digest):
+            return False
+        try:
+            return os.path.getsize(self.blob_path(digest)) == size
+        except OSError:
+            return False
+
+
+STORAGE_BACKENDS = {backend.name: backend for backend in (FlatStorage, DedupStorage)}
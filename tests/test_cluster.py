@@ -0,0 +1,99 @@
+"""The multi-process server (--workers) against real worker processes."""
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cluster  # noqa: E402
+from client import FileClient  # noqa: E402
+
+SERVER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "server_engine.py")
+
+
+@unittest.skipUnless(cluster.supported(), "needs socket passing between processes")
+class ClusterTest(unittest.TestCase):
+    def setUp(self):
+        self.temp = tempfile.TemporaryDirectory()
+        self.storage_dir = os.path.join(self.temp.name, "storage")
+        os.makedirs(self.storage_dir)
+        self.log = []
+        command = [sys.executable, SERVER, "--port", "0", "--storage", self.storage_dir]
+        self.cluster = cluster.Cluster(command, 2, self.storage_dir, host="127.0.0.1", port=0, log=self.log.append)
+        self.thread = threading.Thread(target=self.cluster.run, daemon=True)
+        self.thread.start()
+        deadline = time.monotonic() + 5
+        while not self.cluster.port:
+            self.assertLess(time.monotonic(), deadline, "cluster did not start")
+            time.sleep(0.01)
+
+    def tearDown(self):
+        self.cluster.stop()
+        self.thread.join(15)
+        self.temp.cleanup()
+
+    def client(self, username):
+        return FileClient("127.0.0.1", self.cluster.port, username, streams=1)
+
+    def test_workers_share_the_catalog(self):
+        path = os.path.join(self.temp.name, "shared.txt")
+        with open(path, "wb") as file:
+            file.write(b"from alice")
+        # Logins take turns, so alice and bob land on different workers.
+        with self.client("alice") as alice, self.client("bob") as bob:
+            self.assertTrue(alice.upload(path).ok)
+            deadline = time.monotonic() + 5
+            while ("shared.txt", "alice") not in bob.list_files():  # The change reaches bob's worker via the master
+                self.assertLess(time.monotonic(), deadline, "bob's worker never heard of the upload")
+                time.sleep(0.05)
+            download_dir = os.path.join(self.temp.name, "bob")
+            os.makedirs(download_dir)
+            self.assertTrue(bob.download("shared.txt", "alice", download_dir).ok)
+            with open(os.path.join(download_dir, "shared.txt"), "rb") as file:
+                self.assertEqual(file.read(), b"from alice")
+
+    def test_workers_number_changes_alike(self):
+        paths = []
+        for name in ("a.txt", "b.txt"):
+            paths.append(os.path.join(self.temp.name, name))
+            with open(paths[-1], "wb") as file:
+                file.write(name.encode())
+        changes = {"alice": [], "bob": []}
+        with self.client("alice") as alice, self.client("bob") as bob:
+            start = alice.list_page().position
+            self.assertEqual(bob.list_page().position, start)  # One epoch and sequence for the whole cluster
+            self.assertTrue(alice.subscribe(changes["alice"].append, since=start))
+            self.assertTrue(bob.subscribe(changes["bob"].append, since=start))
+            self.assertTrue(alice.upload(paths[0]).ok)
+            self.assertTrue(bob.upload(paths[1]).ok)
+            self.assertTrue(alice.delete("a.txt").ok)
+            deadline = time.monotonic() + 5
+            while len(changes["alice"]) < 3 or len(changes["bob"]) < 3:
+                self.assertLess(time.monotonic(), deadline, "catalog changes did not arrive")
+                time.sleep(0.05)
+        self.assertEqual(changes["alice"], changes["bob"])
+        # Changes from two workers may reach the master in either order; both workers get its order.
+        self.assertEqual(sorted((change.kind, change.filename) for change in changes["alice"]),
+                         [("added", "a.txt"), ("added", "b.txt"), ("removed", "a.txt")])
+
+    def test_oversized_first_message(self):
+        with socket.create_connection(("127.0.0.1", self.cluster.port)) as sock:
+            size = 300 * 1024
+            sock.sendall(size.to_bytes(4, "big") + b"x" * size)
+            sock.settimeout(5)
+            try:
+                self.assertEqual(sock.recv(1), b"")  # Refused by the master
+            except ConnectionResetError:
+                pass  # Closed with the rest unread
+        for index in range(4):  # Every worker still takes logins
+            with self.client(f"user{index}") as client:
+                self.assertEqual(client.list_files(), [])
+        self.assertFalse([line for line in self.log if "exited" in line])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,479 @@
+"""Uploads against a real server on a loopback port."""
+import asyncio
+import errno
+import hashlib
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import compression  # noqa: E402
+import delta  # noqa: E402
+import staging  # noqa: E402
+from catalog import stored_name  # noqa: E402
+from client import FileClient, Progress  # noqa: E402
+from protocol import format_batch, format_command  # noqa: E402
+from server_engine import ServerEngine  # noqa: E402
+from storage import sharded_path  # noqa: E402
+
+
+class ServerTestCase(unittest.TestCase):
+    server_options = {}
+
+    def setUp(self):
+        self.temp = tempfile.TemporaryDirectory()
+        self.storage_dir = os.path.join(self.temp.name, "storage")
+        os.makedirs(self.storage_dir)
+        self.populate()
+        self.log = []
+        self.server = ServerEngine(self.storage_dir, host="127.0.0.1", port=0, log=self.log.append,
+                                   **self.server_options)
+        self.thread = threading.Thread(target=self.server.run, daemon=True)
+        self.thread.start()
+        deadline = time.monotonic() + 5
+        while not self.server.is_running:
+            self.assertLess(time.monotonic(), deadline, "server did not start")
+            time.sleep(0.01)
+
+    def populate(self):
+        """Put files in the storage directory before the server starts."""
+
+    def tearDown(self):
+        self.server.stop()
+        self.thread.join(5)
+        self.temp.cleanup()
+
+    def wait_for_log(self, text):
+        """Wait for a server log line containing text; the server logs a transfer after replying."""
+        deadline = time.monotonic() + 5
+        while not any(text in message for message in self.log):
+            self.assertLess(time.monotonic(), deadline, f"the server never logged {text!r}")
+            time.sleep(0.01)
+
+    def local_file(self, directory, name, content):
+        path = os.path.join(self.temp.name, directory, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as file:
+            file.write(content)
+        return path
+
+
+class ConcurrentUploadTest(ServerTestCase):
+    # Slow enough that the two uploads below overlap.
+    server_options = {"user_rate": 1024 * 1024}
+
+    def test_two_uploads_of_one_name(self):
+        contents = [os.urandom(2 * 1024 * 1024) for _ in range(2)]
+        paths = [self.local_file(f"copy{index}", "same.bin", content) for index, content in enumerate(contents)]
+        results = [None, None]
+        with FileClient("127.0.0.1", self.server.port, "alice", streams=1) as client:
+            def upload(index):
+                results[index] = client.upload(paths[index])
+
+            threads = [threading.Thread(target=upload, args=(index,)) for index in range(2)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join(30)
+            self.assertFalse(any(thread.is_alive() for thread in threads), "an upload never got its reply")
+        self.assertTrue(all(result.ok for result in results), results)
+
+        entry = self.server.catalog.get("alice", "same.bin")
+        with open(self.server.catalog.path_of(entry), "rb") as file:
+            self.assertIn(file.read(), contents)  # One upload or the other, never a mix
+        self.assertEqual(os.listdir(os.path.join(self.storage_dir, ".staging")), [])
+
+
+class RangedUploadTest(ServerTestCase):
+    def upload_range(self, client, path, offset, length, source, digest=None):
+        return client.upload_stream(client.data_channel, path, "file.bin", 4096, Progress(), offset=offset, length=length,
+                                    source=source, digest=digest)
+
+    def test_ranges_of_another_version_start_over(self):
+        old = self.local_file("old", "file.bin", b"O" * 4096)
+        new = self.local_file("new", "file.bin", b"N" * 4096)
+        with FileClient("127.0.0.1", self.server.port, "alice", streams=1) as client:
+            self.assertTrue(self.upload_range(client, old, 2048, 2048, "old")[0])
+            ok, message = self.upload_range(client, new, 0, 2048, "new")
+            self.assertTrue(ok)
+            self.assertNotIn("uploaded successfully", message)  # The old half was thrown away
+            self.assertIsNone(self.server.catalog.get("alice", "file.bin"))
+            ok, message = self.upload_range(client, new, 2048, 2048, "new")
+            self.assertIn("uploaded successfully", message)
+        entry = self.server.catalog.get("alice", "file.bin")
+        with open(self.server.catalog.path_of(entry), "rb") as file:
+            self.assertEqual(file.read(), b"N" * 4096)
+
+    def test_declared_digest_is_checked(self):
+        path = self.local_file("local", "file.bin", b"N" * 4096)
+        wrong = hashlib.sha256(b"O" * 4096).hexdigest()
+        with FileClient("127.0.0.1", self.server.port, "alice", streams=1) as client:
+            self.assertTrue(self.upload_range(client, path, 0, 2048, "v1", wrong)[0])
+            ok, message = self.upload_range(client, path, 2048, 2048, "v1")
+            self.assertFalse(ok)
+            self.assertIn("doesn't match its sha256", message)
+        self.assertIsNone(self.server.catalog.get("alice", "file.bin"))
+
+
+class ParallelTransferTest(ServerTestCase):
+    def parallel_client(self, username):
+        return FileClient("127.0.0.1", self.server.port, username, streams=2, range_size=64 * 1024,
+                          parallel_threshold=64 * 1024, delta=False)
+
+    def test_download_of_a_file_replaced_midway(self):
+        old, new = os.urandom(512 * 1024), os.urandom(512 * 1024)
+        path = self.local_file("local", "big.bin", old)
+        target = os.path.join(self.temp.name, "downloads")
+        os.makedirs(target)
+        with self.parallel_client("alice") as alice, self.parallel_client("bob") as bob:
+            self.assertTrue(alice.upload(path).ok)
+            download_stream = bob.download_stream
+
+            def replaced_after_first_range(*args, **kwargs):
+                result = download_stream(*args, **kwargs)
+                if bob.download_stream is replaced_after_first_range:
+                    bob.download_stream = download_stream
+                    self.local_file("local", "big.bin", new)
+                    self.assertTrue(alice.upload(path).ok)
+                return result
+
+            bob.download_stream = replaced_after_first_range
+            result = bob.download("big.bin", "alice", target)
+            self.assertFalse(result.ok)
+            self.assertIn("changed on the server", result.message)
+            self.assertEqual(os.listdir(target), [])
+            self.assertTrue(bob.download("big.bin", "alice", target).ok)
+        with open(os.path.join(target, "big.bin"), "rb") as file:
+            self.assertEqual(file.read(), new)
+
+    def test_upload_of_a_file_changed_midway(self):
+        path = self.local_file("local", "big.bin", os.urandom(512 * 1024))
+        with self.parallel_client("alice") as client:
+            upload_stream = client.upload_stream
+
+            def changed_after_first_check(*args, **kwargs):
+                client.upload_stream = upload_stream
+                self.local_file("local", "big.bin", os.urandom(512 * 1024))
+                return upload_stream(*args, **kwargs)
+
+            client.upload_stream = changed_after_first_check
+            result = client.upload(path)
+            self.assertFalse(result.ok)
+            self.assertIn("changed while it was being uploaded", result.message)
+        self.assertIsNone(self.server.catalog.get("alice", "big.bin"))
+
+    def test_file_shorter_than_announced(self):
+        path = self.local_file("local", "short.bin", b"x" * 1000)
+        with FileClient("127.0.0.1", self.server.port, "alice", streams=1) as client:
+            with self.assertRaises(OSError):
+                client.data_channel.send_file(999, path, 0, 5000)  # A stream the server doesn't know
+            self.assertTrue(client.upload(path).ok)  # The channel is still in step
+        self.assertEqual(self.server.catalog.get("alice", "short.bin").size, 1000)
+
+
+class OverrunUploadTest(ServerTestCase):
+    def test_stream_longer_than_declared(self):
+        path = self.local_file("local", "over.bin", os.urandom(5000))
+        with FileClient("127.0.0.1", self.server.port, "alice", streams=1) as client:
+            # Declare fewer bytes than send_file will put on the stream.
+            ok, message = client.upload_stream(client.data_channel, path, "over.bin", 1000, Progress())
+            self.assertFalse(ok)
+            self.assertIn("more than 1000 bytes", message)
+            self.assertIsNone(self.server.catalog.get("alice", "over.bin"))
+            self.assertTrue(client.upload(path).ok)  # The channel and the connection still work
+        self.assertEqual(self.server.catalog.get("alice", "over.bin").size, 5000)
+
+
+class PreallocationTest(ServerTestCase):
+    server_options = {"durability": "group"}
+
+    def test_off_the_event_loop(self):
+        preallocate = staging.preallocate
+        on_loop = []
+
+        def recording_preallocate(file, size):
+            try:
+                asyncio.get_running_loop()
+                on_loop.append(size)
+            except RuntimeError:
+                pass
+            preallocate(file, size)
+
+        staging.preallocate = recording_preallocate
+        try:
+            paths = [self.local_file("local", f"{index}.bin", os.urandom(100000)) for index in range(3)]
+            with FileClient("127.0.0.1", self.server.port, "alice", streams=1) as client:
+                self.assertTrue(all(result.ok for result in [client.upload(path) for path in paths]))
+                self.assertTrue(client.upload_many(paths).ok)
+        finally:
+            staging.preallocate = preallocate
+        self.assertEqual(on_loop, [])
+        self.assertEqual(len(self.server.catalog.listing()), 3)
+
+
+class DedupUploadTest(ServerTestCase):
+    server_options = {"storage": "dedup"}
+
+    def blob_path(self, content):
+        return self.server.storage.blob_path(hashlib.sha256(content).hexdigest())
+
+    def test_link_and_release(self):
+        content = os.urandom(100000)
+        path = self.local_file("local", "shared.bin", content)
+        with FileClient("127.0.0.1", self.server.port, "alice", streams=1) as alice, \
+                FileClient("127.0.0.1", self.server.port, "bob", streams=1) as bob:
+            self.assertTrue(alice.upload(path).ok)
+            self.assertTrue(bob.upload(path).ok)
+            self.wait_for_log("no data sent")
+            self.assertEqual(os.stat(self.blob_path(content)).st_nlink, 3)  # The blob and both names
+            target = os.path.join(self.temp.name, "downloads")
+            os.makedirs(target)
+            self.assertTrue(bob.download("shared.bin", "alice", target).ok)
+            with open(os.path.join(target, "shared.bin"), "rb") as file:
+                self.assertEqual(file.read(), content)
+            self.assertTrue(alice.delete("shared.bin").ok)
+            self.assertEqual(os.stat(self.blob_path(content)).st_nlink, 2)
+            self.assertTrue(bob.delete("shared.bin").ok)
+            self.assertFalse(os.path.exists(self.blob_path(content)))
+
+    def test_blob_gone_before_linking(self):
+        content = os.urandom(100000)
+        path = self.local_file("local", "new.bin", content)
+        storage = self.server.storage
+        has_blob = storage.has_blob
+
+        def deleted_after_lookup(digest, size):
+            storage.has_blob = has_blob
+            return True
+
+        storage.has_blob = deleted_after_lookup
+        with FileClient("127.0.0.1", self.server.port, "alice", streams=1) as client:
+            self.assertTrue(client.upload(path).ok)
+        self.assertIs(storage.has_blob, has_blob)
+        with open(self.server.catalog.path_of(self.server.catalog.get("alice", "new.bin")), "rb") as file:
+            self.assertEqual(file.read(), content)
+        self.assertEqual(os.stat(self.blob_path(content)).st_nlink, 2)
+
+
+class CompressedUploadTest(ServerTestCase):
+    def test_inflates_past_declared_length(self):
+        path = self.local_file("local", "bomb.bin", b"a" * 1024 * 1024)
+        with FileClient("127.0.0.1", self.server.port, "alice", streams=1) as client:
+            self.assertTrue(client.codec)
+            ok, message = client.upload_stream(client.data_channel, path, "bomb.bin", 1000, Progress())
+            self.assertFalse(ok)
+            self.assertIn("more than 1000 bytes", message)
+        self.assertIsNone(self.server.catalog.get("alice", "bomb.bin"))
+
+    @unittest.skipUnless(compression.zstandard, "zstandard is not installed")
+    def test_zstd_output_is_bounded(self):
+        compressor = compression.zstandard.ZstdCompressor().compressobj()
+        bomb = b"".join(compressor.compress(bytes(64 * 1024 * 1024)) for _ in range(4)) + compressor.flush()
+        decompressor = compression.Decompressor("zstd")
+        total = 0
+        for piece in decompressor.feed(bomb):
+            self.assertLessEqual(len(piece), compression.CHUNK_SIZE)
+            total += len(piece)
+            if total > 4 * compression.CHUNK_SIZE:
+                break  # As DecompressingSink does once the declared size is passed
+        path = self.local_file("local", "bomb.bin", bytes(1024 * 1024))
+        with FileClient("127.0.0.1", self.server.port, "alice", streams=1) as client:
+            ok, message = client.upload_stream(client.data_channel, path, "bomb.bin", 1000, Progress(), codec="zstd")
+            self.assertFalse(ok)
+            self.assertIn("more than 1000 bytes", message)
+
+    def test_compressed_frames_without_a_codec(self):
+        path = self.local_file("local", "text.txt", b"some text " * 10000)
+        with FileClient("127.0.0.1", self.server.port, "alice", streams=1) as client:
+            channel = client.data_channel
+            send_file = channel.send_file
+            client.codec = None  # The upload asks for no compression, and the frames come compressed anyway
+            channel.send_file = lambda stream_id, filepath, offset, count, codec, progress: \
+                send_file(stream_id, filepath, offset, count, "zlib", progress)
+            self.assertFalse(client.upload(path).ok)
+            channel.send_file = send_file
+            self.assertTrue(client.upload(path).ok)  # Only that stream was aborted
+        self.assertEqual(self.server.catalog.get("alice", "text.txt").size, 100000)
+
+
+class MalformedCommandTest(ServerTestCase):
+    def test_connection_survives(self):
+        path = self.local_file("local", "a.txt", b"hello")
+        with FileClient("127.0.0.1", self.server.port, "alice", streams=1) as client:
+            for command, reply in (("[UPLOAD]|[a.txt]|[5]|[offset=abc]", "[ERROR] Malformed UPLOAD command."),
+                                   ("[UPLOAD]|[a.txt]|[five]", "[ERROR] Malformed UPLOAD command."),
+                                   ("[DOWNLOAD]|[a.txt]", "[ERROR] Malformed DOWNLOAD command.")):
+                with client.expect(lambda message: message.startswith("[ERROR] Malformed"), command) as waiter:
+                    self.assertEqual(waiter.get(timeout=5), reply)
+            self.assertTrue(client.upload(path).ok)
+        self.assertEqual(os.listdir(os.path.join(self.storage_dir, ".staging")), [])
+
+    def test_signatures_and_disk_errors(self):
+        path = self.local_file("local", "a.txt", b"hello")
+        checkout = self.server.staging.checkout
+
+        def full_disk(*args, **kwargs):
+            raise OSError(errno.ENOSPC, os.strerror(errno.ENOSPC))
+
+        self.server.staging.checkout = full_disk
+        with FileClient("127.0.0.1", self.server.port, "alice", streams=1) as client:
+            for command, reply in (("[SIGNATURES]", "[ERROR] Malformed SIGNATURES command."),
+                                   ("[UPLOAD]|[a.txt]|[5]", f"[ERROR] UPLOAD failed: {os.strerror(errno.ENOSPC)}.")):
+                with client.expect(lambda message: message.startswith("[ERROR]"), command) as waiter:
+                    self.assertEqual(waiter.get(timeout=5), reply)
+            self.server.staging.checkout = checkout
+            self.assertTrue(client.upload(path).ok)
+
+    def test_path_in_file_name(self):
+        with FileClient("127.0.0.1", self.server.port, "alice", streams=1) as client:
+            for name in ("sub/x.txt", "..", "a\\b"):
+                command = format_command("UPLOAD", name, 5)
+                with client.expect(lambda message: message.startswith("[ERROR]"), command) as waiter:
+                    self.assertEqual(waiter.get(timeout=5), f"[ERROR] Invalid file name '{name}'.")
+        self.assertEqual(self.server.catalog.listing(), [])
+
+
+class BatchTest(ServerTestCase):
+    def test_failure_closes_only_its_stream(self):
+        paths = [self.local_file("local", name, name.encode() * 1000) for name in ("a.txt", "b.txt")]
+        commit_upload = self.server.commit_upload
+
+        async def failing_commit(*args):
+            raise RuntimeError("commit failed")
+
+        self.server.commit_upload = failing_commit
+        with FileClient("127.0.0.1", self.server.port, "alice", streams=1) as client:
+            result = client.upload_many(paths)
+            self.assertFalse(result.ok)
+            self.assertEqual(result.message, "commit failed")
+            self.server.commit_upload = commit_upload
+            self.assertTrue(client.upload_many(paths).ok)
+
+            cached_content = self.server.cached_content
+            self.server.cached_content = failing_commit
+            target = os.path.join(self.temp.name, "downloads")
+            os.makedirs(target)
+            self.assertFalse(client.download_many(["a.txt", "b.txt"], "alice", target).ok)
+            self.server.cached_content = cached_content
+            self.assertTrue(client.download_many(["a.txt", "b.txt"], "alice", target).ok)
+            with open(os.path.join(target, "b.txt"), "rb") as file:
+                self.assertEqual(file.read(), b"b.txt" * 1000)
+
+    def test_rejected_before_it_starts(self):
+        path = self.local_file("local", "a\\b.txt", b"backslash")
+        with FileClient("127.0.0.1", self.server.port, "alice", streams=1) as client:
+            result = client.upload_many([path])
+            self.assertFalse(result.ok)
+            self.assertEqual(result.message, "Invalid file name 'a\\b.txt'.")
+            command = format_batch(format_command("BATCH_UPLOAD", stream="abc", channel=client.data_channel.channel_id),
+                                   [("a.txt", 1)])
+            with client.expect(lambda message: message.startswith("[ERROR]"), command) as waiter:
+                self.assertEqual(waiter.get(timeout=5), "[ERROR] Malformed batch upload.")
+            self.assertTrue(client.upload_many([self.local_file("local", "c.txt", b"c")]).ok)
+
+
+class DeltaUploadTest(ServerTestCase):
+    def test_only_changes_are_sent(self):
+        content = os.urandom(2 * 1024 * 1024)
+        path = self.local_file("local", "big.bin", content)
+        changed = content[:1000] + b"inserted" + content[1000:1500000] + content[1500100:]
+        with FileClient("127.0.0.1", self.server.port, "alice", streams=1) as client:
+            self.assertTrue(client.upload(path).ok)
+            self.local_file("local", "big.bin", changed)
+            self.assertTrue(client.upload(path).ok)
+            self.wait_for_log("bytes of changes sent")
+            target = os.path.join(self.temp.name, "downloads")
+            os.makedirs(target)
+            self.assertTrue(client.download("big.bin", "alice", target).ok)
+        with open(os.path.join(target, "big.bin"), "rb") as file:
+            self.assertEqual(file.read(), changed)
+
+    def test_rewritten_file_gives_up_quickly(self):
+        base, rewritten = os.urandom(8 * 1024 * 1024), os.urandom(8 * 1024 * 1024)
+        path = self.local_file("local", "big.bin", rewritten)
+        block_size = delta.block_size_for(len(base))
+        signatures, _ = delta.file_signatures([base], block_size)
+        started = time.monotonic()
+        self.assertIsNone(delta.compute_delta(path, signatures, block_size, len(base), len(rewritten) / 2))
+        self.assertLess(time.monotonic() - started, 1)
+        self.local_file("local", "big.bin", base)
+        with FileClient("127.0.0.1", self.server.port, "alice", streams=1) as client:
+            self.assertTrue(client.upload(path).ok)
+            self.local_file("local", "big.bin", rewritten)
+            self.assertTrue(client.upload(path).ok)  # Sent whole
+        self.assertFalse(any("bytes of changes sent" in message for message in self.log))
+        with open(self.server.catalog.path_of(self.server.catalog.get("alice", "big.bin")), "rb") as file:
+            self.assertEqual(file.read(), rewritten)
+
+
+class CatalogFeedTest(ServerTestCase):
+    def wait_for(self, changes, count):
+        deadline = time.monotonic() + 5
+        while len(changes) < count:
+            self.assertLess(time.monotonic(), deadline, "catalog changes did not arrive")
+            time.sleep(0.01)
+
+    def test_pages_and_catch_up(self):
+        paths = [self.local_file("local", f"file{index}.txt", b"x" * index) for index in range(5)]
+        with FileClient("127.0.0.1", self.server.port, "alice", streams=1) as client:
+            for path in paths[:4]:
+                self.assertTrue(client.upload(path).ok)
+            pages, after = [], None
+            while True:
+                page = client.list_page(after=after, limit=3)
+                pages.append(page.files)
+                if not page.more:
+                    break
+                after = page.files[-1]
+            self.assertEqual(pages, [[(f"file{index}.txt", "alice") for index in range(3)], [("file3.txt", "alice")]])
+            self.assertEqual(client.list_page(prefix="file3").files, [("file3.txt", "alice")])
+            position = page.position
+
+            self.assertTrue(client.upload(paths[4]).ok)
+            self.assertTrue(client.upload(paths[0]).ok)
+            self.assertTrue(client.delete("file1.txt").ok)
+
+        changes = []
+        with FileClient("127.0.0.1", self.server.port, "alice", streams=1) as client:
+            self.assertTrue(client.subscribe(changes.append, since=position))
+            self.wait_for(changes, 3)
+            self.assertEqual([(change.kind, change.filename, change.size) for change in changes],
+                             [("added", "file4.txt", 4), ("updated", "file0.txt", 0), ("removed", "file1.txt", None)])
+            epoch, _, sequence = position.partition(":")
+            self.assertEqual([change.position for change in changes],
+                             [f"{epoch}:{int(sequence) + offset}" for offset in (1, 2, 3)])
+            self.assertFalse(client.subscribe(changes.append, since="stale:1"))  # Another run's numbers
+
+
+class MigrationTest(ServerTestCase):
+    server_options = {"layout": "sharded"}
+    contents = {("alice", "notes.txt"): b"notes", ("bob", "50%.txt"): b"half", ("c_d", "e_f.txt"): b"underscores"}
+
+    def populate(self):
+        for (owner, filename), content in self.contents.items():
+            with open(os.path.join(self.storage_dir, stored_name(owner, filename)), "wb") as file:
+                file.write(content)
+
+    def test_flat_files_move_to_shards(self):
+        deadline = time.monotonic() + 5
+        while self.server.catalog.misplaced():
+            self.assertLess(time.monotonic(), deadline, "files were not migrated")
+            time.sleep(0.01)
+        for (owner, filename), content in self.contents.items():
+            path = sharded_path(owner, filename)
+            self.assertEqual(self.server.catalog.get(owner, filename).path, path)
+            self.assertFalse(os.path.exists(os.path.join(self.storage_dir, stored_name(owner, filename))))
+            with FileClient("127.0.0.1", self.server.port, "reader", streams=1) as client:
+                target = os.path.join(self.temp.name, "downloads", owner)
+                os.makedirs(target, exist_ok=True)
+                self.assertTrue(client.download(filename, owner, target).ok)
+                with open(os.path.join(target, filename), "rb") as file:
+                    self.assertEqual(file.read(), content)
+
+
+if __name__ == "__main__":
+    unittest.main()